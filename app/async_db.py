@@ -0,0 +1,108 @@
+"""
+Async versions of the db.py helpers for use inside the pyrogram handlers.
+
+Every call runs on a single dedicated database thread. It owns the long-lived
+SQLite connection, keeps disk waits and fsyncs off the event loop and
+serializes writes without any lock contention between handlers.
+"""
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+async def run(func, *args, **kwargs):
+    """
+    Run a blocking database function on the database thread and await its result.
+
+    Args:
+        func (callable): The function to run, usually one from db.py.
+        *args, **kwargs: Arguments passed to the function.
+
+    Returns:
+        any: The return value of the function.
+    """
+    loop = asyncio.get_running_loop()
+    name = func.__name__
+    submitted = time.perf_counter()
+
+    def call():
+        started = time.perf_counter()
+        metrics.DB_QUEUE_DEPTH.dec()
+        metrics.DB_WAIT_SECONDS.observe(started - submitted)
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            metrics.DB_ERRORS.inc(name)
+            raise
+        finally:
+            metrics.DB_SECONDS.observe(time.perf_counter() - started, name)
+
+    metrics.DB_QUEUE_DEPTH.inc()
+    return await loop.run_in_executor(_executor, call)
+
+
+def _wrap(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+
+    return wrapper
+
+
+user_exists = _wrap(db.user_exists)
+create_user = _wrap(db.create_user)
+register_user = _wrap(db.register_user)
+add_credits = _wrap(db.add_credits)
+set_credits = _wrap(db.set_credits)
+reserve_credits = _wrap(db.reserve_credits)
+commit_reservation = _wrap(db.commit_reservation)
+refund_reservation = _wrap(db.refund_reservation)
+expire_reservations = _wrap(db.expire_reservations)
+enqueue_job = _wrap(db.enqueue_job)
+claim_jobs = _wrap(db.claim_jobs)
+start_job = _wrap(db.start_job)
+finish_job = _wrap(db.finish_job)
+expire_jobs = _wrap(db.expire_jobs)
+get_queue_position = _wrap(db.get_queue_position)
+count_running_jobs = _wrap(db.count_running_jobs)
+add_chunks = _wrap(db.add_chunks)
+complete_chunk = _wrap(db.complete_chunk)
+set_chunk_predictions = _wrap(db.set_chunk_predictions)
+get_running_chunks = _wrap(db.get_running_chunks)
+count_jobs = _wrap(db.count_jobs)
+get_average_latency = _wrap(db.get_average_latency)
+get_popular_models = _wrap(db.get_popular_models)
+get_model_mirrors = _wrap(db.get_model_mirrors)
+add_model_mirror = _wrap(db.add_model_mirror)
+remove_model_mirror = _wrap(db.remove_model_mirror)
+get_media_upload = _wrap(db.get_media_upload)
+add_media_upload = _wrap(db.add_media_upload)
+add_media_history = _wrap(db.add_media_history)
+get_media_history = _wrap(db.get_media_history)
+get_media_history_item = _wrap(db.get_media_history_item)
+set_media_history_duration = _wrap(db.set_media_history_duration)
+add_shard_event = _wrap(db.add_shard_event)
+get_shard_events = _wrap(db.get_shard_events)
+get_last_shard_event_id = _wrap(db.get_last_shard_event_id)
+get_last_shard_event = _wrap(db.get_last_shard_event)
+delete_shard_events = _wrap(db.delete_shard_events)
+update_user_column = _wrap(db.update_user_column)
+get_users_columns = _wrap(db.get_users_columns)
+get_user = _wrap(db.get_user)
+update_user_columns = _wrap(db.update_user_columns)
+add_generation = _wrap(db.add_generation)
+create_broadcast = _wrap(db.create_broadcast)
+get_broadcast = _wrap(db.get_broadcast)
+get_running_broadcasts = _wrap(db.get_running_broadcasts)
+get_chat_ids_after = _wrap(db.get_chat_ids_after)
+update_broadcast_progress = _wrap(db.update_broadcast_progress)
+finish_broadcast = _wrap(db.finish_broadcast)
+complete_generation = _wrap(db.complete_generation)
+generate_users_report = _wrap(db.generate_users_report)
+generate_generations_report = _wrap(db.generate_generations_report)
@@ -0,0 +1,263 @@
+"""
+Audio processing with ffmpeg.
+
+With AUDIO_PREPROCESS=1 the voice goes through ffmpeg before the upload: the
+leading and trailing silence is trimmed, it's cut to MAX_AUDIO_DURATION,
+loudness normalized and resampled to mono AUDIO_SAMPLE_RATE. The user is
+billed for the duration of the result instead of the Telegram duration.
+
+The chunked conversions (chunking.py) split the voices at pauses and stitch
+the converted chunks back together with crossfades.
+"""
+import hashlib
+import os
+import re
+import subprocess
+
+AUDIO_PREPROCESS = os.getenv("AUDIO_PREPROCESS") == "1"
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+
+# Sample rate of the uploaded audio, RVC extracts its features at 16 kHz
+AUDIO_SAMPLE_RATE = int(os.getenv("AUDIO_SAMPLE_RATE", 16000))
+
+# Seconds kept from a voice after the leading silence
+MAX_AUDIO_DURATION = int(os.getenv("MAX_AUDIO_DURATION", 300))
+
+# Voices shorter than this (seconds) after trimming are rejected
+MIN_AUDIO_DURATION = 1
+
+# Level (dB) below which the start and the end of a voice count as silence
+SILENCE_THRESHOLD = os.getenv("SILENCE_THRESHOLD", "-45dB")
+
+# Loudness normalization filter, speechnorm is several times cheaper than
+# an EBU R128 "loudnorm=I=-16:TP=-1.5:LRA=11" and meant for voices
+AUDIO_NORMALIZE = os.getenv("AUDIO_NORMALIZE", "speechnorm=e=12.5:r=0.0001:l=1")
+
+# Bitrate of the Opus encoded result, plenty for a mono 16 kHz voice
+AUDIO_BITRATE = "24k"
+
+# Seconds ffmpeg may take for one voice
+FFMPEG_TIMEOUT = 120
+
+_silence = (
+    f"silenceremove=start_periods=1:start_threshold={SILENCE_THRESHOLD}"
+    ":start_silence=0.1"
+)
+
+
+def _run(command, input=None, timeout=FFMPEG_TIMEOUT):
+    """
+    Run ffmpeg and return the result, raises RuntimeError if it fails.
+    """
+    result = subprocess.run(command, input=input, capture_output=True, timeout=timeout)
+    if result.returncode != 0:
+        stderr = result.stderr.decode(errors="replace")
+        raise RuntimeError(f"ffmpeg failed: {stderr.strip()[-500:]}")
+    return result
+
+
+def build_filters(max_duration):
+    return ",".join(
+        [
+            # resample first so every other filter has less samples to go through
+            f"aresample={AUDIO_SAMPLE_RATE}",
+            # leading silence, then cap the length before reversing the audio in memory
+            _silence,
+            f"atrim=0:{max_duration}",
+            # trailing silence is the leading silence of the reversed audio
+            "areverse",
+            _silence,
+            "areverse",
+            AUDIO_NORMALIZE,
+            # only needed when AUDIO_NORMALIZE is loudnorm, which outputs
+            # 192 kHz, a no-op after speechnorm
+            f"aresample={AUDIO_SAMPLE_RATE}",
+        ]
+    )
+
+
+def processing_id():
+    """
+    Return an ID of the preprocessing settings, empty when preprocessing is off.
+    """
+    if not AUDIO_PREPROCESS:
+        return ""
+    settings = f"{build_filters(MAX_AUDIO_DURATION)}|{AUDIO_BITRATE}"
+    return hashlib.sha256(settings.encode()).hexdigest()[:16]
+
+
+def preprocess(audio, max_duration=MAX_AUDIO_DURATION):
+    """
+    Trim, normalize and resample a voice with ffmpeg.
+
+    Args:
+        audio (bytes or str): The voice file content, or its path.
+        max_duration (int): Seconds kept after the leading silence.
+
+    Returns:
+        tuple: (ogg_bytes, duration), the Opus encoded voice and its length in seconds.
+
+    Raises:
+        RuntimeError: If ffmpeg fails.
+    """
+    from_file = isinstance(audio, str)
+    command = [
+        FFMPEG_PATH,
+        "-hide_banner",
+        "-loglevel", "error",
+        "-nostats",
+        "-progress", "pipe:2",
+    ]  # fmt: skip
+    if from_file:
+        command += ["-nostdin", "-i", audio]
+    else:
+        command += ["-i", "pipe:0"]
+    command += [
+        "-af", build_filters(max_duration),
+        "-ac", "1",
+        "-c:a", "libopus",
+        "-b:a", AUDIO_BITRATE,
+        "-f", "ogg",
+        "pipe:1",
+    ]  # fmt: skip
+
+    result = _run(command, input=None if from_file else audio)
+    stderr = result.stderr.decode(errors="replace")
+
+    # the last progress report has the position of the end of the output
+    out_times = re.findall(r"out_time_us=(\d+)", stderr)
+    duration = int(out_times[-1]) / 1_000_000 if out_times else 0.0
+    return result.stdout, duration
+
+
+def probe_duration(source):
+    """
+    Return the length of an audio file or URL in seconds by decoding it.
+
+    Raises:
+        RuntimeError: If ffmpeg fails.
+    """
+    result = _run(
+        [
+            FFMPEG_PATH,
+            "-hide_banner",
+            "-loglevel", "error",
+            "-nostats",
+            "-nostdin",
+            "-progress", "pipe:2",
+            "-i", source,
+            "-f", "null",
+            "-",
+        ]  # fmt: skip
+    )
+    out_times = re.findall(r"out_time_us=(\d+)", result.stderr.decode(errors="replace"))
+    return int(out_times[-1]) / 1_000_000 if out_times else 0.0
+
+
+def find_silences(
+    source, threshold=SILENCE_THRESHOLD, min_silence=0.3, timeout=FFMPEG_TIMEOUT
+):
+    """
+    Return the middle (seconds) of every pause in an audio file.
+
+    Args:
+        source (str): Path or URL of the audio.
+        threshold (str): Level below which the audio counts as silence.
+        min_silence (float): Shortest pause (seconds) to report.
+        timeout (float): Seconds ffmpeg may take, long files need more.
+    """
+    result = _run(
+        [
+            FFMPEG_PATH,
+            "-hide_banner",
+            "-nostdin",
+            "-i", source,
+            "-af", f"silencedetect=n={threshold}:d={min_silence}",
+            "-f", "null",
+            "-",
+        ],  # fmt: skip
+        timeout=timeout,
+    )
+    stderr = result.stderr.decode(errors="replace")
+
+    starts = [float(value) for value in re.findall(r"silence_start: ([\d.]+)", stderr)]
+    ends = [float(value) for value in re.findall(r"silence_end: ([\d.]+)", stderr)]
+    return [(start + end) / 2 for start, end in zip(starts, ends)]
+
+
+def choose_cuts(silences, duration, chunk_duration):
+    """
+    Pick the cut points of chunks of about `chunk_duration` seconds.
+
+    Every cut is the pause closest to where the chunk would end, or exactly
+    there when there is no pause within half a chunk of it. The last chunk is
+    never shorter than half a chunk.
+    """
+    cuts = []
+    last = 0.0
+    while duration - last > chunk_duration * 1.5:
+        target = last + chunk_duration
+        candidates = [
+            silence
+            for silence in silences
+            if last + chunk_duration / 2 < silence < target + chunk_duration / 2
+        ]
+        cut = min(candidates, key=lambda s: abs(s - target)) if candidates else target
+        cuts.append(cut)
+        last = cut
+    return cuts
+
+
+def split_audio(source, cuts, directory, timeout=FFMPEG_TIMEOUT):
+    """
+    Cut an audio file at `cuts` (seconds) into Opus files in `directory`.
+
+    Returns:
+        list: Paths of the chunks in order.
+    """
+    command = [FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-nostdin"]
+    command += ["-i", source, "-c:a", "libopus", "-b:a", "64k"]
+    if cuts:
+        segment_times = ",".join(f"{cut:.3f}" for cut in cuts)
+        command += ["-f", "segment", "-segment_times", segment_times]
+        command.append(os.path.join(directory, "chunk%03d.ogg"))
+    else:
+        command += ["-f", "ogg", os.path.join(directory, "chunk000.ogg")]
+    _run(command, timeout=timeout)
+
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith("chunk")
+    )
+
+
+def stitch(sources, crossfade, timeout=FFMPEG_TIMEOUT):
+    """
+    Join audio files with a crossfade between each two of them.
+
+    Args:
+        sources (list): Paths or URLs of the audio files in order.
+        crossfade (float): Seconds the neighbouring files overlap.
+        timeout (float): Seconds ffmpeg may take, long files need more.
+
+    Returns:
+        bytes: The joined audio as MP3.
+    """
+    command = [FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-nostdin"]
+    for source in sources:
+        command += ["-i", source]
+
+    if len(sources) > 1:
+        # [0][1]acrossfade[a1];[a1][2]acrossfade[a2];...
+        filters = []
+        previous = "[0]"
+        for index in range(1, len(sources)):
+            label = f"[a{index}]"
+            filters.append(f"{previous}[{index}]acrossfade=d={crossfade}{label}")
+            previous = label
+        command += ["-filter_complex", ";".join(filters), "-map", previous]
+
+    command += ["-c:a", "libmp3lame", "-b:a", "192k", "-f", "mp3", "pipe:1"]
+
+    return _run(command, timeout=timeout).stdout
@@ -0,0 +1,76 @@
+"""
+Benchmark of the audio preprocessing stage on generated voices.
+
+Generates Telegram-like voices (48 kHz mono Opus) with silence before and
+after the speech, runs them through audio.preprocess and compares the size
+and the billed duration before and after, and the time ffmpeg takes.
+
+Usage (from the app directory, needs ffmpeg or FFMPEG_PATH):
+    python -m benchmarks.audio
+"""
+import subprocess
+import time
+
+import audio
+
+# (speech seconds, silence seconds before and after)
+SAMPLES = [(5, 1), (10, 3), (30, 5), (60, 10), (280, 20)]
+
+
+def make_voice(speech, silence):
+    # an amplitude modulated tone stands in for the speech
+    expression = (
+        f"if(between(t,{silence},{silence + speech}),"
+        "0.3*sin(2*PI*180*t)*(0.6+0.4*sin(2*PI*3*t)),0)"
+    )
+    result = subprocess.run(
+        [
+            audio.FFMPEG_PATH,
+            "-loglevel", "error",
+            "-f", "lavfi",
+            "-i", f"aevalsrc='{expression}':s=48000:d={speech + 2 * silence}",
+            "-c:a", "libopus",
+            "-b:a", "32k",
+            "-f", "ogg",
+            "pipe:1",
+        ],  # fmt: skip
+        capture_output=True,
+        check=True,
+    )
+    return result.stdout
+
+
+def main():
+    print(
+        f"{'voice':<18}{'in KB':>8}{'out KB':>8}{'billed s':>10}"
+        f"{'processed s':>13}{'ffmpeg ms':>11}"
+    )
+
+    totals = {"in": 0, "out": 0, "billed": 0, "processed": 0}
+    for speech, silence in SAMPLES:
+        data = make_voice(speech, silence)
+        billed = speech + 2 * silence
+
+        start = time.perf_counter()
+        output, duration = audio.preprocess(data)
+        elapsed = time.perf_counter() - start
+
+        print(
+            f"{f'{speech}s + 2x{silence}s':<18}{len(data) / 1024:>8.1f}"
+            f"{len(output) / 1024:>8.1f}{billed:>10}{duration:>13.1f}"
+            f"{elapsed * 1000:>11.0f}"
+        )
+        totals["in"] += len(data)
+        totals["out"] += len(output)
+        totals["billed"] += billed
+        totals["processed"] += duration
+
+    print(
+        f"\nbilled seconds: {totals['billed']} -> {totals['processed']:.0f} "
+        f"({1 - totals['processed'] / totals['billed']:.0%} less), "
+        f"upload: {totals['in'] / 1024:.0f} KB -> {totals['out'] / 1024:.0f} KB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Time to result of a long voice converted in one prediction vs in chunks.
+
+Generates a long voice with a pause every few seconds, uploads it to a fake
+ufiles and converts it through the job queue, the fake Replicate and the
+webhook server, once as a single prediction and once with CHUNKED_CONVERSION.
+The fake Replicate takes `rtf` seconds per second of input audio (estimated
+from the size of the 64 kbps input) plus a fixed startup time, and echoes the
+input as output so the stitched result is real audio.
+
+Usage (from the app directory, needs ffmpeg or FFMPEG_PATH):
+    python -m benchmarks.chunked [seconds] [rtf]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+PORT = 8280
+BYTES_PER_SECOND = 64000 / 8
+PREDICTION_STARTUP = 2.0  # seconds before a prediction starts converting
+
+
+def make_voice(path, seconds):
+    import audio
+
+    # 6 seconds of "speech" then 0.6 seconds of pause, again and again
+    expression = "0.3*sin(2*PI*180*t)*(0.6+0.4*sin(2*PI*3*t))*lt(mod(t,6.6),6)"
+    audio._run(
+        [
+            audio.FFMPEG_PATH,
+            "-loglevel", "error",
+            "-y",
+            "-f", "lavfi",
+            "-i", f"aevalsrc='{expression}':s=48000:d={seconds}",
+            "-c:a", "libopus",
+            "-b:a", "64k",
+            path,
+        ]  # fmt: skip
+    )
+
+
+async def convert(bot, chat_id, audio_url, seconds):
+    import db
+    import job_queue
+
+    db.create_user(chat_id)
+    db.add_credits(chat_id, seconds, "admin")
+    reservation_id, _ = db.reserve_credits(chat_id, seconds)
+    payload = {
+        "audio": audio_url,
+        "model_url": "https://example.com/model.zip",
+        "pitch": 0,
+        "voice_name": "Fake Voice",
+        "rvc_model": "CUSTOM",
+        "duration": seconds,
+        "model_name": "fake_voice",
+    }
+
+    start = time.perf_counter()
+    await job_queue.enqueue(chat_id, reservation_id, payload)
+    while not any(sent[1] == chat_id for sent in bot.sent):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    kind, _, result = next(sent for sent in bot.sent if sent[1] == chat_id)
+    return elapsed, result if kind == "audio" else None
+
+
+async def run(seconds, rtf, workdir):
+    from aiohttp import web
+
+    from benchmarks import fake_replicate, fake_ufiles
+
+    import audio
+    import chunking
+    import job_queue
+    import uploader
+    import webhook
+    from migrations import migrate
+
+    migrate()
+
+    ufiles_app = fake_ufiles.create_app(latency=0.1)
+
+    def latency_fn(prediction_input):
+        path = prediction_input["input_audio"].split(str(PORT + 2), 1)[1]
+        size = len(ufiles_app["files"][path])
+        return PREDICTION_STARTUP + rtf * size / BYTES_PER_SECOND
+
+    replicate_app = fake_replicate.create_predictions_app(
+        latency_fn=latency_fn, echo=True
+    )
+    runners = []
+    for app, port in ((replicate_app, PORT + 1), (ufiles_app, PORT + 2)):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+
+    bot = fake_replicate.FakeBot()
+    runners.append(await webhook.start_server(bot, "127.0.0.1", PORT))
+    scheduler = asyncio.create_task(job_queue.run_scheduler(bot))
+
+    voice = os.path.join(workdir, "voice.ogg")
+    make_voice(voice, seconds)
+    # off the event loop, the fakes run on it
+    audio_url = await asyncio.to_thread(uploader.upload_file, voice, "voice.ogg")
+
+    print(
+        f"{seconds}s voice, {rtf}s per second of audio "
+        f"+ {PREDICTION_STARTUP}s startup per prediction\n"
+    )
+    print(f"{'mode':<10}{'predictions':>13}{'time to result':>16}{'result':>10}")
+    for chat_id, chunked in ((1, False), (2, True)):
+        chunking.CHUNKED_CONVERSION = chunked
+        created = replicate_app["stats"]["created"]
+        elapsed, result = await convert(bot, chat_id, audio_url, seconds)
+        if result:
+            length = f"{await asyncio.to_thread(audio.probe_duration, result):.1f}s"
+        else:
+            length = "failed"
+        print(
+            f"{'chunked' if chunked else 'single':<10}"
+            f"{replicate_app['stats']['created'] - created:>13}"
+            f"{elapsed:>15.1f}s{length:>10}"
+        )
+
+    scheduler.cancel()
+    for runner in runners:
+        await runner.cleanup()
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    rtf = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    from benchmarks.fake_replicate import SECRET
+
+    os.environ.update(
+        {
+            "REPLICATE_API_TOKEN": "fake",
+            "REPLICATE_BASE_URL": f"http://127.0.0.1:{PORT + 1}",
+            "UFILES_URL": f"http://127.0.0.1:{PORT + 2}/v1/f",
+            "USSO_URL": f"http://127.0.0.1:{PORT + 2}",
+            "PTOKEN": "fake",
+            "WEBHOOK_URL": f"http://127.0.0.1:{PORT}/webhook/replicate",
+            "REPLICATE_WEBHOOK_SECRET": SECRET,
+        }
+    )
+
+    with tempfile.TemporaryDirectory() as workdir:
+        import db
+
+        db.DB_NAME = os.path.join(workdir, "chunked.db")
+        asyncio.run(run(seconds, rtf, workdir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Compare connecting to SQLite on every call with the pooled connection of db.py.
+
+Replays the db calls made by the handlers in main.py for one user:
+/start (new user), sending a voice, selecting a voice model and a pitch.
+
+Usage (from the app directory):
+    python -m benchmarks.db_pool [users]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import db
+from migrations import migrate
+
+PAYLOAD = {
+    "audio": "https://example.com/audio.ogg",
+    "model_url": "https://example.com/model.zip",
+    "pitch": 0,
+    "voice_name": "Fake Voice",
+    "rvc_model": "CUSTOM",
+    "duration": 10,
+    "model_name": "model",
+}
+
+# db calls made by each handler, in the order main.py makes them, the reads
+# served by user_cache and media_cache are left out
+START = [
+    ("register_user", lambda c: (c, f"user{c}", None)),
+]
+VOICE = [
+    ("get_media_upload", lambda c: (f"file{c}", "", 30)),
+    (
+        "add_media_upload",
+        lambda c: (f"file{c}", "", f"https://example.com/{c}.ogg", 10, f"hash{c}", 1000),
+    ),
+    ("add_media_history", lambda c: (c, f"https://example.com/{c}.ogg", 10, f"hash{c}")),
+    (
+        "update_user_columns",
+        lambda c: (c, {"audio": f"https://example.com/{c}.ogg", "duration": 10}),
+    ),
+]
+VOICE_CALLBACK = [
+    ("update_user_columns", lambda c: (c, {"model_name": "model"})),
+    # the first read of the user misses the cache
+    ("get_user", lambda c: (c,)),
+]
+PITCH_CALLBACK = [
+    ("reserve_credits", lambda c: (c, 10)),
+    # the reservation ID isn't checked, any one does
+    ("enqueue_job", lambda c: (c, c, PAYLOAD)),
+]
+SEQUENCES = {
+    "/start": START,
+    "voice": VOICE,
+    "voice_ callback": VOICE_CALLBACK,
+    "pitch_ callback": PITCH_CALLBACK,
+}
+
+
+def run(db_path, users, per_call):
+    """
+    Run every handler sequence for `users` users and return the seconds spent per sequence.
+    """
+    db.DB_NAME = db_path
+    db.close_connection()
+    if per_call:
+        # behave like the old db.py: default journal and a new connection per call
+        db.PRAGMAS = {}
+    migrate()
+
+    timings = {}
+    for name, sequence in SEQUENCES.items():
+        start = time.perf_counter()
+        for chat_id in range(users):
+            for func_name, args in sequence:
+                getattr(db, func_name)(*args(chat_id))
+                if per_call:
+                    db.close_connection()
+        timings[name] = time.perf_counter() - start
+
+    db.close_connection()
+    return timings
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    pragmas = dict(db.PRAGMAS)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        per_call = run(os.path.join(tmp, "per_call.db"), users, per_call=True)
+        db.PRAGMAS = pragmas
+        pooled = run(os.path.join(tmp, "pooled.db"), users, per_call=False)
+
+    print(f"{users} users\n")
+    print(f"{'sequence':<18}{'per-call ms/user':>18}{'pooled ms/user':>18}{'speedup':>10}")
+    for name in SEQUENCES:
+        a = per_call[name] / users * 1000
+        b = pooled[name] / users * 1000
+        print(f"{name:<18}{a:>18.3f}{b:>18.3f}{a / b:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
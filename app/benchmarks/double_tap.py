@@ -0,0 +1,138 @@
+"""
+Double taps on the pitch buttons, with and without coalescing.
+
+Drives the handlers of main.py with the fake Telegram client of the e2e
+benchmark. Every user gets to the pitch buttons, then taps the same button
+`taps` times at once. Without coalescing (the handler under rate_limit.limit
+called directly) every tap runs process_pitch_conversion and submits a job.
+Reports the jobs submitted and the time until the taps are answered.
+
+Usage (from the app directory):
+    python -m benchmarks.double_tap [users] [taps]
+"""
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+PORT = 8780
+API_LATENCY = 0.05
+UPLOAD_LATENCY = 0.2
+
+
+async def to_pitch(main, client, chat_id):
+    from benchmarks.e2e import MODEL_KEY, FakeCallbackQuery, FakeMessage, FakeVoice
+
+    await main.start_text(client, FakeMessage(client, chat_id, "/start"))
+    await main.get_voice_or_audio(
+        client, FakeMessage(client, chat_id, voice=FakeVoice(chat_id))
+    )
+    for data in ("gender_male", f"voice_{MODEL_KEY}"):
+        await main.callbacks(client, FakeCallbackQuery(client, chat_id, data))
+
+
+async def double_tap(handler, client, chat_id, taps, answered):
+    from benchmarks.e2e import FakeCallbackQuery
+
+    start = time.perf_counter()
+
+    class TimedCallbackQuery(FakeCallbackQuery):
+        async def answer(self, text=None, **kwargs):
+            answered.append(time.perf_counter() - start)
+            await super().answer(text, **kwargs)
+
+    queries = [TimedCallbackQuery(client, chat_id, "pitch_0") for _ in range(taps)]
+    for query in queries[1:]:
+        # the taps are on the same message
+        query.message = queries[0].message
+    await asyncio.gather(*(handler(client, query) for query in queries))
+
+
+async def run(users, taps):
+    from aiohttp import web
+
+    from benchmarks import fake_ufiles
+    from benchmarks.e2e import FakeClient, percentile
+
+    import db
+    import main
+    import rate_limit
+
+    client = FakeClient(API_LATENCY, None)
+    main.bot = client
+    runner = web.AppRunner(fake_ufiles.create_app(UPLOAD_LATENCY))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    def count_jobs():
+        return db.get_connection().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    print(f"{'coalescing':<12}{'taps':>6}{'jobs':>6}{'answer p50 ms':>15}")
+    for name, handler, first_id in (
+        ("off", main.callbacks.__wrapped__, 1_000_000),
+        ("on", main.callbacks, 2_000_000),
+    ):
+        chat_ids = range(first_id, first_id + users)
+        await asyncio.gather(*(to_pitch(main, client, c) for c in chat_ids))
+
+        jobs = count_jobs()
+        answered = []
+        await asyncio.gather(
+            *(double_tap(handler, client, c, taps, answered) for c in chat_ids)
+        )
+        print(
+            f"{name:<12}{users * taps:>6}{count_jobs() - jobs:>6}"
+            f"{percentile(answered, 0.5) * 1000:>15.1f}"
+        )
+
+    await runner.cleanup()
+    print(f"\ncoalesced taps: {rate_limit.COALESCED.get()}")
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    taps = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    workdir = tempfile.mkdtemp(prefix="nedaai-taps-")
+    os.makedirs(os.path.join(workdir, "sessions"))
+    from benchmarks.e2e import MODEL_KEY
+
+    with open(os.path.join(workdir, "sessions", "models.json"), "w") as f:
+        json.dump(
+            {
+                MODEL_KEY: {
+                    "name": "Fake Voice",
+                    "category": "actor",
+                    "gender": "male",
+                    "url": "https://example.com/model.zip",
+                    "pitch": 0,
+                    "type": "CUSTOM",
+                }
+            },
+            f,
+        )
+
+    os.environ.update(
+        {
+            "UFILES_URL": f"http://127.0.0.1:{PORT}/v1/f",
+            "USSO_URL": f"http://127.0.0.1:{PORT}",
+            "PTOKEN": "fake",
+            "WEBHOOK_URL": "http://127.0.0.1/webhook/replicate",
+        }
+    )
+    os.chdir(workdir)
+    try:
+        asyncio.run(run(users, taps))
+    finally:
+        os.chdir(APP_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
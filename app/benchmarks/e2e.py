@@ -0,0 +1,298 @@
+"""
+End-to-end throughput benchmark of the bot without Telegram and Replicate.
+
+Runs a fake Replicate predictions API, a fake ufiles endpoint and the bot's
+webhook server locally, then drives the handlers of main.py (start_text,
+get_voice_or_audio, callbacks) with synthetic pyrogram messages for N
+concurrent users. Each user sends /start and a voice, picks a gender, a
+voice and a pitch, and waits for the converted audio.
+
+Reports p50/p95/p99 latency per handler and conversions per second.
+
+Usage (from the app directory):
+    python -m benchmarks.e2e --users 50 --latency 5 --failure-rate 0.05
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+MODEL_KEY = "fake_voice"
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.mention = f"@user{user_id}"
+        self.is_bot = False
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeVoice:
+    def __init__(self, chat_id, duration=10):
+        self.file_id = f"voice{chat_id}"
+        self.file_unique_id = f"unique{chat_id}"
+        self.duration = duration
+        self.file_size = 32 * 1024
+
+
+class FakeMessage:
+    def __init__(self, client, chat_id, text=None, voice=None):
+        self._client = client
+        self.id = client.next_message_id()
+        self.chat = FakeChat(chat_id)
+        self.from_user = FakeUser(chat_id)
+        self.text = text
+        self.voice = voice
+        self.audio = None
+
+    async def reply(self, text, **kwargs):
+        return await self._client.send_message(self.chat.id, text, **kwargs)
+
+    async def reply_audio(self, audio, **kwargs):
+        return await self._client.send_audio(self.chat.id, audio, **kwargs)
+
+    async def delete(self):
+        await self._client.api_call()
+
+
+class FakeCallbackQuery:
+    def __init__(self, client, chat_id, data):
+        self.id = str(client.next_message_id())
+        self.data = data
+        self.from_user = FakeUser(chat_id)
+        self.message = FakeMessage(client, chat_id)
+        self._client = client
+
+    async def answer(self, text=None, **kwargs):
+        await self._client.api_call()
+
+
+class FakeClient:
+    """
+    Stand-in for the pyrogram client with a fixed Telegram API latency.
+    """
+
+    def __init__(self, api_latency, failure_text):
+        self.api_latency = api_latency
+        self.failure_text = failure_text
+        self.results = {}  # chat_id -> future of "succeeded" or "failed"
+        self._message_id = 0
+
+    def next_message_id(self):
+        self._message_id += 1
+        return self._message_id
+
+    def expect_result(self, chat_id):
+        self.results[chat_id] = asyncio.get_running_loop().create_future()
+        return self.results[chat_id]
+
+    def _set_result(self, chat_id, status):
+        future = self.results.get(int(chat_id))
+        if future and not future.done():
+            future.set_result(status)
+
+    async def api_call(self):
+        await asyncio.sleep(self.api_latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.api_call()
+        if text == self.failure_text:
+            self._set_result(chat_id, "failed")
+        return FakeMessage(self, chat_id, text)
+
+    async def send_audio(self, chat_id, audio, **kwargs):
+        await self.api_call()
+        self._set_result(chat_id, "succeeded")
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        await self.api_call()
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self.api_call()
+
+    async def get_me(self):
+        await self.api_call()
+        return FakeUser(0)
+
+    async def download_media(self, file_id, in_memory=False, file_name=None):
+        await self.api_call()
+        # unique content per user, so the conversion cache doesn't kick in
+        data = file_id.encode() * 4096
+        if in_memory:
+            file = io.BytesIO(data)
+            file.name = file_id
+            return file
+
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name, "wb") as f:
+            f.write(data)
+        return file_name
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def simulate_user(main, client, chat_id, timings, timeout):
+    async def timed(name, handler, *args):
+        start = time.perf_counter()
+        await handler(client, *args)
+        timings[name].append(time.perf_counter() - start)
+
+    result = client.expect_result(chat_id)
+
+    await timed("start_text", main.start_text, FakeMessage(client, chat_id, "/start"))
+    await timed(
+        "get_voice_or_audio",
+        main.get_voice_or_audio,
+        FakeMessage(client, chat_id, voice=FakeVoice(chat_id)),
+    )
+    for data in ("gender_male", f"voice_{MODEL_KEY}", "pitch_0"):
+        await timed(
+            f"callbacks ({data.split('_')[0]})",
+            main.callbacks,
+            FakeCallbackQuery(client, chat_id, data),
+        )
+
+    try:
+        return await asyncio.wait_for(result, timeout)
+    except asyncio.TimeoutError:
+        return "timeout"
+
+
+async def run(args):
+    from aiohttp import web
+
+    from benchmarks import fake_replicate, fake_ufiles
+
+    import job_queue
+    import main
+    import msgs
+    import webhook
+
+    client = FakeClient(
+        args.api_latency, msgs.conversion_failed.format(admin=msgs.admin_username)
+    )
+    main.bot = client
+
+    replicate_app = fake_replicate.create_predictions_app(
+        args.latency, args.failure_rate
+    )
+    ufiles_app = fake_ufiles.create_app(args.upload_latency)
+    runners = []
+    for app, port in ((replicate_app, args.port + 1), (ufiles_app, args.port + 2)):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+    runners.append(await webhook.start_server(client, "127.0.0.1", args.port))
+    scheduler = asyncio.create_task(job_queue.run_scheduler(client))
+
+    timings = defaultdict(list)
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(
+            simulate_user(main, client, 1_000_000 + i, timings, args.timeout)
+            for i in range(args.users)
+        )
+    )
+    elapsed = time.perf_counter() - start
+
+    scheduler.cancel()
+    for runner in runners:
+        await runner.cleanup()
+
+    print(f"\n{args.users} users, {elapsed:.1f}s\n")
+    print(f"{'handler':<28}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in timings.items():
+        print(
+            f"{name:<28}{len(values):>7}"
+            f"{percentile(values, 0.5) * 1000:>10.1f}"
+            f"{percentile(values, 0.95) * 1000:>10.1f}"
+            f"{percentile(values, 0.99) * 1000:>10.1f}"
+        )
+
+    succeeded = results.count("succeeded")
+    print(
+        f"\nconversions: {succeeded} succeeded, {results.count('failed')} failed, "
+        f"{results.count('timeout')} timed out"
+    )
+    print(f"throughput: {succeeded / elapsed:.2f} conversions/s")
+    print(f"replicate: {replicate_app['stats']}")
+    print(f"ufiles: {ufiles_app['stats']}")
+    if timings:
+        all_values = [value for values in timings.values() for value in values]
+        print(f"mean handler latency: {statistics.mean(all_values) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=5, help="prediction seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--upload-latency", type=float, default=0.2)
+    parser.add_argument("--api-latency", type=float, default=0.05, help="telegram seconds")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--port", type=int, default=8180)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="nedaai-e2e-")
+    os.makedirs(os.path.join(workdir, "sessions"))
+    with open(os.path.join(workdir, "sessions", "models.json"), "w") as f:
+        json.dump(
+            {
+                MODEL_KEY: {
+                    "name": "Fake Voice",
+                    "category": "actor",
+                    "gender": "male",
+                    "url": "https://example.com/model.zip",
+                    "pitch": 0,
+                    "type": "CUSTOM",
+                }
+            },
+            f,
+        )
+
+    # point the bot at the fakes before its modules read the environment
+    from benchmarks.fake_replicate import SECRET
+
+    os.environ.update(
+        {
+            "REPLICATE_API_TOKEN": "fake",
+            "REPLICATE_BASE_URL": f"http://127.0.0.1:{args.port + 1}",
+            "UFILES_URL": f"http://127.0.0.1:{args.port + 2}/v1/f",
+            "USSO_URL": f"http://127.0.0.1:{args.port + 2}",
+            "PTOKEN": "fake",
+            "WEBHOOK_URL": f"http://127.0.0.1:{args.port}/webhook/replicate",
+            "REPLICATE_WEBHOOK_SECRET": SECRET,
+        }
+    )
+    os.chdir(workdir)
+    try:
+        asyncio.run(run(args))
+    finally:
+        os.chdir(APP_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Fake Replicate for trying webhook.py and the bot without Replicate.
+
+create_predictions_app() is a stand-in for the predictions API: it accepts
+predictions, waits a configurable latency and posts signed webhooks back,
+failing a configurable share of them (used by benchmarks/e2e.py).
+
+Run as a script, it starts the webhook server with a stand-in bot on a
+temporary database, posts signed prediction webhooks to it the way Replicate
+does and prints what was recorded and sent.
+
+Usage (from the app directory):
+    python -m benchmarks.fake_replicate
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import tempfile
+import time
+import uuid
+from urllib.parse import urlencode
+
+import aiohttp
+from aiohttp import web
+
+SECRET = "whsec_" + base64.b64encode(b"fake replicate secret").decode()
+
+# Deliveries of a webhook before it counts as undelivered
+WEBHOOK_ATTEMPTS = 5
+
+
+def sign(body, secret=SECRET):
+    """
+    Return the webhook headers Replicate would send with `body`.
+    """
+    webhook_id = f"msg_{uuid.uuid4().hex}"
+    timestamp = str(int(time.time()))
+    key = base64.b64decode(secret.split("_", 1)[-1])
+    signature = base64.b64encode(
+        hmac.new(key, f"{webhook_id}.{timestamp}.".encode() + body, hashlib.sha256).digest()
+    ).decode()
+    return {
+        "webhook-id": webhook_id,
+        "webhook-timestamp": timestamp,
+        "webhook-signature": f"v1,{signature}",
+        "content-type": "application/json",
+    }
+
+
+async def post_prediction(session, url, prediction, query, secret=SECRET):
+    """
+    Post a prediction webhook and return the response status and text.
+    """
+    body = json.dumps(prediction).encode()
+    async with session.post(
+        f"{url}?{urlencode(query)}", data=body, headers=sign(body, secret)
+    ) as response:
+        return response.status, await response.text()
+
+
+def fake_prediction(replicate_id, status="succeeded"):
+    return {
+        "id": replicate_id,
+        "status": status,
+        "output": f"https://replicate.delivery/fake/{replicate_id}.wav"
+        if status == "succeeded"
+        else None,
+        "error": None if status == "succeeded" else "fake failure",
+    }
+
+
+def create_predictions_app(
+    latency=5.0, failure_rate=0.0, secret=SECRET, latency_fn=None, echo=False
+):
+    """
+    Create a fake of the Replicate predictions API.
+
+    Args:
+        latency (float): Mean seconds between creating a prediction and its
+            webhook, each prediction takes 50% to 150% of it.
+        failure_rate (float): Share of the predictions that fail.
+        secret (str): Webhook signing secret.
+        latency_fn (callable): Returns the seconds a prediction takes from its
+            input, used instead of `latency` when given.
+        echo (bool): Use the input audio URL as the output, so the output is
+            real audio when the input is.
+
+    Returns:
+        web.Application: The app, its "stats" key counts created, succeeded,
+            failed and undelivered predictions.
+    """
+    app = web.Application()
+    app["stats"] = {"created": 0, "succeeded": 0, "failed": 0, "undelivered": 0}
+    tasks = set()
+
+    async def finish(prediction, webhook_url):
+        if latency_fn:
+            await asyncio.sleep(latency_fn(prediction["input"]))
+        else:
+            await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        status = "failed" if random.random() < failure_rate else "succeeded"
+        prediction.update(fake_prediction(prediction["id"], status))
+        if echo and status == "succeeded":
+            prediction["output"] = prediction["input"]["input_audio"]
+        app["stats"][status] += 1
+
+        body = json.dumps(prediction).encode()
+        # like Replicate, retry the webhooks answered with an error
+        for attempt in range(WEBHOOK_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(0.1 * 2**attempt)
+            try:
+                async with app["session"].post(
+                    webhook_url, data=body, headers=sign(body, secret)
+                ) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+        app["stats"]["undelivered"] += 1
+
+    async def create_prediction(request):
+        data = await request.json()
+        app["stats"]["created"] += 1
+        prediction = {
+            "id": uuid.uuid4().hex,
+            "model": "fake/rvc",
+            "version": data["version"],
+            "status": "starting",
+            "input": data["input"],
+            "output": None,
+            "logs": "",
+            "error": None,
+            "metrics": {},
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "started_at": None,
+            "completed_at": None,
+            "urls": {},
+        }
+
+        if data.get("webhook"):
+            task = asyncio.create_task(finish(dict(prediction), data["webhook"]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        return web.json_response(prediction, status=201)
+
+    async def session_context(app):
+        app["session"] = aiohttp.ClientSession()
+        yield
+        await app["session"].close()
+
+    app.cleanup_ctx.append(session_context)
+    app.router.add_post("/v1/predictions", create_prediction)
+    return app
+
+
+class FakeBot:
+    """
+    Stand-in for the pyrogram client that records what would be sent.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_audio(self, chat_id, audio, caption=None):
+        self.sent.append(("audio", chat_id, audio))
+
+    async def send_message(self, chat_id, text):
+        self.sent.append(("message", chat_id, text))
+
+
+async def main():
+    # webhook.py imports the uploader, which needs a token to be created
+    os.environ.setdefault("PTOKEN", "fake")
+
+    import db
+    import migrations
+    import webhook
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, "fake_replicate.db")
+        migrations.migrate()
+        db.add_generation(1, "audio", "model", 10, "ok_prediction")
+        db.add_generation(2, "audio", "model", 10, "failed_prediction")
+
+        webhook.WEBHOOK_SECRET = SECRET
+        bot = FakeBot()
+        runner = await webhook.start_server(bot, "127.0.0.1", 8099)
+        url = f"http://127.0.0.1:8099{webhook.WEBHOOK_PATH}"
+
+        async with aiohttp.ClientSession() as session:
+            for replicate_id, t_id, status in [
+                ("ok_prediction", 1, "succeeded"),
+                ("ok_prediction", 1, "succeeded"),  # webhook retried by Replicate
+                ("failed_prediction", 2, "failed"),
+                ("unknown_prediction", 3, "succeeded"),  # not recorded yet
+            ]:
+                result = await post_prediction(
+                    session,
+                    url,
+                    fake_prediction(replicate_id, status),
+                    {"t_id": t_id, "voice": "fake voice", "duration": 10},
+                )
+                print(replicate_id, status, "->", *result)
+
+            result = await post_prediction(
+                session, url, fake_prediction("ok_prediction"), {}, secret="whsec_d3Jvbmc="
+            )
+            print("wrong secret ->", *result)
+
+        await asyncio.sleep(0.1)
+        await runner.cleanup()
+
+        print("\nsent:", *bot.sent, sep="\n  ")
+        rows = db.get_connection().execute(
+            "SELECT replicate_id, status, output, latency FROM generations"
+        )
+        print("\ngenerations:", *rows.fetchall(), sep="\n  ")
+        db.close_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
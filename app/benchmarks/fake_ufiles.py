@@ -0,0 +1,68 @@
+"""
+Fake ufiles upload endpoint, used by the benchmarks in place of pixiee.
+
+Uploaded files are kept in memory and served back from their URL.
+"""
+import asyncio
+import datetime
+import uuid
+
+from aiohttp import web
+
+
+def create_app(latency=0.2):
+    """
+    Create a fake of the ufiles API that accepts uploads after `latency` seconds.
+
+    Returns:
+        web.Application: The app, its "stats" key counts uploads and bytes and
+            its "files" key maps the URL paths to the uploaded content.
+    """
+    app = web.Application(client_max_size=100 * 1024 * 1024)
+    app["stats"] = {"uploads": 0, "bytes": 0}
+    app["files"] = {}
+
+    async def upload(request):
+        content = bytearray()
+        filename = "file"
+        async for field in (await request.multipart()):
+            if field.name == "file":
+                filename = field.filename or filename
+                while chunk := await field.read_chunk():
+                    content += chunk
+            elif field.name == "filename":
+                filename = await field.text()
+        size = len(content)
+
+        await asyncio.sleep(latency)
+        app["stats"]["uploads"] += 1
+        app["stats"]["bytes"] += size
+
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        uid = str(uuid.uuid4())
+        path = f"/files/{uid}/{filename.replace('/', '_')}"
+        app["files"][path] = bytes(content)
+        return web.json_response(
+            {
+                "uid": uid,
+                "created_at": now,
+                "updated_at": now,
+                "is_deleted": False,
+                "user_id": str(uuid.uuid4()),
+                "business_name": "fake",
+                "filename": filename,
+                "url": f"{request.scheme}://{request.host}{path}",
+                "size": size,
+                "content_type": "audio/ogg",
+            }
+        )
+
+    async def download(request):
+        content = app["files"].get(request.path)
+        if content is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=content)
+
+    app.router.add_post("/v1/f/upload", upload)
+    app.router.add_get("/files/{uid}/{filename}", download)
+    return app
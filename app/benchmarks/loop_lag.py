@@ -0,0 +1,85 @@
+"""
+Measure event-loop lag while simulated users hit the database.
+
+Each simulated user runs the db calls of a full conversion flow (see
+benchmarks/db_pool.py) either directly on the event loop, like the handlers
+used to, or through the async_db facade. A monitor task sleeps in small steps
+and records how late it wakes up.
+
+Usage (from the app directory):
+    python -m benchmarks.loop_lag [max_users]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import async_db
+import db
+from benchmarks.db_pool import SEQUENCES
+from migrations import migrate
+
+TICK = 0.005
+
+
+async def monitor_lag(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def simulated_user(chat_id, use_facade):
+    for sequence in SEQUENCES.values():
+        for func_name, args in sequence:
+            if use_facade:
+                await getattr(async_db, func_name)(*args(chat_id))
+            else:
+                getattr(db, func_name)(*args(chat_id))
+            # handlers await telegram between db calls
+            await asyncio.sleep(0)
+
+
+async def run(users, use_facade, offset):
+    lags = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_lag(lags, stop))
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(simulated_user(offset + i, use_facade) for i in range(users))
+    )
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await monitor
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99)] if lags else 0
+    return elapsed, statistics.mean(lags) if lags else 0, p99, lags[-1] if lags else 0
+
+
+def main():
+    max_users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, "loop_lag.db")
+        # full fsync on every commit, like a slow disk in production
+        db.PRAGMAS["synchronous"] = "FULL"
+        migrate()
+
+        print(f"{'users':>6}{'mode':>10}{'total s':>10}{'mean lag ms':>14}{'p99 lag ms':>13}{'max lag ms':>13}")
+        users = 1
+        offset = 0
+        while users <= max_users:
+            for use_facade in (False, True):
+                elapsed, mean, p99, worst = asyncio.run(run(users, use_facade, offset))
+                offset += users
+                mode = "async_db" if use_facade else "direct"
+                print(f"{users:>6}{mode:>10}{elapsed:>10.3f}{mean * 1000:>14.2f}{p99 * 1000:>13.2f}{worst * 1000:>13.2f}")
+            users *= 4
+
+
+if __name__ == "__main__":
+    main()
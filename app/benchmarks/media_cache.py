@@ -0,0 +1,104 @@
+"""
+Latency of get_voice_or_audio for new voices vs forwarded ones.
+
+Drives main.get_voice_or_audio with the fake Telegram client of the e2e
+benchmark and a fake ufiles endpoint. Every voice is sent once, then
+forwarded `forwards` times (same file_unique_id), then forwarded once more
+after the in-memory cache was cleared, like after a restart.
+
+Usage (from the app directory):
+    python -m benchmarks.media_cache [voices] [forwards]
+"""
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+PORT = 8480
+API_LATENCY = 0.05
+UPLOAD_LATENCY = 0.2
+
+
+async def send_all(main, client, voices, phase, timings):
+    from benchmarks.e2e import FakeMessage, FakeVoice
+
+    async def send(i):
+        chat_id = 1_000_000 + i * 100 + phase
+        voice = FakeVoice(i)
+        start = time.perf_counter()
+        await main.get_voice_or_audio(client, FakeMessage(client, chat_id, voice=voice))
+        timings.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(send(i) for i in range(voices)))
+
+
+async def run(voices, forwards):
+    from aiohttp import web
+
+    from benchmarks import fake_ufiles
+    from benchmarks.e2e import FakeClient, percentile
+
+    import main
+    import media_cache
+
+    client = FakeClient(API_LATENCY, None)
+    ufiles_app = fake_ufiles.create_app(UPLOAD_LATENCY)
+    runner = web.AppRunner(ufiles_app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    phases = [("new", 1), ("forwarded", forwards), ("after restart", 1)]
+    print(f"{'voices':<16}{'sends':>7}{'p50 ms':>10}{'p95 ms':>10}{'uploads':>9}")
+    phase = 0
+    for name, repeats in phases:
+        if name == "after restart":
+            media_cache.cache._entries.clear()
+        timings = []
+        uploads = ufiles_app["stats"]["uploads"]
+        for _ in range(repeats):
+            phase += 1
+            await send_all(main, client, voices, phase, timings)
+        print(
+            f"{name:<16}{len(timings):>7}"
+            f"{percentile(timings, 0.5) * 1000:>10.1f}"
+            f"{percentile(timings, 0.95) * 1000:>10.1f}"
+            f"{ufiles_app['stats']['uploads'] - uploads:>9}"
+        )
+
+    await runner.cleanup()
+    print()
+    print(media_cache.cache.generate_report())
+
+
+def main():
+    voices = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    forwards = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    workdir = tempfile.mkdtemp(prefix="nedaai-media-")
+    os.makedirs(os.path.join(workdir, "sessions"))
+    with open(os.path.join(workdir, "sessions", "models.json"), "w") as f:
+        json.dump({}, f)
+
+    os.environ.update(
+        {
+            "UFILES_URL": f"http://127.0.0.1:{PORT}/v1/f",
+            "USSO_URL": f"http://127.0.0.1:{PORT}",
+            "PTOKEN": "fake",
+        }
+    )
+    os.chdir(workdir)
+    try:
+        asyncio.run(run(voices, forwards))
+    finally:
+        os.chdir(APP_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Appending uploads to files.json vs to the media_history table.
+
+Starts both stores with `users` users of `per_user` uploads each, then times
+`appends` new uploads and reading one user's first history page. files.json
+is read and written whole on every append, the table inserts one row.
+
+Usage (from the app directory):
+    python -m benchmarks.media_history [users] [per_user] [appends]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+import db
+from migrations import migrate
+
+
+def add_to_files_json(t_id, file_url):
+    # the files.json helper main.py had before media_history
+    if os.path.exists("files.json"):
+        with open("files.json", "r") as f:
+            files = json.load(f)
+    else:
+        files = {}
+
+    if str(t_id) in files:
+        files[str(t_id)].append(file_url)
+    else:
+        files[str(t_id)] = [file_url]
+
+    with open("files.json", "w") as f:
+        json.dump(files, f, indent=4)
+
+
+def get_files_by_chat_id(chat_id):
+    with open("files.json", "r") as f:
+        files = json.load(f)
+    return files.get(str(chat_id), [])
+
+
+def url(chat_id, i):
+    return f"https://media.pixiee.io/v1/f/files/{chat_id}/{i:06d}.ogg"
+
+
+def timed(func, calls):
+    start = time.perf_counter()
+    for args in calls:
+        func(*args)
+    return (time.perf_counter() - start) / len(calls) * 1000
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    appends = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    appended = [(i % users, url(i % users, per_user)) for i in range(appends)]
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        with open("files.json", "w") as f:
+            json.dump(
+                {
+                    str(chat_id): [url(chat_id, i) for i in range(per_user)]
+                    for chat_id in range(users)
+                },
+                f,
+                indent=4,
+            )
+        size = os.path.getsize("files.json")
+
+        # the migration imports files.json like on a real upgrade
+        db.DB_NAME = os.path.join(workdir, "history.db")
+        start = time.perf_counter()
+        migrate()
+        import_time = time.perf_counter() - start
+
+        json_append = timed(add_to_files_json, appended)
+        json_read = timed(get_files_by_chat_id, [(1,)] * 20)
+        table_append = timed(
+            lambda chat_id, file_url: db.add_media_history(chat_id, file_url, 10, None),
+            [(chat_id, file_url + "-new") for chat_id, file_url in appended],
+        )
+        table_read = timed(db.get_media_history, [(1, None, 6)] * 20)
+
+    print(f"\n{users} users x {per_user} uploads, files.json {size / 1024:.0f} KB")
+    print(f"import into media_history: {import_time:.2f}s\n")
+    print(f"{'store':<16}{'append ms':>11}{'read ms':>10}")
+    print(f"{'files.json':<16}{json_append:>11.2f}{json_read:>10.2f}")
+    print(f"{'media_history':<16}{table_append:>11.2f}{table_read:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
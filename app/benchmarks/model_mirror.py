@@ -0,0 +1,163 @@
+"""
+Download time of popular model weights from their source vs from the mirror.
+
+Fills a database with generations spread over many models (a few of them
+much more used than the rest), times the popularity query, mirrors the top
+models from a fake source host limited to `source_mbps` and then downloads
+every top model once from the source and once from the webhook server, like a
+cold Replicate worker would. A second request to the mirror with the ETag
+shows what a cache in front of the worker gets.
+
+Usage (from the app directory):
+    python -m benchmarks.model_mirror [model MB] [source MB/s]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+PORT = 8380
+MODELS = 300
+GENERATIONS = 100_000
+TOP = 5
+
+
+def fill_generations(conn):
+    random.seed(1)
+    # the first models are used much more than the rest, like the real voices
+    weights = [1 / (rank + 1) for rank in range(MODELS)]
+    models = random.choices(range(MODELS), weights, k=GENERATIONS)
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO generations (chat_id, model_name, duration, created_at)
+            VALUES (?, ?, 10, datetime('now', ?))
+        """,
+            [
+                (i % 5000, f"model_{model}", f"-{i % (14 * 24)} hours")
+                for i, model in enumerate(models)
+            ],
+        )
+
+
+def create_source_app(size, mbps):
+    from aiohttp import web
+
+    content = os.urandom(size)
+    step = 64 * 1024
+
+    async def download(request):
+        response = web.StreamResponse()
+        response.content_length = size
+        await response.prepare(request)
+        for start in range(0, size, step):
+            await response.write(content[start : start + step])
+            await asyncio.sleep(step / (mbps * 1024 * 1024))
+        return response
+
+    app = web.Application()
+    app.router.add_get("/weights/{name}", download)
+    return app
+
+
+def fetch(url, etag=None):
+    import requests
+
+    headers = {"If-None-Match": etag} if etag else {}
+    start = time.perf_counter()
+    response = requests.get(url, headers=headers, timeout=600)
+    return time.perf_counter() - start, response
+
+
+async def run(size, mbps):
+    from aiohttp import web
+
+    from benchmarks import fake_replicate
+
+    import db
+    import model_mirror
+    import webhook
+    from migrations import migrate
+
+    migrate()
+    fill_generations(db.get_connection())
+
+    start = time.perf_counter()
+    popular = await model_mirror.get_popular_models(TOP, 7)
+    print(
+        f"popularity query over {GENERATIONS} generations: "
+        f"{(time.perf_counter() - start) * 1000:.1f}ms"
+    )
+    print("top models: " + ", ".join(f"{name} ({count})" for name, count in popular))
+
+    class Catalog:
+        def get(self, key):
+            return {
+                "url": f"http://127.0.0.1:{PORT + 1}/weights/{key}.zip",
+                "type": "CUSTOM",
+            }
+
+    source = web.AppRunner(create_source_app(size, mbps))
+    await source.setup()
+    await web.TCPSite(source, "127.0.0.1", PORT + 1).start()
+    server = await webhook.start_server(fake_replicate.FakeBot(), "127.0.0.1", PORT)
+
+    start = time.perf_counter()
+    await model_mirror.refresh(Catalog())
+    print(
+        f"mirrored {len(model_mirror._urls)} models in "
+        f"{time.perf_counter() - start:.1f}s\n"
+    )
+
+    print(f"{'model':<12}{'source s':>10}{'mirror s':>10}{'cached':>10}")
+    totals = [0, 0]
+    for model_name, _ in popular:
+        source_url = Catalog().get(model_name)["url"]
+        mirror_url = model_mirror.url_for(source_url)
+        source_time, _ = await asyncio.to_thread(fetch, source_url)
+        mirror_time, response = await asyncio.to_thread(fetch, mirror_url)
+        _, cached = await asyncio.to_thread(
+            fetch, mirror_url, response.headers["ETag"]
+        )
+        totals[0] += source_time
+        totals[1] += mirror_time
+        print(
+            f"{model_name:<12}{source_time:>10.2f}{mirror_time:>10.2f}"
+            f"{cached.status_code:>10}"
+        )
+
+    print(
+        f"\n{size / 1024 / 1024:.0f} MB models, source at {mbps} MB/s: "
+        f"{totals[0]:.1f}s -> {totals[1]:.1f}s of downloads"
+    )
+
+    await server.cleanup()
+    await source.cleanup()
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 50 << 20
+    mbps = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ.update(
+            {
+                "PTOKEN": "fake",
+                "MODEL_MIRROR_DIR": os.path.join(workdir, "models"),
+                "MODEL_MIRROR_TOP": str(TOP),
+                "MODEL_MIRROR_URL": f"http://127.0.0.1:{PORT}/models",
+            }
+        )
+        import db
+
+        db.DB_NAME = os.path.join(workdir, "mirror.db")
+        asyncio.run(run(size, mbps))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+A user spamming voices and callbacks, with and without the rate limits.
+
+Drives the handlers of main.py with the fake Telegram client of the e2e
+benchmark and a fake ufiles endpoint. One user sends `spam` voices and taps
+the same button `spam` times at once while `users` other users send a voice
+each. Reports the uploads the spam caused and the latency of the others.
+The repeated taps of a running callback are dropped in both rounds.
+
+Usage (from the app directory):
+    python -m benchmarks.rate_limit [users] [spam]
+"""
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+PORT = 8680
+API_LATENCY = 0.05
+UPLOAD_LATENCY = 0.2
+SPAMMER = 999_999
+
+
+async def run_round(main, client, users, spam, voice_id):
+    from benchmarks.e2e import FakeCallbackQuery, FakeMessage, FakeVoice
+
+    timings = []
+
+    async def user(chat_id):
+        start = time.perf_counter()
+        await main.get_voice_or_audio(
+            client, FakeMessage(client, chat_id, voice=FakeVoice(voice_id + chat_id))
+        )
+        timings.append(time.perf_counter() - start)
+
+    spam_voices = [
+        main.get_voice_or_audio(
+            client, FakeMessage(client, SPAMMER, voice=FakeVoice(voice_id + i))
+        )
+        for i in range(spam)
+    ]
+    spam_taps = [
+        main.callbacks(client, FakeCallbackQuery(client, SPAMMER, "gender_male"))
+        for _ in range(spam)
+    ]
+    await asyncio.gather(
+        *spam_voices, *spam_taps, *(user(1_000_000 + i) for i in range(users))
+    )
+    return timings
+
+
+async def run(users, spam):
+    from aiohttp import web
+
+    from benchmarks import fake_ufiles
+    from benchmarks.e2e import FakeClient, percentile
+
+    import main
+    import rate_limit
+
+    client = FakeClient(API_LATENCY, None)
+    ufiles_app = fake_ufiles.create_app(UPLOAD_LATENCY)
+    runner = web.AppRunner(ufiles_app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    limits = dict(rate_limit.RATE_LIMITS)
+    print(f"{'limits':<10}{'uploads':>9}{'throttled':>11}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, voice_id in (("off", 10_000_000), ("on", 20_000_000)):
+        if name == "off":
+            rate_limit.RATE_LIMITS.update({action: (1e6, 10**6) for action in limits})
+        else:
+            rate_limit.RATE_LIMITS.update(limits)
+            rate_limit._buckets.clear()
+
+        uploads = ufiles_app["stats"]["uploads"]
+        throttled = sum(rate_limit.THROTTLED.get(action) for action in limits)
+        timings = await run_round(main, client, users, spam, voice_id)
+        print(
+            f"{name:<10}{ufiles_app['stats']['uploads'] - uploads:>9}"
+            f"{sum(rate_limit.THROTTLED.get(a) for a in limits) - throttled:>11}"
+            f"{percentile(timings, 0.5) * 1000:>10.1f}"
+            f"{percentile(timings, 0.95) * 1000:>10.1f}"
+        )
+
+    await runner.cleanup()
+    print()
+    print(rate_limit.generate_report())
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    spam = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    workdir = tempfile.mkdtemp(prefix="nedaai-rate-")
+    os.makedirs(os.path.join(workdir, "sessions"))
+    with open(os.path.join(workdir, "sessions", "models.json"), "w") as f:
+        json.dump({}, f)
+
+    os.environ.update(
+        {
+            "UFILES_URL": f"http://127.0.0.1:{PORT}/v1/f",
+            "USSO_URL": f"http://127.0.0.1:{PORT}",
+            "PTOKEN": "fake",
+        }
+    )
+    os.chdir(workdir)
+    try:
+        asyncio.run(run(users, spam))
+    finally:
+        os.chdir(APP_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
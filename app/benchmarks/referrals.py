@@ -0,0 +1,129 @@
+"""
+Burst of referral sign-ups: the old /start db calls vs register_user.
+
+Every sign-up goes through the async_db facade like start_text does. A part of
+the burst replays the same invite twice at once (double taps) and a part
+invites itself. The old path runs user_exists, create_user and two updates on
+the inviter as separate transactions; register_user does it in one.
+
+Usage (from the app directory):
+    python -m benchmarks.referrals [signups] [inviters]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import async_db
+import db
+import msgs
+from migrations import migrate
+
+DUPLICATE_EVERY = 10  # every 10th sign-up is sent twice at once
+SELF_REFERRAL_EVERY = 25  # every 25th sign-up uses its own invite link
+
+
+async def old_signup(chat_id, invited_by):
+    # the db calls start_text made before register_user
+    if await async_db.user_exists(chat_id):
+        return
+    await async_db.create_user(chat_id, f"user{chat_id}")
+    if invited_by is not None:
+        await async_db.update_user_column(invited_by, "refs", 1, True)
+        await async_db.add_credits(invited_by, msgs.invitation_gift, "referral")
+
+
+async def new_signup(chat_id, invited_by):
+    await async_db.register_user(chat_id, f"user{chat_id}", invited_by)
+
+
+def make_burst(signups, inviters):
+    burst = []
+    for i in range(signups):
+        chat_id = 1_000_000 + i
+        invited_by = chat_id if i % SELF_REFERRAL_EVERY == 0 else i % inviters + 1
+        burst.append((chat_id, invited_by))
+        if i % DUPLICATE_EVERY == 0:
+            burst.append((chat_id, invited_by))
+    return burst
+
+
+async def run(signup, burst, inviters):
+    for inviter in range(1, inviters + 1):
+        await async_db.create_user(inviter, f"inviter{inviter}")
+
+    latencies = []
+    errors = 0
+
+    async def timed(chat_id, invited_by):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            await signup(chat_id, invited_by)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(chat_id, invited_by) for chat_id, invited_by in burst))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "p99": latencies[int(len(latencies) * 0.99)],
+        "errors": errors,
+    }
+
+
+def check(signups):
+    """
+    Return the referral credits paid out and the referrals rewarded, according
+    to the ledger, next to the expected values.
+    """
+    conn = db.get_connection()
+    paid = conn.execute(
+        "SELECT COALESCE(SUM(amount), 0), COUNT(*) FROM credit_transactions "
+        "WHERE kind = 'referral'"
+    ).fetchone()
+    expected_refs = signups - len(range(0, signups, SELF_REFERRAL_EVERY))
+    return paid, (expected_refs * msgs.invitation_gift, expected_refs)
+
+
+def main():
+    signups = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    inviters = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    burst = make_burst(signups, inviters)
+
+    print(f"{len(burst)} sign-ups ({signups} users) invited by {inviters} users\n")
+    print(
+        f"{'path':<16}{'total s':>9}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}"
+        f"{'credits paid':>14}{'refs':>7}"
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, signup in (("old /start", old_signup), ("register_user", new_signup)):
+            db.close_connection()
+            db.DB_NAME = os.path.join(tmp, f"{signup.__name__}.db")
+            migrate()
+            # open the connection of the database thread on the new file
+            async_db._executor.submit(db.close_connection).result()
+
+            result = asyncio.run(run(signup, burst, inviters))
+            (paid, refs), (expected_paid, expected_refs) = check(signups)
+            print(
+                f"{name:<16}{result['elapsed']:>9.2f}"
+                f"{result['p50'] * 1000:>9.1f}{result['p99'] * 1000:>9.1f}"
+                f"{result['errors']:>8}{paid:>14}{refs:>7}"
+            )
+
+        db.close_connection()
+        async_db._executor.submit(db.close_connection).result()
+
+    print(f"\nexpected: {expected_paid} credits paid, {expected_refs} refs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Benchmark the queries of db.py before and after the schema migrations.
+
+Builds a synthetic database with the pre-migration schema (no indexes,
+INTEGER replicate_id), times the per user lookups, the webhook lookup and
+the admin reports, runs migrate() and times them again, then once more with
+INCREMENTAL_STATS. No index helps the users report, it counts every user by
+credits, audio, refs and gender, INCREMENTAL_STATS is what makes it fast.
+
+Usage (from the app directory):
+    python -m benchmarks.schema [users]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+import db
+import migrations
+
+LOOKUPS = 200
+
+
+def create_legacy_database(users):
+    conn = db.get_connection()
+    conn.executescript(
+        """
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, username TEXT,
+        credits INTEGER DEFAULT 0, audio TEXT, gender TEXT, refs INTEGER DEFAULT 0,
+        model_name TEXT, duration INTEGER, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE generations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, audio TEXT,
+        model_name TEXT, duration INTEGER, replicate_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+    )
+
+    rng = random.Random(0)
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (chat_id, username, credits, audio, gender, refs) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    1_000_000_000 + i,
+                    f"user{i}",
+                    rng.randint(0, 150),
+                    f"https://example.com/{i}.ogg" if rng.random() < 0.6 else None,
+                    rng.choice(["male", "female", None]),
+                    rng.randint(0, 3) if rng.random() < 0.1 else 0,
+                )
+                for i in range(users)
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO generations (chat_id, audio, model_name, duration, replicate_id) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                (
+                    1_000_000_000 + rng.randrange(users),
+                    "audio",
+                    f"model{rng.randrange(40)}",
+                    rng.randint(3, 60),
+                    f"prediction{i}",
+                )
+                for i in range(users // 2)
+            ),
+        )
+
+
+def timed(func, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def measure(users):
+    rng = random.Random(1)
+    chat_ids = [1_000_000_000 + rng.randrange(users) for _ in range(LOOKUPS)]
+    replicate_ids = [f"prediction{rng.randrange(users // 2)}" for _ in range(LOOKUPS)]
+    conn = db.get_connection()
+
+    def lookups():
+        for chat_id in chat_ids:
+            db.user_exists(chat_id)
+            db.get_users_columns(chat_id, ["credits", "model_name", "audio"])
+
+    def webhook_lookups():
+        for replicate_id in replicate_ids:
+            conn.execute(
+                "SELECT id FROM generations WHERE replicate_id = ?", (replicate_id,)
+            ).fetchone()
+
+    return {
+        "user lookup": timed(lookups) / LOOKUPS,
+        "webhook lookup": timed(webhook_lookups) / LOOKUPS,
+        "users report": timed(db.generate_users_report),
+        "generations report": timed(db.generate_generations_report),
+    }
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, "schema.db")
+
+        start = time.perf_counter()
+        create_legacy_database(users)
+        print(f"created {users} users in {time.perf_counter() - start:.1f}s")
+        before = measure(users)
+
+        start = time.perf_counter()
+        migrations.migrate()
+        print(f"migrated in {time.perf_counter() - start:.1f}s\n")
+        after = measure(users)
+
+        start = time.perf_counter()
+        db.enable_incremental_stats()
+        print(f"enabled incremental stats in {time.perf_counter() - start:.1f}s\n")
+        incremental = measure(users)
+
+        db.close_connection()
+
+    print(
+        f"{'query':<20}{'before ms':>12}{'after ms':>12}{'speedup':>10}"
+        f"{'incremental ms':>16}{'speedup':>10}"
+    )
+    for name in before:
+        print(
+            f"{name:<20}{before[name]:>12.3f}"
+            f"{after[name]:>12.3f}{before[name] / after[name]:>9.1f}x"
+            f"{incremental[name]:>16.3f}{before[name] / incremental[name]:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Update handling throughput with 1, 2 and 4 shard workers.
+
+Every worker is a separate process owning the users whose chat_id modulo the
+number of workers is its index, like the workers of cluster.py. It drives the
+handlers of main.py (start_text, get_voice_or_audio, callbacks) with the fake
+Telegram client of the e2e benchmark for its users, all workers sharing one
+SQLite database. Each user sends /start and a voice and picks a gender, a
+voice and a pitch, 5 updates; the jobs are queued but not run.
+
+The workers start handling together once they are all ready, the throughput
+is the updates of all workers over the time until the last one is done. It
+can only grow with the workers up to the number of cores of the machine.
+
+Usage (from the app directory):
+    python -m benchmarks.shards [users] [workers ...]
+"""
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+# worker i uploads to PORT + 10 * i, ufiles strips trailing "1"s off its URL
+PORT = 8580
+API_LATENCY = 0.0
+UPLOAD_LATENCY = 0.0
+
+
+async def simulate_user(main, client, chat_id):
+    from benchmarks.e2e import MODEL_KEY, FakeCallbackQuery, FakeMessage, FakeVoice
+
+    await main.start_text(client, FakeMessage(client, chat_id, "/start"))
+    await main.get_voice_or_audio(
+        client, FakeMessage(client, chat_id, voice=FakeVoice(chat_id))
+    )
+    for data in ("gender_male", f"voice_{MODEL_KEY}", "pitch_0"):
+        await main.callbacks(client, FakeCallbackQuery(client, chat_id, data))
+    return 5
+
+
+async def run_worker(index, count, users):
+    from aiohttp import web
+
+    from benchmarks import fake_ufiles
+    from benchmarks.e2e import FakeClient
+
+    import main
+    import shards
+
+    client = FakeClient(API_LATENCY, None)
+    main.bot = client
+    runner = web.AppRunner(fake_ufiles.create_app(UPLOAD_LATENCY))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT + 10 * index).start()
+
+    chat_ids = [
+        chat_id
+        for chat_id in range(1_000_000, 1_000_000 + users)
+        if shards.shard_of(chat_id, count) == index
+    ]
+
+    # wait for the other workers
+    print("ready", flush=True)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+
+    updates = await asyncio.gather(
+        *(simulate_user(main, client, chat_id) for chat_id in chat_ids)
+    )
+    print(json.dumps({"updates": sum(updates), "finished": time.time()}), flush=True)
+    await runner.cleanup()
+
+
+def worker(index, count, users, workdir):
+    os.environ.update(
+        {
+            "SHARD_INDEX": str(index),
+            "SHARD_COUNT": str(count),
+            "UFILES_URL": f"http://127.0.0.1:{PORT + 10 * index}/v1/f",
+            "USSO_URL": f"http://127.0.0.1:{PORT + 10 * index}",
+            "PTOKEN": "fake",
+            "WEBHOOK_URL": "http://127.0.0.1/webhook/replicate",
+        }
+    )
+    os.chdir(workdir)
+    asyncio.run(run_worker(index, count, users))
+
+
+def run(count, users):
+    from benchmarks.e2e import MODEL_KEY
+
+    from migrations import migrate
+
+    import db
+
+    workdir = tempfile.mkdtemp(prefix="nedaai-shards-")
+    os.makedirs(os.path.join(workdir, "sessions"))
+    with open(os.path.join(workdir, "sessions", "models.json"), "w") as f:
+        json.dump(
+            {
+                MODEL_KEY: {
+                    "name": "Fake Voice",
+                    "category": "actor",
+                    "gender": "male",
+                    "url": "https://example.com/model.zip",
+                    "pitch": 0,
+                    "type": "CUSTOM",
+                }
+            },
+            f,
+        )
+    db.DB_NAME = os.path.join(workdir, "sessions", "nedaai.db")
+    migrate()
+
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.shards", "--worker"]
+            + [str(index), str(count), str(users), workdir],
+            cwd=APP_DIR,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for index in range(count)
+    ]
+    try:
+        for process in processes:
+            if process.stdout.readline().strip() != "ready":
+                raise RuntimeError("a worker failed to start")
+
+        start = time.time()
+        for process in processes:
+            process.stdin.write("go\n")
+            process.stdin.flush()
+        results = [json.loads(process.stdout.readline()) for process in processes]
+        for process in processes:
+            process.wait()
+    finally:
+        for process in processes:
+            process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    elapsed = max(result["finished"] for result in results) - start
+    return sum(result["updates"] for result in results), elapsed
+
+
+def main():
+    if sys.argv[1:2] == ["--worker"]:
+        index, count, users = (int(arg) for arg in sys.argv[2:5])
+        return worker(index, count, users, sys.argv[5])
+
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    counts = [int(arg) for arg in sys.argv[2:]] or [1, 2, 4]
+
+    print(f"\n{users} users, {os.cpu_count()} cores\n")
+    print(f"{'workers':<10}{'updates':>9}{'seconds':>10}{'updates/s':>11}")
+    for count in counts:
+        updates, elapsed = run(count, users)
+        print(f"{count:<10}{updates:>9}{elapsed:>10.2f}{updates / elapsed:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
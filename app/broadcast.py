@@ -0,0 +1,180 @@
+"""
+Sending a message to every user without running into Telegram's flood limits.
+
+The users are read in pages of chat_ids ordered by chat_id. Every send takes a
+token from a bucket refilled at BROADCAST_RATE messages per second, and a
+FloodWait empties the bucket for the time Telegram asks for. The position and
+the counters are saved after every page, so a broadcast interrupted by a
+restart resumes from the last saved page.
+
+The status is read from the database before every page, so a broadcast
+canceled by another shard worker stops after the page it's sending.
+"""
+import asyncio
+import logging
+import os
+
+from pyrogram.errors import (
+    FloodWait,
+    InputUserDeactivated,
+    PeerIdInvalid,
+    UserDeactivated,
+    UserDeactivatedBan,
+    UserIsBlocked,
+)
+
+import metrics
+import msgs
+from async_db import (
+    create_broadcast,
+    finish_broadcast,
+    get_broadcast,
+    get_chat_ids_after,
+    get_running_broadcasts,
+    update_broadcast_progress,
+)
+from rate_limit import TokenBucket
+
+# Messages per second, Telegram allows bots about 30
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+
+# Users read, sent to concurrently and checkpointed at once
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 100))
+
+# Times a message is retried after a FloodWait before counting it as failed
+MAX_FLOOD_RETRIES = 3
+
+# The user can't receive messages from the bot anymore
+BLOCKED_ERRORS = (
+    InputUserDeactivated,
+    PeerIdInvalid,
+    UserDeactivated,
+    UserDeactivatedBan,
+    UserIsBlocked,
+)
+
+BROADCAST_MESSAGES = metrics.Counter(
+    "nedaai_broadcast_messages_total", "Broadcast messages by result.", ["result"]
+)
+
+# broadcast_id -> running task
+_running = {}
+
+
+async def send(bot, bucket, chat_id, text):
+    """
+    Send a broadcast message to a user.
+
+    Returns:
+        str: delivered, blocked or failed.
+    """
+    for _ in range(MAX_FLOOD_RETRIES + 1):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text)
+            return "delivered"
+        except FloodWait as e:
+            logging.warning(f"broadcast flood wait of {e.value}s")
+            bucket.pause(e.value)
+        except BLOCKED_ERRORS:
+            return "blocked"
+        except Exception as e:
+            logging.error(f"Error broadcasting to {chat_id}: {str(e)}")
+            return "failed"
+    return "failed"
+
+
+async def run_broadcast(bot, broadcast):
+    """
+    Send a broadcast from its saved position and report the summary to the admin.
+    """
+    broadcast_id = broadcast["id"]
+    bucket = TokenBucket(BROADCAST_RATE)
+    last_chat_id = broadcast["last_chat_id"]
+    counts = {key: broadcast[key] for key in ("delivered", "blocked", "failed")}
+
+    while True:
+        current = await get_broadcast(broadcast_id)
+        if current is None or current["status"] != "running":
+            return
+
+        chat_ids = await get_chat_ids_after(last_chat_id, BROADCAST_BATCH_SIZE)
+        if not chat_ids:
+            break
+
+        results = await asyncio.gather(
+            *(send(bot, bucket, chat_id, broadcast["text"]) for chat_id in chat_ids)
+        )
+        for result in results:
+            counts[result] += 1
+            BROADCAST_MESSAGES.inc(result)
+
+        last_chat_id = chat_ids[-1]
+        await update_broadcast_progress(broadcast_id, last_chat_id, **counts)
+
+    if await finish_broadcast(broadcast_id, "done"):
+        await bot.send_message(msgs.admin_id, format_summary(broadcast_id, counts))
+
+
+def format_summary(broadcast_id, counts, status="done"):
+    return (
+        f"📣 Broadcast {broadcast_id} {status}\n"
+        f"✅ delivered: {counts['delivered']}\n"
+        f"🚫 blocked: {counts['blocked']}\n"
+        f"❌ failed: {counts['failed']}"
+    )
+
+
+def _start(bot, broadcast):
+    task = asyncio.create_task(run_broadcast(bot, broadcast))
+    _running[broadcast["id"]] = task
+    task.add_done_callback(lambda _: _running.pop(broadcast["id"], None))
+    task.add_done_callback(_log_error)
+
+
+def _log_error(task):
+    if not task.cancelled() and task.exception():
+        logging.error(f"Error broadcasting: {str(task.exception())}")
+
+
+async def start(bot, text):
+    """
+    Start broadcasting a text to every user.
+
+    Returns:
+        int or None: The broadcast ID, or None if another broadcast is running.
+    """
+    broadcast_id = await create_broadcast(text)
+    if broadcast_id is None:
+        return None
+
+    broadcast = await get_broadcast(broadcast_id)
+    _start(bot, broadcast)
+    return broadcast["id"]
+
+
+async def resume(bot):
+    """
+    Resume the broadcasts interrupted by a restart.
+    """
+    for broadcast in await get_running_broadcasts():
+        logging.info(
+            f"resuming broadcast {broadcast['id']} after {broadcast['last_chat_id']}"
+        )
+        _start(bot, broadcast)
+
+
+async def cancel(broadcast_id):
+    """
+    Stop a running broadcast, the worker sending it stops before its next page.
+
+    Returns:
+        dict or None: The broadcast, or None if it wasn't running.
+    """
+    if not await finish_broadcast(broadcast_id, "canceled"):
+        return None
+
+    task = _running.get(broadcast_id)
+    if task:
+        task.cancel()
+    return await get_broadcast(broadcast_id)
@@ -0,0 +1,170 @@
+"""
+In-memory catalog of the voice models listed in models.json.
+"""
+import json
+import os
+import threading
+import time
+
+import msgs
+
+MODELS_DIR = "sessions/models.json"
+
+# Seconds between two mtime checks of the models file
+CHECK_INTERVAL = 5
+
+# Order of the categories in the model list
+CATEGORY_ORDER = ["voice_actor", "character", "actor", "celebritie", "singer"]
+
+
+class ModelCatalog:
+    """
+    Keep models.json parsed in memory, indexed by model key and by category.
+
+    The file is parsed again only when it's replaced through `replace` or when
+    its mtime changes. A reload builds the new indexes aside and swaps them in
+    at once, so readers never see a half loaded catalog.
+    """
+
+    def __init__(self, file_path=MODELS_DIR, check_interval=CHECK_INTERVAL):
+        self.file_path = file_path
+        self.check_interval = check_interval
+        self.version = 0  # incremented on every successful reload
+
+        # (models, categories, model_list)
+        self._state = ({}, {}, [])
+        self._mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+        self.refresh(force=True)
+
+    def get(self, key):
+        """
+        Return the data of a model, or None if the key doesn't exist.
+        """
+        self.refresh()
+        return self._state[0].get(key)
+
+    def category(self, category):
+        """
+        Return a list of (key, model) pairs in a category.
+        """
+        self.refresh()
+        return self._state[1].get(category, [])
+
+    def model_list(self):
+        """
+        Return the models grouped by category as a button list for create_reply_markup.
+        """
+        self.refresh()
+        return self._state[2]
+
+    def refresh(self, force=False):
+        """
+        Reload the catalog if the models file has changed since the last load.
+
+        The file is checked at most once every `check_interval` seconds unless
+        `force` is True.
+        """
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+
+        try:
+            mtime = os.stat(self.file_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+
+        if mtime != self._mtime:
+            try:
+                self._load(self.file_path, mtime)
+            except (OSError, ValueError) as e:
+                print(f"Error loading models from '{self.file_path}': {e}")
+
+    def replace(self, new_file_path):
+        """
+        Validate a new models file, move it over the current one and reload.
+
+        Args:
+            new_file_path (str): Path of the uploaded models file.
+
+        Raises:
+            ValueError: If the new file isn't a valid models json. The current
+                catalog and file are kept in that case.
+        """
+        models = _read_models(new_file_path)
+        os.replace(new_file_path, self.file_path)
+        self._swap(models, os.stat(self.file_path).st_mtime_ns)
+
+    def _load(self, file_path, mtime):
+        self._swap(_read_models(file_path), mtime)
+
+    def _swap(self, models, mtime):
+        categories = {}
+        for key, model in models.items():
+            category = model.get("category", "Uncategorized")
+            categories.setdefault(category, []).append((key, model))
+
+        state = (models, categories, generate_model_list(categories))
+        with self._lock:
+            self._state = state
+            self._mtime = mtime
+            self.version += 1
+
+
+def _read_models(file_path):
+    with open(file_path, "r", encoding="utf-8") as f:
+        models = json.load(f)
+
+    if not isinstance(models, dict) or not all(
+        isinstance(model, dict) for model in models.values()
+    ):
+        raise ValueError("models json must be an object of models by key")
+
+    return models
+
+
+def generate_model_list(categories):
+    """
+    Generate a list of models grouped by categories, with category names as headers.
+
+    Args:
+        categories (dict): Lists of (key, model) pairs by category.
+
+    Returns:
+        list: A list of models grouped by categories with headers.
+    """
+    model_list = []
+    row_number = 0
+
+    # Add models by category with headers in specified order
+    for category in CATEGORY_ORDER:
+        if category not in categories:
+            continue
+
+        category_models = categories[category]
+
+        # Add category header as a regular button instead of header type
+        model_list.append(
+            [
+                msgs.category_header.format(
+                    category=msgs.categories_lable[category], count=len(category_models)
+                ),
+                "callback",
+                f"cat_{category}",
+                row_number,
+            ]
+        )
+        row_number += 1
+
+        # Add models in this category
+        for i, (key, model) in enumerate(category_models):
+            if i % 2 == 0 and i > 0:
+                row_number += 1
+            model_list.append([model["name"], "callback", f"voice_{key}", row_number])
+
+        row_number += 1  # Add extra row between categories
+
+    return model_list
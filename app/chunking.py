@@ -0,0 +1,237 @@
+"""
+Chunked conversions of long voices.
+
+With CHUNKED_CONVERSION=1 a voice longer than CHUNK_MIN_DURATION is split at
+pauses into chunks of about CHUNK_DURATION seconds, and every chunk is sent to
+Replicate as its own prediction, so they are converted in parallel. When the
+last chunk's webhook arrives the outputs are stitched back together with
+CHUNK_CROSSFADE seconds of crossfade and the result is handled like the output
+of a single prediction.
+
+The whole conversion is identified by a "chunked-..." replicate_id, used for
+the job, the credit reservation and the generation like a real prediction ID.
+"""
+import asyncio
+import io
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+
+import audio
+import rvc
+from async_db import (
+    add_chunks,
+    complete_chunk,
+    get_running_chunks,
+    set_chunk_predictions,
+)
+from uploader import upload_bytes, upload_file
+from workers import DEFAULT_TIMEOUT, run_blocking
+
+CHUNKED_CONVERSION = os.getenv("CHUNKED_CONVERSION") == "1"
+
+# Voices shorter than this (seconds) are converted in one prediction
+CHUNK_MIN_DURATION = int(os.getenv("CHUNK_MIN_DURATION", 120))
+
+# Target length of a chunk in seconds
+CHUNK_DURATION = int(os.getenv("CHUNK_DURATION", 60))
+
+# Predictions a conversion is split into at most, longer chunks are used beyond it
+MAX_CHUNKS = int(os.getenv("MAX_CHUNKS", 8))
+
+# Seconds the neighbouring chunks overlap when they are stitched
+CHUNK_CROSSFADE = float(os.getenv("CHUNK_CROSSFADE", 0.1))
+
+# Seconds each ffmpeg pass of the split may take per second of voice, on top
+# of WORKER_TIMEOUT, the remote voice is downloaded and decoded in each pass
+SPLIT_SECONDS_PER_SECOND = float(os.getenv("SPLIT_SECONDS_PER_SECOND", 0.1))
+
+# Seconds the stitch may take per second of voice, on top of WORKER_TIMEOUT,
+# the outputs of the chunks are downloaded, decoded and encoded to MP3
+STITCH_SECONDS_PER_SECOND = float(os.getenv("STITCH_SECONDS_PER_SECOND", 0.1))
+
+
+def should_chunk(duration):
+    return CHUNKED_CONVERSION and duration >= CHUNK_MIN_DURATION
+
+
+def split(source, duration, directory, timeout):
+    """
+    Split a voice at its pauses into chunks in `directory`.
+
+    Args:
+        source (str): URL of the voice.
+        duration (int): Length of the voice in seconds.
+        directory (str): Directory the chunks are written to.
+        timeout (float): Seconds each ffmpeg pass may take.
+
+    Returns:
+        list: Paths of the chunks in order.
+    """
+    chunk_duration = max(CHUNK_DURATION, duration / MAX_CHUNKS)
+    silences = audio.find_silences(source, timeout=timeout)
+    cuts = audio.choose_cuts(silences, duration, chunk_duration)
+    return audio.split_audio(source, cuts, directory, timeout=timeout)
+
+
+async def split_and_upload(source, duration, file_name):
+    """
+    Split a voice at its pauses and upload the chunks in parallel.
+
+    Args:
+        source (str): URL of the voice.
+        duration (int): Length of the voice in seconds.
+        file_name (str): Storage name prefix of the chunks.
+
+    Returns:
+        list: URLs of the chunks in order.
+    """
+    timeout = DEFAULT_TIMEOUT + duration * SPLIT_SECONDS_PER_SECOND
+    directory = tempfile.mkdtemp(prefix="chunks-")
+    try:
+        # two ffmpeg passes, each one is given the timeout
+        paths = await run_blocking(
+            split, source, duration, directory, timeout, timeout=timeout * 2, retries=0
+        )
+        return await asyncio.gather(
+            *(
+                run_blocking(upload_file, path, f"{file_name}-{index:03d}.ogg")
+                for index, path in enumerate(paths)
+            )
+        )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+async def create_predictions(chat_id, payload, parent_id, chunk_urls):
+    """
+    Create the prediction of every chunk.
+
+    If one of them can't be created, the ones that were are cancelled once
+    every call has returned, so no chunk keeps running on paid GPU time for a
+    conversion that failed. A call that timed out may still have created its
+    prediction, that one can't be cancelled.
+
+    Returns:
+        list: The prediction IDs of the chunks.
+    """
+    results = await asyncio.gather(
+        *(
+            run_blocking(
+                rvc.create_rvc_conversion,
+                chunk_url,
+                payload["model_url"],
+                chat_id,
+                pitch=payload["pitch"],
+                voice_name=payload["voice_name"],
+                rvc_model=payload["rvc_model"],
+                duration=payload["duration"],
+                parent=parent_id,
+                chunk=index,
+                retries=0,
+            )
+            for index, chunk_url in enumerate(chunk_urls)
+        ),
+        return_exceptions=True,
+    )
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if not errors:
+        return results
+
+    await cancel([result for result in results if not isinstance(result, BaseException)])
+    raise errors[0]
+
+
+async def cancel(prediction_ids):
+    """
+    Cancel chunk predictions, the errors are logged.
+    """
+    cancelled = await asyncio.gather(
+        *(run_blocking(rvc.cancel_prediction, p, retries=1) for p in prediction_ids),
+        return_exceptions=True,
+    )
+    for prediction_id, result in zip(prediction_ids, cancelled):
+        if isinstance(result, BaseException):
+            logging.error(f"Error cancelling chunk {prediction_id}: {str(result)}")
+
+
+def new_id():
+    """
+    Return a new replicate_id for a chunked conversion.
+    """
+    return f"chunked-{uuid.uuid4().hex}"
+
+
+async def submit(chat_id, payload, parent_id):
+    """
+    Create a prediction for every chunk of a voice.
+
+    Args:
+        chat_id (int): The chat_id of the user.
+        payload (dict): The job payload, see job_queue.enqueue.
+        parent_id (str): The replicate_id of the whole conversion, from new_id().
+    """
+    chunk_urls = await split_and_upload(
+        payload["audio"], payload["duration"], f"nedaai/{chat_id}/{parent_id}"
+    )
+
+    # the chunks are recorded first, their webhooks may arrive right away
+    await add_chunks(parent_id, len(chunk_urls))
+    predictions = await create_predictions(chat_id, payload, parent_id, chunk_urls)
+
+    # a chunk that failed before the others were recorded couldn't cancel them
+    if await set_chunk_predictions(parent_id, predictions):
+        await cancel(await get_running_chunks(parent_id))
+
+
+def stitch_and_upload(outputs, file_name, timeout):
+    stitched = io.BytesIO(audio.stitch(outputs, CHUNK_CROSSFADE, timeout=timeout))
+    stitched.name = os.path.basename(file_name)
+    return upload_bytes(stitched, file_name)
+
+
+async def complete(parent_id, chunk, replicate_id, status, output, t_id, duration):
+    """
+    Record the outcome of a chunk prediction.
+
+    Args:
+        parent_id (str): The replicate_id of the whole conversion.
+        chunk (int): Position of the chunk.
+        replicate_id (str): The prediction of the chunk.
+        status (str): Final status of the prediction.
+        output (str): Output URL of the prediction.
+        t_id (int): The chat_id of the user.
+        duration (float): Length of the whole voice in seconds.
+
+    Returns:
+        tuple or None: (status, output) once the whole conversion is decided,
+            output is the URL of the stitched audio. None while chunks are
+            still running or if the conversion was already decided.
+    """
+    outputs = await complete_chunk(parent_id, chunk, replicate_id, status, output)
+    if outputs is None:
+        return None
+
+    if status != "succeeded":
+        # the other chunks would be paid for a conversion that failed
+        await cancel(await get_running_chunks(parent_id))
+        return status, None
+
+    timeout = DEFAULT_TIMEOUT + duration * STITCH_SECONDS_PER_SECOND
+    try:
+        # the ffmpeg run and the upload, each one is given the timeout
+        output = await run_blocking(
+            stitch_and_upload,
+            outputs,
+            f"nedaai/{t_id}/{parent_id}.mp3",
+            timeout,
+            timeout=timeout * 2,
+            retries=0,
+        )
+    except Exception as e:
+        logging.error(f"Error stitching {parent_id}: {str(e)}")
+        return "failed", None
+
+    return "succeeded", output
@@ -0,0 +1,279 @@
+"""
+Run the bot as BOT_WORKERS shard worker processes behind one receiver.
+
+    python cluster.py
+
+This process is the only one connected to Telegram for updates. Every update
+is forwarded to the worker of its chat (see shards.py), a main.py process
+started with SHARD_INDEX and SHARD_COUNT. The workers are restarted when they
+exit, waiting longer after every crash in a row. The updates of a worker that
+is down are buffered until it's back, up to FORWARD_BUFFER of them.
+
+The public webhook port is served here too. The Replicate webhooks are passed
+to the worker of their user (the t_id of the callback URL), the other
+requests (/metrics?shard=N, /models/...) to the worker in their shard
+parameter, worker 0 by default. Worker i listens on WEBHOOK_PORT + 1 + i.
+
+The state shared by the workers is the database (db.py), SQLite in WAL mode
+by default, see db.DB_BACKEND. With BOT_WORKERS=1 this just runs main.py.
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections import deque
+
+import dotenv
+
+dotenv.load_dotenv(".env")
+
+import aiohttp
+from aiohttp import web
+from pyrogram import Client, idle
+
+import rvc
+import shards
+import webhook
+from migrations import migrate
+
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 2))
+
+# Seconds to wait before restarting a worker, doubled after every crash in a
+# row up to MAX_RESTART_BACKOFF, a worker that ran STABLE_RUN seconds resets it
+RESTART_BACKOFF = 1
+MAX_RESTART_BACKOFF = 60
+STABLE_RUN = 60
+
+# Updates kept per worker while it's unreachable, the oldest are dropped
+FORWARD_BUFFER = int(os.getenv("FORWARD_BUFFER", 10000))
+
+# Seconds between two connection attempts to a worker
+RECONNECT_INTERVAL = 0.5
+
+# Headers that only apply to one connection and aren't passed to the workers
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "host", "upgrade"}
+
+
+class WorkerProcess:
+    """
+    A shard worker process, restarted whenever it exits.
+    """
+
+    def __init__(self, index, count, command=None):
+        self.index = index
+        self.count = count
+        self.command = command or [sys.executable, "main.py"]
+        self.process = None
+        self.restarts = 0
+        self._stopping = False
+
+    async def run(self):
+        backoff = RESTART_BACKOFF
+        while not self._stopping:
+            started = time.monotonic()
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command,
+                env={
+                    **os.environ,
+                    "SHARD_INDEX": str(self.index),
+                    "SHARD_COUNT": str(self.count),
+                },
+            )
+            logging.info(f"worker {self.index} started, pid {self.process.pid}")
+            code = await self.process.wait()
+            if self._stopping:
+                return
+
+            if time.monotonic() - started > STABLE_RUN:
+                backoff = RESTART_BACKOFF
+            self.restarts += 1
+            logging.error(
+                f"worker {self.index} exited with {code}, restarting in {backoff}s"
+            )
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MAX_RESTART_BACKOFF)
+
+    async def stop(self, timeout=10):
+        """
+        Ask the worker to stop (SIGTERM) and kill it after `timeout` seconds.
+        """
+        self._stopping = True
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.process.kill()
+
+
+class ShardLink:
+    """
+    Connection to the update server of a worker.
+    """
+
+    def __init__(self, index, host=shards.SHARD_HOST, port=None):
+        self.index = index
+        self.host = host
+        self.port = port or shards.SHARD_PORT + index
+        self.sent = 0
+        self.dropped = 0
+        self._frames = deque()
+        self._ready = asyncio.Event()
+
+    def send(self, frame):
+        if len(self._frames) >= FORWARD_BUFFER:
+            self._frames.popleft()
+            self.dropped += 1
+            logging.warning(f"worker {self.index} is behind, dropped an update")
+        self._frames.append(frame)
+        self._ready.set()
+
+    async def run(self):
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError:
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+
+            try:
+                while True:
+                    # the frames left by a lost connection are sent right away
+                    if not self._frames:
+                        self._ready.clear()
+                        await self._ready.wait()
+                    while self._frames:
+                        writer.write(self._frames[0])
+                        await writer.drain()
+                        self._frames.popleft()
+                        self.sent += 1
+            except (ConnectionError, OSError) as e:
+                logging.warning(f"lost the connection to worker {self.index}: {e}")
+            finally:
+                writer.close()
+
+
+class UpdateForwarder(asyncio.Queue):
+    """
+    Replacement of the receiver's dispatcher queue that forwards the updates
+    to the workers instead of running handlers.
+
+    pyrogram puts the updates in the queue in the order they arrive, so the
+    updates of a chat reach its worker in order, without being parsed here.
+    """
+
+    def __init__(self, links):
+        super().__init__()
+        self.links = links
+
+    def put_nowait(self, packet):
+        # None stops the dispatcher's handler tasks
+        if packet is None:
+            return super().put_nowait(packet)
+
+        update, users, chats = packet
+        shard = shards.shard_of(shards.get_chat_id(update), len(self.links))
+        self.links[shard].send(shards.pack_update(update, users, chats))
+
+
+def _route_shard(request, count):
+    try:
+        if request.path == webhook.WEBHOOK_PATH:
+            return shards.shard_of(request.query.get("t_id", 0), count)
+        return min(max(int(request.query.get("shard", 0)), 0), count - 1)
+    except ValueError:
+        return 0
+
+
+async def route(request):
+    """
+    Pass a request to the webhook server of the worker it belongs to.
+    """
+    count = request.app["count"]
+    port = webhook.WEBHOOK_PORT + 1 + _route_shard(request, count)
+    url = f"http://{shards.SHARD_HOST}:{port}{request.path_qs}"
+    headers = {
+        k: v for k, v in request.headers.items() if k.lower() not in HOP_HEADERS
+    }
+
+    try:
+        async with request.app["session"].request(
+            request.method, url, headers=headers, data=await request.read()
+        ) as upstream:
+            response = web.StreamResponse(
+                status=upstream.status,
+                headers={
+                    k: v
+                    for k, v in upstream.headers.items()
+                    if k.lower() not in HOP_HEADERS
+                },
+            )
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_chunked(64 * 1024):
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+    except aiohttp.ClientError as e:
+        logging.error(f"Error passing {request.path} to {url}: {str(e)}")
+        return web.Response(status=502, text="worker unavailable")
+
+
+async def start_router(count, host=webhook.WEBHOOK_HOST, port=webhook.WEBHOOK_PORT):
+    """
+    Start the public webhook server that routes the requests to the workers.
+
+    Returns:
+        web.AppRunner: The runner, call its cleanup() to stop the server.
+    """
+    app = web.Application(client_max_size=10 * 1024 * 1024)
+    app["count"] = count
+    # the bodies are passed as they are, compressed or not
+    app["session"] = aiohttp.ClientSession(auto_decompress=False)
+    app.on_cleanup.append(lambda app: app["session"].close())
+    app.router.add_route("*", "/{path:.*}", route)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"routing {host}:{port} to {count} workers")
+    return runner
+
+
+async def main():
+    # fail here rather than restarting the workers for ever
+    rvc.check_webhook_url()
+    migrate()
+
+    links = [ShardLink(index) for index in range(BOT_WORKERS)]
+    workers = [WorkerProcess(index, BOT_WORKERS) for index in range(BOT_WORKERS)]
+    tasks = [asyncio.create_task(item.run()) for item in links + workers]
+    router = await start_router(BOT_WORKERS)
+
+    receiver = Client(
+        "sessions/nedaai",
+        api_id=os.getenv("API_ID"),
+        api_hash=os.getenv("API_HASH"),
+        bot_token=os.getenv("TOKEN"),
+        workers=1,
+    )
+    receiver.dispatcher.updates_queue = UpdateForwarder(links)
+    await receiver.start()
+    logging.info(f"receiver started with {BOT_WORKERS} workers")
+
+    await idle()
+
+    await receiver.stop()
+    await router.cleanup()
+    await asyncio.gather(*(worker.stop() for worker in workers))
+    for task in tasks:
+        task.cancel()
+
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    if BOT_WORKERS <= 1:
+        os.execv(sys.executable, [sys.executable, "main.py"])
+    asyncio.run(main())
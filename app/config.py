@@ -1,6 +1,7 @@
 import os
 
-from db import create_users_table, DB_NAME, create_generations_table
+from db import DB_NAME
+from migrations import migrate
 
 path = "sessions"
 
@@ -11,12 +12,10 @@ if not os.path.exists(path):
 else:
     print(f"{path} Directory already exists.")
 
-# Create db file if it doesn't exist
+# Create the database or bring its tables up to date
 if not os.path.exists(DB_NAME):
-    create_users_table()
     print(f"Database {DB_NAME} created.")
 else:
     print(f"{DB_NAME} Database already exists.")
 
-#Create generations table if it doesn't exist
-create_generations_table()
\ No newline at end of file
+migrate()
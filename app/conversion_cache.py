@@ -0,0 +1,144 @@
+"""
+Cache of finished conversions, so repeating the same conversion doesn't pay
+for a new Replicate prediction.
+
+Conversions are keyed by the content hash of the input audio, the model, the
+effective pitch and the RVC settings. The output URL is stored when the
+prediction's webhook reports success.
+"""
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+import rvc
+
+CACHE_SIZE = int(os.getenv("CONVERSION_CACHE_SIZE", 2000))
+
+# Replicate output URLs expire an hour after the prediction, so entries must
+# be dropped before that
+CACHE_TTL = int(os.getenv("CONVERSION_CACHE_TTL", 50 * 60))
+
+# Predictions waiting for their webhook and audio URLs with known hashes
+PENDING_SIZE = 10000
+AUDIO_HASHES_SIZE = 10000
+
+
+def hash_audio(file):
+    """
+    Return the sha256 hex digest of an audio file.
+
+    Args:
+        file (BytesIO or str): The in-memory file or its path.
+    """
+    if isinstance(file, str):
+        with open(file, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+    return hashlib.sha256(file.getbuffer()).hexdigest()
+
+
+class ConversionCache:
+    """
+    LRU cache of output URLs with a TTL per entry.
+    """
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()  # key -> (output, expires_at)
+        self._pending = OrderedDict()  # replicate_id -> key
+        self._audio_hashes = OrderedDict()  # audio url -> content hash
+
+    def remember_audio(self, audio_url, audio_hash):
+        """
+        Remember the content hash of an uploaded audio file.
+        """
+        _bounded_set(self._audio_hashes, audio_url, audio_hash, AUDIO_HASHES_SIZE)
+
+    def make_key(self, audio_url, model_name, pitch, rvc_model, model_url):
+        """
+        Return the cache key of a conversion, or None if the audio hash is unknown.
+        """
+        audio_hash = self._audio_hashes.get(audio_url)
+        if audio_hash is None:
+            return None
+
+        params = tuple(sorted(rvc.RVC_PARAMS.items()))
+        return (audio_hash, model_name, pitch, rvc_model, model_url, params)
+
+    def get(self, key):
+        """
+        Return the cached output URL of a conversion, or None on a miss.
+        """
+        entry = self._entries.get(key) if key is not None else None
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def add_pending(self, replicate_id, key):
+        """
+        Remember which conversion a submitted prediction belongs to.
+        """
+        if key is not None:
+            _bounded_set(self._pending, replicate_id, key, PENDING_SIZE)
+
+    def complete(self, replicate_id, output):
+        """
+        Store the output of a succeeded prediction.
+        """
+        key = self._pending.pop(replicate_id, None)
+        if key is None or not output:
+            return
+
+        self._entries[key] = (output, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, replicate_id):
+        """
+        Forget a prediction that didn't succeed.
+        """
+        self._pending.pop(replicate_id, None)
+
+    def generate_report(self):
+        """
+        Generate a report about the cache hit rate.
+
+        Returns:
+            str: A formatted string report about the conversion cache.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0
+
+        report_lines = [
+            "📊 **Conversion Cache Report:**\n",
+            f"📦 **Entries:** {len(self._entries)}/{self.size}, TTL {self.ttl} sec",
+            f"✅ **Hits:** {self.hits} ({hit_rate:.2f}%)",
+            f"❌ **Misses:** {self.misses}",
+            f"🗑 **Evictions:** {self.evictions}",
+            f"⏳ **Pending:** {len(self._pending)}",
+        ]
+        return "\n".join(report_lines)
+
+
+def _bounded_set(entries, key, value, size):
+    entries[key] = value
+    entries.move_to_end(key)
+    while len(entries) > size:
+        entries.popitem(last=False)
+
+
+cache = ConversionCache()
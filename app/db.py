@@ -1,13 +1,94 @@
+import json
+import os
 import sqlite3
+import threading
 
 import msgs
 
 DB_NAME = "sessions/nedaai.db"
 
+# Backend get_connection() connects with, one of BACKENDS
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite")
 
-def create_users_table():
-    # Connect to SQLite database (or create it if it doesn't exist)
-    conn = sqlite3.connect(DB_NAME)
+# Pragmas applied once to every connection opened by get_connection()
+PRAGMAS = {
+    "journal_mode": "WAL",  # readers don't block the writer and vice versa
+    "synchronous": "NORMAL",  # safe with WAL, fsync only on checkpoints
+    "cache_size": -16000,  # negative means KiB, ~16MB page cache
+    "mmap_size": 268435456,  # 256MB memory mapped reads
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,  # ms to wait for a lock before raising
+}
+
+# Number of prepared statements kept per connection by the sqlite3 module
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+
+def _connect_sqlite():
+    conn = sqlite3.connect(DB_NAME, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+
+# backend name -> function opening a new DB-API connection
+BACKENDS = {"sqlite": _connect_sqlite}
+
+
+def register_backend(name, connect):
+    """
+    Make a database backend available as DB_BACKEND.
+
+    The queries of this module are written for SQLite (qmark parameters,
+    INSERT OR IGNORE, PRAGMA user_version), the connections of another
+    backend must accept them, or translate them.
+
+    Args:
+        name (str): The value of DB_BACKEND that selects the backend.
+        connect (callable): Returns a new connection, called once per thread.
+    """
+    BACKENDS[name] = connect
+
+
+def get_connection():
+    """
+    Return the long-lived connection of the current thread, opening it on first use.
+
+    sqlite3 connections can't be shared between threads, so each thread keeps its
+    own connection for the whole lifetime of the process instead of connecting on
+    every query.
+
+    Returns:
+        sqlite3.Connection: The connection for the current thread.
+    """
+    conn = getattr(_local, "conn", None)
+
+    # DB_NAME may be changed at runtime (benchmarks), reconnect in that case
+    if conn is not None and _local.db_name == DB_NAME:
+        return conn
+
+    close_connection()
+    conn = BACKENDS[DB_BACKEND]()
+
+    _local.conn = conn
+    _local.db_name = DB_NAME
+    return conn
+
+
+def close_connection():
+    """
+    Close the connection of the current thread if it's open.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+def create_users_table(commit=True):
+    conn = get_connection()
 
     # Create a cursor object
     cursor = conn.cursor()
@@ -30,16 +111,15 @@ def create_users_table():
     """
     )
 
-    # Commit the changes and close the connection
-    conn.commit()
-    conn.close()
+    # Commit the changes, a migration commits with the schema version instead
+    if commit:
+        conn.commit()
 
     print("Users table created successfully.")
 
 
-def create_generations_table():
-    # Connect to SQLite database (or create it if it doesn't exist)
-    conn = sqlite3.connect(DB_NAME)
+def create_generations_table(commit=True):
+    conn = get_connection()
 
     # Create a cursor object
     cursor = conn.cursor()
@@ -53,56 +133,948 @@ def create_generations_table():
         audio TEXT,                            -- Input text for generation
         model_name TEXT,                            -- Model used for generation
         duration INTEGER,                      -- Duration of the generated audio
-        replicate_id INTEGER,                 -- ID of the original generation
+        replicate_id TEXT,                     -- ID of the original generation
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP -- Generation creation timestamp
     );
     """
     )
 
-    # Commit the changes and close the connection
-    conn.commit()
-    conn.close()
+    # Commit the changes
+    if commit:
+        conn.commit()
 
     print("Generations table created successfully.")
 
 
-def add_generation(chat_id, audio, model, duartion, replicate_id):
-    conn = sqlite3.connect(DB_NAME)
+def create_credit_tables(commit=True):
+    """
+    Create the credit reservations and the append-only credit transactions tables.
+
+    When the transactions table is new, every user gets an opening entry with
+    their current credits, so the sum of a user's transactions is their balance.
+    """
+    conn = get_connection()
     cursor = conn.cursor()
+
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'credit_transactions'"
+    )
+    is_new = cursor.fetchone() is None
+
     cursor.execute(
         """
-        INSERT INTO generations (chat_id, audio, model_name, duration, replicate_id) 
-        VALUES (?, ?, ?, ?, ?)
-    """,
-        (chat_id, audio, model, duartion, replicate_id),
+    CREATE TABLE IF NOT EXISTS credit_reservations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        amount INTEGER,                        -- Credits held for the generation
+        status TEXT DEFAULT 'reserved',        -- reserved, committed or refunded
+        replicate_id TEXT,                     -- Prediction the credits are held for
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """
     )
-    conn.commit()
-    conn.close()
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS credit_transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        amount INTEGER,                        -- Change of the balance, negative for debits
+        kind TEXT,                             -- opening, gift, referral, admin, reserve or refund
+        reference TEXT,                        -- Reservation ID for reserve and refund
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+    )
+
+    if is_new:
+        cursor.execute(
+            """
+            INSERT INTO credit_transactions (chat_id, amount, kind)
+            SELECT chat_id, credits, 'opening' FROM users
+            WHERE id IN (SELECT MIN(id) FROM users GROUP BY chat_id)
+        """
+        )
+
+    if commit:
+        conn.commit()
+
+    print("Credit tables created successfully.")
+
+
+def add_generation(chat_id, audio, model, duartion, replicate_id):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """
+            INSERT INTO generations (chat_id, audio, model_name, duration, replicate_id) 
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            (chat_id, audio, model, duartion, replicate_id),
+        )
+
+
+def complete_generation(replicate_id, status, output=None):
+    """
+    Record the outcome of a generation reported by the Replicate webhook.
+
+    The end-to-end latency is measured from the creation of the generation row.
+    Only pending generations are updated, so repeated webhooks are ignored.
+
+    Args:
+        replicate_id (str): The Replicate prediction ID.
+        status (str): Final status of the prediction (succeeded, failed or canceled).
+        output (str): URL of the converted audio, if any.
+
+    Returns:
+        bool or None: True if a pending generation was updated, False if it was
+            already completed, None if no generation has the replicate_id.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            """
+            UPDATE generations
+            SET status = ?, output = ?, completed_at = CURRENT_TIMESTAMP,
+                latency = (julianday('now') - julianday(created_at)) * 86400
+            WHERE replicate_id = ? AND status IS NULL
+        """,
+            (status, output, replicate_id),
+        )
+        if cursor.rowcount > 0:
+            return True
+        cursor = conn.execute(
+            "SELECT 1 FROM generations WHERE replicate_id = ?", (replicate_id,)
+        )
+        return False if cursor.fetchone() else None
 
 
 # Function to check if a user exists
 def user_exists(chat_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
+    conn = get_connection()
+    cursor = conn.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
     result = cursor.fetchone()
-    conn.close()
     return result is not None
 
 
 # Function to create a new user
 def create_user(chat_id, username=None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """
+            INSERT INTO users (chat_id, username, credits) 
+            VALUES (?, ?, ?)
+        """,
+            (chat_id, username, msgs.initial_gift),
+        )
+        _add_transaction(conn, chat_id, msgs.initial_gift, "gift")
+
+
+def register_user(chat_id, username=None, invited_by=None):
+    """
+    Create a user and reward the inviter in a single transaction.
+
+    The inviter is rewarded only if they exist, aren't the user themselves and
+    the user wasn't referred before.
+
+    Args:
+        chat_id (int): The chat_id of the new user.
+        username (str): The Telegram username of the new user.
+        invited_by (int): The chat_id from the invite link, if any.
+
+    Returns:
+        tuple: (created, inviter_credits), inviter_credits is the new balance of
+            the inviter or None if nobody was rewarded.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO users (chat_id, username, credits) VALUES (?, ?, ?)",
+            (chat_id, username, msgs.initial_gift),
+        )
+        if cursor.rowcount == 0:
+            return False, None
+        _add_transaction(conn, chat_id, msgs.initial_gift, "gift")
+
+        if invited_by is None or invited_by == chat_id:
+            return True, None
+
+        cursor = conn.execute(
+            """
+            INSERT OR IGNORE INTO referrals (chat_id, invited_by)
+            SELECT ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE chat_id = ?)
+        """,
+            (chat_id, invited_by, invited_by),
+        )
+        if cursor.rowcount == 0:
+            return True, None
+
+        conn.execute(
+            "UPDATE users SET refs = refs + 1, credits = credits + ? WHERE chat_id = ?",
+            (msgs.invitation_gift, invited_by),
+        )
+        _add_transaction(conn, invited_by, msgs.invitation_gift, "referral")
+        return True, _get_credits(conn, invited_by)
+
+
+def add_credits(chat_id, amount, kind):
+    """
+    Add credits to a user (or remove them with a negative amount) and log the transaction.
+
+    Args:
+        chat_id (int): The chat_id of the user.
+        amount (int): Credits to add.
+        kind (str): Reason of the change, e.g. referral or admin.
+
+    Returns:
+        int or None: The new balance, or None if the user doesn't exist.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            "UPDATE users SET credits = credits + ? WHERE chat_id = ?",
+            (amount, chat_id),
+        )
+        if cursor.rowcount == 0:
+            return None
+
+        _add_transaction(conn, chat_id, amount, kind)
+        return _get_credits(conn, chat_id)
+
+
+def set_credits(chat_id, amount, kind="admin"):
+    """
+    Set the credits of a user and log the difference as a transaction.
+
+    Returns:
+        bool: True if the user exists.
+    """
+    conn = get_connection()
+    with conn:
+        credits = _get_credits(conn, chat_id)
+        if credits is None:
+            return False
+
+        conn.execute(
+            "UPDATE users SET credits = ? WHERE chat_id = ?", (amount, chat_id)
+        )
+        _add_transaction(conn, chat_id, amount - credits, kind)
+        return True
+
+
+def reserve_credits(chat_id, amount):
+    """
+    Hold credits for a generation if the user has enough of them.
+
+    The balance is checked and debited in a single statement, so concurrent
+    requests can't overspend.
+
+    Args:
+        chat_id (int): The chat_id of the user.
+        amount (int): Credits to hold.
+
+    Returns:
+        tuple or None: (reservation_id, new_credits), or None if the user doesn't
+            have enough credits.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            "UPDATE users SET credits = credits - ? WHERE chat_id = ? AND credits >= ?",
+            (amount, chat_id, amount),
+        )
+        if cursor.rowcount == 0:
+            return None
+
+        cursor = conn.execute(
+            "INSERT INTO credit_reservations (chat_id, amount) VALUES (?, ?)",
+            (chat_id, amount),
+        )
+        reservation_id = cursor.lastrowid
+        _add_transaction(conn, chat_id, -amount, "reserve", reservation_id)
+        return reservation_id, _get_credits(conn, chat_id)
+
+
+def commit_reservation(replicate_id):
+    """
+    Keep the credits held for a succeeded prediction.
+
+    Returns:
+        bool: True if a held reservation was committed.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            """
+            UPDATE credit_reservations SET status = 'committed'
+            WHERE replicate_id = ? AND status = 'reserved'
+        """,
+            (replicate_id,),
+        )
+    return cursor.rowcount > 0
+
+
+def refund_reservation(reservation_id=None, replicate_id=None):
+    """
+    Give the credits held by a reservation back to the user.
+
+    Args:
+        reservation_id (int): The reservation to refund.
+        replicate_id (str): Or the prediction whose reservation to refund.
+
+    Returns:
+        bool: True if held credits were refunded.
+    """
+    conn = get_connection()
+    with conn:
+        if reservation_id is None:
+            cursor = conn.execute(
+                "SELECT id FROM credit_reservations WHERE replicate_id = ?",
+                (replicate_id,),
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return False
+            reservation_id = row[0]
+
+        return _refund(conn, reservation_id)
+
+
+def _shard_filter(column, shard):
+    """
+    Return an SQL condition and its parameters selecting the rows of a shard.
+
+    Args:
+        column (str): The chat_id column.
+        shard (tuple): (index, count) from shards.local_shard(), None for all rows.
+    """
+    if shard is None:
+        return "", ()
+    index, count = shard
+    return f"AND abs({column}) % ? = ?", (count, index)
+
+
+def expire_reservations(max_age, shard=None):
+    """
+    Refund the reservations still held after `max_age` seconds.
+
+    The age of reservations paying for a queued job is counted from the start
+    of the job, waiting in the queue doesn't expire them.
+
+    Args:
+        max_age (int): Seconds a reservation may be held.
+        shard (tuple): Only refund the users of this (index, count) shard.
+
+    Returns:
+        list: The chat_ids of the refunded users.
+    """
+    shard_filter, shard_params = _shard_filter("r.chat_id", shard)
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            f"""
+            SELECT r.id, r.chat_id FROM credit_reservations r
+            LEFT JOIN jobs j ON j.reservation_id = r.id
+            WHERE r.status = 'reserved'
+              AND COALESCE(j.status, '') != 'queued'
+              AND COALESCE(j.started_at, r.created_at) < datetime('now', ?)
+              {shard_filter}
+        """,
+            (f"-{int(max_age)} seconds", *shard_params),
+        )
+        return [
+            chat_id
+            for reservation_id, chat_id in cursor.fetchall()
+            if _refund(conn, reservation_id)
+        ]
+
+
+def enqueue_job(chat_id, reservation_id, payload):
+    """
+    Add a conversion job to the queue.
+
+    Users who have ever bought credits (admin credit transactions) get a
+    higher priority.
+
+    Args:
+        chat_id (int): The chat_id of the user.
+        reservation_id (int): The credit reservation paying for the job.
+        payload (dict): Arguments of the conversion, stored as JSON.
+
+    Returns:
+        int: The job ID.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            """
+            INSERT INTO jobs (chat_id, priority, payload, reservation_id)
+            VALUES (?, EXISTS (
+                SELECT 1 FROM credit_transactions
+                WHERE chat_id = ? AND kind = 'admin' AND amount > 0
+            ), ?, ?)
+        """,
+            (chat_id, chat_id, json.dumps(payload), reservation_id),
+        )
+    return cursor.lastrowid
+
+
+# Queued jobs in the order they run: by priority, then round robin between
+# users (every user's first job before anyone's second), then by age
+_QUEUED_JOBS = """
+    SELECT id, chat_id, priority, payload, reservation_id,
+           ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS user_rank
+    FROM jobs WHERE status = 'queued'
+"""
+
+
+def claim_jobs(limit, per_user_limit, shard=None):
+    """
+    Mark the next queued jobs as running and return them.
+
+    Users never have more than `per_user_limit` running jobs and there are
+    never more than `limit` running jobs in total. The jobs are counted and
+    claimed in one write transaction, so schedulers in several processes
+    don't claim the same jobs or go over the limit together.
+
+    Args:
+        limit (int): Maximum number of running jobs.
+        per_user_limit (int): Maximum running jobs per user.
+        shard (tuple): Only claim the jobs of this (index, count) shard.
+
+    Returns:
+        list: Dictionaries with the id, chat_id, payload and reservation_id of the jobs.
+    """
+    shard_filter, shard_params = _shard_filter("q.chat_id", shard)
+    conn = get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        free = limit - count_running_jobs()
+        if free <= 0:
+            return []
+
+        cursor = conn.execute(
+            f"""
+            WITH queued AS ({_QUEUED_JOBS}),
+            running AS (
+                SELECT chat_id, COUNT(*) AS count FROM jobs
+                WHERE status = 'running' GROUP BY chat_id
+            )
+            SELECT q.id, q.chat_id, q.payload, q.reservation_id
+            FROM queued q LEFT JOIN running r ON r.chat_id = q.chat_id
+            WHERE COALESCE(r.count, 0) + q.user_rank <= ? {shard_filter}
+            ORDER BY q.priority DESC, q.user_rank, q.id
+            LIMIT ?
+        """,
+            (per_user_limit, *shard_params, free),
+        )
+        jobs = [
+            {
+                "id": job_id,
+                "chat_id": chat_id,
+                "payload": json.loads(payload),
+                "reservation_id": reservation_id,
+            }
+            for job_id, chat_id, payload, reservation_id in cursor.fetchall()
+        ]
+        conn.executemany(
+            "UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP WHERE id = ?",
+            [(job["id"],) for job in jobs],
+        )
+    return jobs
+
+
+def start_job(job_id, reservation_id, chat_id, replicate_id, audio, model, duration):
+    """
+    Record the prediction created for a running job.
+
+    The job, the reservation paying for it and the generation are written in
+    one transaction, the webhook of the prediction finds all of them or none.
+
+    Args:
+        job_id (int): The running job.
+        reservation_id (int): The reservation of the job, linked to the prediction.
+        chat_id (int): The chat_id of the user.
+        replicate_id (str): The Replicate prediction ID.
+        audio (str): URL of the input audio.
+        model (str): Name of the voice model.
+        duration (int): Length of the audio in seconds.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "UPDATE jobs SET replicate_id = ? WHERE id = ?", (replicate_id, job_id)
+        )
+        conn.execute(
+            "UPDATE credit_reservations SET replicate_id = ? WHERE id = ?",
+            (replicate_id, reservation_id),
+        )
+        conn.execute(
+            """
+            INSERT INTO generations (chat_id, audio, model_name, duration, replicate_id)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            (chat_id, audio, model, duration, replicate_id),
+        )
+
+
+def finish_job(status, job_id=None, replicate_id=None):
+    """
+    Mark a running job as finished, by job ID or by its prediction.
+
+    Args:
+        status (str): succeeded, failed or canceled.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """
+            UPDATE jobs SET status = ?, finished_at = CURRENT_TIMESTAMP
+            WHERE (id = ? OR replicate_id = ?) AND status = 'running'
+        """,
+            (status, job_id, replicate_id),
+        )
+
+
+def expire_jobs(max_age):
+    """
+    Fail the jobs running for more than `max_age` seconds without a webhook.
+
+    Returns:
+        int: The number of expired jobs.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            """
+            UPDATE jobs SET status = 'failed', finished_at = CURRENT_TIMESTAMP
+            WHERE status = 'running' AND started_at < datetime('now', ?)
+        """,
+            (f"-{int(max_age)} seconds",),
+        )
+    return cursor.rowcount
+
+
+def get_queue_position(job_id):
+    """
+    Return the number of jobs that run before a queued job, or None if it's not queued.
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        f"""
+        WITH queued AS ({_QUEUED_JOBS})
+        SELECT COUNT(q.id) FROM queued me LEFT JOIN queued q
+        ON q.priority > me.priority
+           OR (q.priority = me.priority AND q.user_rank < me.user_rank)
+           OR (q.priority = me.priority AND q.user_rank = me.user_rank AND q.id < me.id)
+        WHERE me.id = ?
+        GROUP BY me.id
+    """,
+        (job_id,),
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def add_chunks(parent_id, count):
+    """
+    Record the chunks of a chunked conversion before their predictions are created.
+    """
+    conn = get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO chunks (parent_id, idx) VALUES (?, ?)",
+            [(parent_id, idx) for idx in range(count)],
+        )
+
+
+def complete_chunk(parent_id, idx, replicate_id, status, output=None):
+    """
+    Record the outcome of a chunk prediction.
+
+    The conversion is decided by the first failed chunk, or by the last chunk
+    when all of them succeeded. Only the call that decides it gets the chunks.
+
+    Returns:
+        list or None: The outputs of the chunks in order (None for the
+            unfinished ones), or None if the conversion isn't decided by this call.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            """
+            UPDATE chunks SET replicate_id = ?, status = ?, output = ?
+            WHERE parent_id = ? AND idx = ? AND status IS NULL
+        """,
+            (replicate_id, status, output, parent_id, idx),
+        )
+        if cursor.rowcount == 0:
+            return None
+
+        pending, failed = conn.execute(
+            """
+            SELECT SUM(status IS NULL), SUM(status != 'succeeded')
+            FROM chunks WHERE parent_id = ?
+        """,
+            (parent_id,),
+        ).fetchone()
+        if status == "succeeded" and (pending or failed):
+            return None
+        if status != "succeeded" and failed > 1:
+            return None
+
+        cursor = conn.execute(
+            "SELECT output FROM chunks WHERE parent_id = ? ORDER BY idx", (parent_id,)
+        )
+        return [output for (output,) in cursor.fetchall()]
+
+
+def set_chunk_predictions(parent_id, replicate_ids):
+    """
+    Record the predictions of the chunks whose webhook didn't arrive yet.
+
+    Returns:
+        bool: True if a chunk already failed, the conversion is decided.
+    """
+    conn = get_connection()
+    with conn:
+        conn.executemany(
+            """
+            UPDATE chunks SET replicate_id = ?
+            WHERE parent_id = ? AND idx = ? AND replicate_id IS NULL
+        """,
+            [
+                (replicate_id, parent_id, idx)
+                for idx, replicate_id in enumerate(replicate_ids)
+            ],
+        )
+        cursor = conn.execute(
+            """
+            SELECT 1 FROM chunks
+            WHERE parent_id = ? AND status IS NOT NULL AND status != 'succeeded'
+        """,
+            (parent_id,),
+        )
+        return cursor.fetchone() is not None
+
+
+def get_running_chunks(parent_id):
+    """
+    Return the predictions of the chunks of a conversion that didn't finish.
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        """
+        SELECT replicate_id FROM chunks
+        WHERE parent_id = ? AND status IS NULL AND replicate_id IS NOT NULL
+    """,
+        (parent_id,),
+    )
+    return [replicate_id for (replicate_id,) in cursor.fetchall()]
+
+
+def count_running_jobs():
+    conn = get_connection()
+    cursor = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'")
+    return cursor.fetchone()[0]
+
+
+def count_jobs():
+    """
+    Return the number of queued and running jobs.
+
+    Returns:
+        dict: {"queued": int, "running": int}
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        """
+        SELECT status, COUNT(*) FROM jobs
+        WHERE status IN ('queued', 'running') GROUP BY status
+    """
+    )
+    counts = {"queued": 0, "running": 0}
+    counts.update(cursor.fetchall())
+    return counts
+
+
+def get_average_latency(last=50):
+    """
+    Return the average end-to-end latency of the last finished generations, or None.
+    """
+    conn = get_connection()
+    cursor = conn.execute(
         """
-        INSERT INTO users (chat_id, username, credits) 
-        VALUES (?, ?, ?)
+        SELECT AVG(latency) FROM (
+            SELECT latency FROM generations WHERE latency IS NOT NULL
+            ORDER BY id DESC LIMIT ?
+        )
     """,
-        (chat_id, username, msgs.initial_gift),
+        (last,),
+    )
+    return cursor.fetchone()[0]
+
+
+def get_popular_models(limit, days):
+    """
+    Return the most used models of the last days.
+
+    Returns:
+        list: (model_name, generations) pairs, the most used first.
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        """
+        SELECT model_name, COUNT(*) FROM generations
+        WHERE created_at >= datetime('now', ?) AND model_name IS NOT NULL
+        GROUP BY model_name ORDER BY COUNT(*) DESC LIMIT ?
+    """,
+        (f"-{days} days", limit),
+    )
+    return cursor.fetchall()
+
+
+def get_model_mirrors():
+    """
+    Return the mirrored model files.
+
+    Returns:
+        dict: {source_url: {"model_name", "file_name", "size", "mirrored_at"}}
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        "SELECT source_url, model_name, file_name, size, mirrored_at FROM model_mirrors"
+    )
+    return {
+        row[0]: {
+            "model_name": row[1],
+            "file_name": row[2],
+            "size": row[3],
+            "mirrored_at": row[4],
+        }
+        for row in cursor.fetchall()
+    }
+
+
+def add_model_mirror(source_url, model_name, file_name, size):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO model_mirrors (source_url, model_name, file_name, size)
+            VALUES (?, ?, ?, ?)
+        """,
+            (source_url, model_name, file_name, size),
+        )
+
+
+def remove_model_mirror(source_url):
+    conn = get_connection()
+    with conn:
+        conn.execute("DELETE FROM model_mirrors WHERE source_url = ?", (source_url,))
+
+
+def get_media_upload(file_unique_id, processing, max_age):
+    """
+    Return the upload of a Telegram file, or None if it wasn't uploaded in the
+    last `max_age` days.
+
+    Returns:
+        dict or None: {"url", "duration", "audio_hash", "size", "created_at"},
+            created_at is a Unix timestamp.
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        """
+        SELECT url, duration, audio_hash, size, CAST(strftime('%s', created_at) AS INTEGER)
+        FROM media_uploads
+        WHERE file_unique_id = ? AND processing = ? AND created_at >= datetime('now', ?)
+    """,
+        (file_unique_id, processing, f"-{max_age} days"),
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return {
+        "url": row[0],
+        "duration": row[1],
+        "audio_hash": row[2],
+        "size": row[3],
+        "created_at": row[4],
+    }
+
+
+def add_media_upload(file_unique_id, processing, url, duration, audio_hash, size):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO media_uploads
+                (file_unique_id, processing, url, duration, audio_hash, size)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """,
+            (file_unique_id, processing, url, duration, audio_hash, size),
+        )
+
+
+def add_media_history(chat_id, url, duration, audio_hash):
+    """
+    Add an uploaded voice to the history of a user, it's kept once per URL.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO media_history (chat_id, url, duration, audio_hash)
+            VALUES (?, ?, ?, ?)
+        """,
+            (chat_id, url, duration, audio_hash),
+        )
+
+
+def get_media_history(chat_id, before_id=None, limit=10):
+    """
+    Return a page of the history of a user, the newest first.
+
+    Args:
+        chat_id (int): The chat_id of the user.
+        before_id (int): Return the items older than this one, None for the first page.
+        limit (int): Number of items to return.
+
+    Returns:
+        list: Dicts with id, url, duration, audio_hash and created_at.
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        """
+        SELECT id, url, duration, audio_hash, created_at FROM media_history
+        WHERE chat_id = ? AND id < ? ORDER BY id DESC LIMIT ?
+    """,
+        (chat_id, before_id if before_id is not None else 2**63 - 1, limit),
+    )
+    return _dict_rows(cursor)
+
+
+def get_media_history_item(chat_id, item_id):
+    """
+    Return an item of the history of a user, or None if it isn't theirs.
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        """
+        SELECT id, url, duration, audio_hash, created_at FROM media_history
+        WHERE id = ? AND chat_id = ?
+    """,
+        (item_id, chat_id),
+    )
+    rows = _dict_rows(cursor)
+    return rows[0] if rows else None
+
+
+def set_media_history_duration(item_id, duration):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "UPDATE media_history SET duration = ? WHERE id = ?", (duration, item_id)
+        )
+
+
+def add_shard_event(kind, value):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO shard_events (kind, value) VALUES (?, ?)", (kind, str(value))
+        )
+
+
+def get_shard_events(after_id):
+    """
+    Return the events published after `after_id`, oldest first.
+
+    Returns:
+        list: (id, kind, value) tuples.
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        "SELECT id, kind, value FROM shard_events WHERE id > ? ORDER BY id",
+        (after_id,),
+    )
+    return cursor.fetchall()
+
+
+def get_last_shard_event_id():
+    conn = get_connection()
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM shard_events").fetchone()[0]
+
+
+def get_last_shard_event(kind):
+    """
+    Return the value of the latest event of a kind, or None.
+    """
+    conn = get_connection()
+    row = conn.execute(
+        "SELECT value FROM shard_events WHERE kind = ? ORDER BY id DESC LIMIT 1",
+        (kind,),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def delete_shard_events(max_age, keep_kinds=()):
+    """
+    Delete the events older than `max_age` seconds, except the latest one of
+    each of `keep_kinds`.
+    """
+    conn = get_connection()
+    placeholders = ", ".join("?" * len(keep_kinds))
+    with conn:
+        conn.execute(
+            f"""
+            DELETE FROM shard_events
+            WHERE created_at < datetime('now', ?)
+            AND id NOT IN (
+                SELECT MAX(id) FROM shard_events
+                WHERE kind IN ({placeholders}) GROUP BY kind
+            )
+        """,
+            (f"-{int(max_age)} seconds", *keep_kinds),
+        )
+
+
+def _refund(conn, reservation_id):
+    cursor = conn.execute(
+        """
+        UPDATE credit_reservations SET status = 'refunded'
+        WHERE id = ? AND status = 'reserved'
+        RETURNING chat_id, amount
+    """,
+        (reservation_id,),
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return False
+
+    chat_id, amount = row
+    conn.execute(
+        "UPDATE users SET credits = credits + ? WHERE chat_id = ?", (amount, chat_id)
+    )
+    _add_transaction(conn, chat_id, amount, "refund", reservation_id)
+    return True
+
+
+def _get_credits(conn, chat_id):
+    cursor = conn.execute("SELECT credits FROM users WHERE chat_id = ?", (chat_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _add_transaction(conn, chat_id, amount, kind, reference=None):
+    conn.execute(
+        """
+        INSERT INTO credit_transactions (chat_id, amount, kind, reference)
+        VALUES (?, ?, ?, ?)
+    """,
+        (chat_id, amount, kind, reference),
     )
-    conn.commit()
-    conn.close()
 
 
 def update_user_column(chat_id, column, value, increment=False):
@@ -115,8 +1087,7 @@ def update_user_column(chat_id, column, value, increment=False):
         value: The value to set or increment the column by.
         increment (bool): If True, increments the column value; otherwise, sets it.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    conn = get_connection()
 
     if increment:
         # Increment the column value
@@ -125,9 +1096,8 @@ def update_user_column(chat_id, column, value, increment=False):
         # Set the column value
         query = f"UPDATE users SET {column} = ? WHERE chat_id = ?"
 
-    cursor.execute(query, (value, chat_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute(query, (value, chat_id))
 
 
 def get_users_columns(chat_id, columns):
@@ -141,7 +1111,7 @@ def get_users_columns(chat_id, columns):
     Returns:
         dict or None: A dictionary of column-value pairs if the user exists, otherwise None.
     """
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Ensure columns is a list to handle both single and multiple columns
@@ -165,15 +1135,142 @@ def get_users_columns(chat_id, columns):
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return None
-    finally:
-        conn.close()
 
 
-def add_gender_column_to_users():
+def get_user(chat_id):
+    """
+    Retrieve the whole row of a user from the 'users' table.
+
+    Returns:
+        dict or None: A dictionary of all the columns if the user exists, otherwise None.
+    """
+    conn = get_connection()
+    cursor = conn.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
+    result = cursor.fetchone()
+    if result is None:
+        return None
+
+    return dict(zip([column[0] for column in cursor.description], result))
+
+
+def update_user_columns(chat_id, values):
+    """
+    Set several columns of a user in a single statement.
+
+    Args:
+        chat_id (int): The chat_id of the user to update.
+        values (dict): New values by column name.
+    """
+    assignments = ", ".join(f"{column} = ?" for column in values)
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            f"UPDATE users SET {assignments} WHERE chat_id = ?",
+            (*values.values(), chat_id),
+        )
+
+
+def create_broadcast(text):
+    """
+    Create a broadcast of a text message to every user.
+
+    Returns:
+        int or None: The broadcast ID, or None if another broadcast is running.
+    """
+    conn = get_connection()
+    with conn:
+        # one statement, two shard workers can't both start a broadcast
+        cursor = conn.execute(
+            """
+            INSERT INTO broadcasts (text)
+            SELECT ? WHERE NOT EXISTS (
+                SELECT 1 FROM broadcasts WHERE status = 'running'
+            )
+            """,
+            (text,),
+        )
+        return cursor.lastrowid if cursor.rowcount else None
+
+
+def _dict_rows(cursor):
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def get_broadcast(broadcast_id):
+    """
+    Return a broadcast as a dictionary, or None if it doesn't exist.
+    """
+    conn = get_connection()
+    cursor = conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+    rows = _dict_rows(cursor)
+    return rows[0] if rows else None
+
+
+def get_running_broadcasts():
+    """
+    Return the broadcasts that were started and not finished or canceled.
+    """
+    conn = get_connection()
+    cursor = conn.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+    return _dict_rows(cursor)
+
+
+def get_chat_ids_after(chat_id, limit):
+    """
+    Return the next `limit` user chat_ids greater than `chat_id`, in order.
+
+    Walking the users with the last chat_id as a cursor reads them in pages
+    off the chat_id index, so the position can be saved and resumed.
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        "SELECT chat_id FROM users WHERE chat_id > ? ORDER BY chat_id LIMIT ?",
+        (chat_id, limit),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def update_broadcast_progress(broadcast_id, last_chat_id, delivered, blocked, failed):
+    """
+    Save the position and the counters of a running broadcast.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """
+            UPDATE broadcasts
+            SET last_chat_id = ?, delivered = ?, blocked = ?, failed = ?
+            WHERE id = ?
+        """,
+            (last_chat_id, delivered, blocked, failed, broadcast_id),
+        )
+
+
+def finish_broadcast(broadcast_id, status):
+    """
+    Mark a running broadcast as done or canceled.
+
+    Returns:
+        bool: True if the broadcast was running.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            """
+            UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'running'
+        """,
+            (status, broadcast_id),
+        )
+        return cursor.rowcount > 0
+
+
+def add_gender_column_to_users(commit=True):
     """
     Add a 'gender' column to the 'users' table if it doesn't already exist.
     """
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Check if the 'gender' column already exists
@@ -182,85 +1279,259 @@ def add_gender_column_to_users():
     if "gender" not in columns:
         # Add the 'gender' column
         cursor.execute("ALTER TABLE users ADD COLUMN gender TEXT")
-        conn.commit()
+        if commit:
+            conn.commit()
         print("Gender column added to users table.")
     else:
         print("Gender column already exists in users table.")
 
-    conn.close()
 
-
-def generate_users_report():
+def add_status_columns_to_generations(commit=True):
     """
-    Generate a report about the users in the 'users' table.
-
-    Returns:
-        str: A formatted string report about the users.
+    Add the completion columns to the 'generations' table if they don't already exist.
     """
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
 
-    try:
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
+    cursor.execute("PRAGMA table_info(generations)")
+    columns = [column[1] for column in cursor.fetchall()]
+    new_columns = {
+        "status": "TEXT",  # succeeded, failed or canceled, NULL while processing
+        "output": "TEXT",  # URL of the converted audio
+        "completed_at": "TIMESTAMP",
+        "latency": "REAL",  # seconds from creation to completion
+    }
+    for column, column_type in new_columns.items():
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE generations ADD COLUMN {column} {column_type}")
+            print(f"{column} column added to generations table.")
+
+    if commit:
+        conn.commit()
 
-        if total_users == 0:
-            return "No users found in the database."
 
-        cursor.execute("SELECT COUNT(*) FROM users WHERE credits = 120")
-        credits_120 = cursor.fetchone()[0]
+# Counters of the users report, `{t}` is replaced with the row prefix
+# (NEW. or OLD.) in the stats triggers
+USERS_STATS = {
+    "total_users": "1",
+    "credits_120": "{t}credits = 120",
+    "credits_120_100": "{t}credits <= 120 AND {t}credits > 100",
+    "credits_100_50": "{t}credits <= 100 AND {t}credits > 50",
+    "credits_50_25": "{t}credits <= 50 AND {t}credits > 25",
+    "credits_25_0": "{t}credits <= 25 AND {t}credits >= 0",
+    "audio_not_none": "{t}audio IS NOT NULL",
+    "refs_greater_than_0": "{t}refs > 0",
+    "male_users": "{t}gender = 'male'",
+    "female_users": "{t}gender = 'female'",
+}
 
-        cursor.execute(
-            "SELECT COUNT(*) FROM users WHERE credits <= 120 AND credits > 100"
-        )
-        credits_120_100 = cursor.fetchone()[0]
 
-        cursor.execute(
-            "SELECT COUNT(*) FROM users WHERE credits <= 100 AND credits > 50"
+def _count_cases(prefix=""):
+    return [
+        f"CASE WHEN {condition.format(t=prefix)} THEN 1 ELSE 0 END"
+        for condition in USERS_STATS.values()
+    ]
+
+
+def enable_incremental_stats():
+    """
+    Keep the report counters in stats tables that triggers update on every change.
+
+    The stats are filled from the current data the first time, after that
+    the reports read a single row instead of scanning the tables. The tables,
+    the backfill and the triggers are created in one transaction, so no write
+    of another process is missed in between.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        columns = ", ".join(f"{name} INTEGER DEFAULT 0" for name in USERS_STATS)
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS users_stats (id INTEGER PRIMARY KEY, {columns})"
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS generations_stats (
+                id INTEGER PRIMARY KEY,
+                total_generations INTEGER DEFAULT 0,
+                total_duration INTEGER DEFAULT 0,
+                unique_users INTEGER DEFAULT 0
+            )
+        """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS model_stats (
+                model_name TEXT PRIMARY KEY,  -- '' for the generations without one
+                count INTEGER DEFAULT 0,
+                duration INTEGER DEFAULT 0
+            )
+        """
         )
-        credits_100_50 = cursor.fetchone()[0]
 
-        cursor.execute(
-            "SELECT COUNT(*) FROM users WHERE credits <= 50 AND credits > 25"
+        # fill the stats from the current data once, triggers keep them up to date
+        if conn.execute("SELECT 1 FROM users_stats").fetchone() is None:
+            sums = ", ".join(f"COALESCE(SUM({case}), 0)" for case in _count_cases())
+            conn.execute(
+                f"INSERT INTO users_stats VALUES (1, {', '.join(['?'] * len(USERS_STATS))})",
+                conn.execute(f"SELECT {sums} FROM users").fetchone(),
+            )
+            conn.execute(
+                """
+                INSERT INTO generations_stats
+                SELECT 1, COUNT(*), COALESCE(SUM(duration), 0), COUNT(DISTINCT chat_id)
+                FROM generations
+            """
+            )
+            conn.execute(
+                """
+                INSERT INTO model_stats
+                SELECT COALESCE(model_name, ''), COUNT(*), COALESCE(SUM(duration), 0)
+                FROM generations GROUP BY COALESCE(model_name, '')
+            """
+            )
+
+        # NULL never conflicts on the primary key, older triggers added a row
+        # per generation without a model, merge them into the '' row
+        conn.execute(
+            """
+            INSERT INTO model_stats (model_name, count, duration)
+            SELECT '', SUM(count), SUM(duration) FROM model_stats
+            WHERE model_name IS NULL HAVING COUNT(*) > 0
+            ON CONFLICT (model_name) DO UPDATE SET
+                count = count + excluded.count, duration = duration + excluded.duration
+        """
         )
-        credits_50_25 = cursor.fetchone()[0]
+        conn.execute("DELETE FROM model_stats WHERE model_name IS NULL")
 
-        cursor.execute(
-            "SELECT COUNT(*) FROM users WHERE credits <= 25 AND credits >= 0"
+        def users_delta(sign, prefix):
+            return ", ".join(
+                f"{name} = {name} {sign} {case}"
+                for name, case in zip(USERS_STATS, _count_cases(prefix))
+            )
+
+        updates = ", ".join(
+            f"{name} = {name} + {new} - {old}"
+            for name, new, old in zip(
+                USERS_STATS, _count_cases("NEW."), _count_cases("OLD.")
+            )
         )
-        credits_25_0 = cursor.fetchone()[0]
+        # executescript() would commit the backfill before the triggers exist,
+        # and the triggers are recreated in case an older version made them
+        triggers = {
+            "users_stats_insert": f"""
+            CREATE TRIGGER users_stats_insert AFTER INSERT ON users
+            BEGIN
+                UPDATE users_stats SET {users_delta("+", "NEW.")} WHERE id = 1;
+            END
+        """,
+            "users_stats_update": f"""
+            CREATE TRIGGER users_stats_update
+            AFTER UPDATE OF credits, audio, refs, gender ON users
+            BEGIN
+                UPDATE users_stats SET {updates} WHERE id = 1;
+            END
+        """,
+            "users_stats_delete": f"""
+            CREATE TRIGGER users_stats_delete AFTER DELETE ON users
+            BEGIN
+                UPDATE users_stats SET {users_delta("-", "OLD.")} WHERE id = 1;
+            END
+        """,
+            "generations_stats_insert": """
+            CREATE TRIGGER generations_stats_insert AFTER INSERT ON generations
+            BEGIN
+                UPDATE generations_stats SET
+                    total_generations = total_generations + 1,
+                    total_duration = total_duration + COALESCE(NEW.duration, 0),
+                    unique_users = unique_users + (
+                        SELECT COUNT(*) = 1 FROM generations WHERE chat_id = NEW.chat_id
+                    )
+                WHERE id = 1;
+                INSERT INTO model_stats (model_name, count, duration)
+                VALUES (COALESCE(NEW.model_name, ''), 1, COALESCE(NEW.duration, 0))
+                ON CONFLICT (model_name) DO UPDATE SET
+                    count = count + 1, duration = duration + excluded.duration;
+            END
+        """,
+        }
+        for name, trigger in triggers.items():
+            conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+            conn.execute(trigger)
+
+    print("Incremental stats enabled.")
+
+
+def disable_incremental_stats():
+    """
+    Drop the stats tables and triggers, the reports scan the tables again.
+    """
+    conn = get_connection()
+    conn.executescript(
+        """
+        DROP TRIGGER IF EXISTS users_stats_insert;
+        DROP TRIGGER IF EXISTS users_stats_update;
+        DROP TRIGGER IF EXISTS users_stats_delete;
+        DROP TRIGGER IF EXISTS generations_stats_insert;
+        DROP TABLE IF EXISTS users_stats;
+        DROP TABLE IF EXISTS generations_stats;
+        DROP TABLE IF EXISTS model_stats;
+    """
+    )
+
+
+def _stats_enabled(cursor):
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_stats'"
+    )
+    return cursor.fetchone() is not None
 
-        cursor.execute("SELECT COUNT(*) FROM users WHERE audio IS NOT NULL")
-        audio_not_none = cursor.fetchone()[0]
 
-        cursor.execute("SELECT COUNT(*) FROM users WHERE refs > 0")
-        refs_greater_than_0 = cursor.fetchone()[0]
+def generate_users_report():
+    """
+    Generate a report about the users in the 'users' table.
 
-        cursor.execute("SELECT COUNT(*) FROM users WHERE gender = 'male'")
-        male_users = cursor.fetchone()[0]
+    The counters are read from the stats table when incremental stats are
+    enabled, otherwise they are computed in a single pass over the table.
 
-        cursor.execute("SELECT COUNT(*) FROM users WHERE gender = 'female'")
-        female_users = cursor.fetchone()[0]
+    Returns:
+        str: A formatted string report about the users.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    try:
+        if _stats_enabled(cursor):
+            cursor.execute(f"SELECT {', '.join(USERS_STATS)} FROM users_stats")
+        else:
+            sums = ", ".join(f"COALESCE(SUM({case}), 0)" for case in _count_cases())
+            cursor.execute(f"SELECT {sums} FROM users")
+        stats = dict(zip(USERS_STATS, cursor.fetchone()))
+
+        total_users = stats["total_users"]
+        if total_users == 0:
+            return "No users found in the database."
+
+        def line(label, name):
+            return f"{label} {stats[name]} ({stats[name] / total_users * 100:.2f}%)"
 
         report_lines = [
             "📊 **Users Report:**\n",
             f"👥 **Total:** {total_users}\n",
-            f"💳 **Credits = 120:** {credits_120} ({credits_120 / total_users * 100:.2f}%)",
-            f"💳 **Credits 120-100:** {credits_120_100} ({credits_120_100 / total_users * 100:.2f}%)",
-            f"💳 **Credits 100-50:** {credits_100_50} ({credits_100_50 / total_users * 100:.2f}%)",
-            f"💳 **Credits 50-25:** {credits_50_25} ({credits_50_25 / total_users * 100:.2f}%)",
-            f"💳 **Credits 25-0:** {credits_25_0} ({credits_25_0 / total_users * 100:.2f}%)\n",
-            f"🎧 **Audio not none:** {audio_not_none} ({audio_not_none / total_users * 100:.2f}%)\n",
-            f"🔗 **Refs > 0:** {refs_greater_than_0} ({refs_greater_than_0 / total_users * 100:.2f}%)\n",
-            f"♂️ **Male:** {male_users} ({male_users / total_users * 100:.2f}%)",
-            f"♀️ **Female:** {female_users} ({female_users / total_users * 100:.2f}%)",
+            line("💳 **Credits = 120:**", "credits_120"),
+            line("💳 **Credits 120-100:**", "credits_120_100"),
+            line("💳 **Credits 100-50:**", "credits_100_50"),
+            line("💳 **Credits 50-25:**", "credits_50_25"),
+            line("💳 **Credits 25-0:**", "credits_25_0") + "\n",
+            line("🎧 **Audio not none:**", "audio_not_none") + "\n",
+            line("🔗 **Refs > 0:**", "refs_greater_than_0") + "\n",
+            line("♂️ **Male:**", "male_users"),
+            line("♀️ **Female:**", "female_users"),
         ]
 
         return "\n".join(report_lines)
     except sqlite3.Error as e:
         return f"Database error: {e}"
-    finally:
-        conn.close()
 
 
 def generate_generations_report():
@@ -270,29 +1541,34 @@ def generate_generations_report():
     Returns:
         str: A formatted string report about the generations.
     """
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
 
     try:
-        cursor.execute("SELECT COUNT(*) FROM generations")
-        total_generations = cursor.fetchone()[0]
+        if _stats_enabled(cursor):
+            cursor.execute(
+                "SELECT NULLIF(model_name, ''), count, duration FROM model_stats "
+                "ORDER BY count DESC"
+            )
+            model_stats = cursor.fetchall()
+            cursor.execute("SELECT unique_users FROM generations_stats")
+            unique_users = cursor.fetchone()[0]
+        else:
+            # totals are summed from the per model rows instead of separate scans
+            cursor.execute(
+                "SELECT model_name, COUNT(*), SUM(duration) FROM generations GROUP BY model_name ORDER BY COUNT(*) DESC"
+            )
+            model_stats = cursor.fetchall()
+            cursor.execute("SELECT COUNT(DISTINCT chat_id) FROM generations")
+            unique_users = cursor.fetchone()[0]
 
+        total_generations = sum(count for _, count, _ in model_stats)
         if total_generations == 0:
             return "No generations found."
 
-        cursor.execute("SELECT SUM(duration) FROM generations")
-        total_duration = cursor.fetchone()[0] or 0
-
-        cursor.execute("SELECT COUNT(DISTINCT chat_id) FROM generations")
-        unique_users = cursor.fetchone()[0]
-
+        total_duration = sum(duration or 0 for _, _, duration in model_stats)
         average_duration_per_user = total_duration / unique_users if unique_users else 0
 
-        cursor.execute(
-            "SELECT model_name, COUNT(*), SUM(duration) FROM generations GROUP BY model_name ORDER BY COUNT(*) DESC"
-        )
-        model_stats = cursor.fetchall()
-
         report_lines = [
             "📊 **Generations Report:**\n",
             f"🔢 **Total:** {total_generations}",
@@ -311,5 +1587,3 @@ def generate_generations_report():
         return "\n".join(report_lines)
     except sqlite3.Error as e:
         return f"Database error: {e}"
-    finally:
-        conn.close()
@@ -0,0 +1,201 @@
+"""
+Scheduler of the RVC conversion jobs.
+
+Conversions are queued in the jobs table instead of going straight to
+Replicate. The scheduler submits them while there are fewer than
+QUEUE_GLOBAL_LIMIT predictions in flight and QUEUE_USER_LIMIT per user.
+Queued jobs are ordered by priority (paid users first), then round robin
+between users. A job stays running until its webhook arrives.
+"""
+import asyncio
+import logging
+import math
+import os
+
+import chunking
+import metrics
+import model_mirror
+import msgs
+import rvc
+import shards
+from async_db import (
+    claim_jobs,
+    complete_generation,
+    count_jobs,
+    count_running_jobs,
+    enqueue_job,
+    finish_job,
+    get_average_latency,
+    get_queue_position,
+    refund_reservation,
+    start_job,
+)
+from conversion_cache import cache as conversion_cache
+from user_cache import cache as user_cache
+from workers import run_blocking
+
+QUEUE_GLOBAL_LIMIT = int(os.getenv("QUEUE_GLOBAL_LIMIT", 10))
+QUEUE_USER_LIMIT = int(os.getenv("QUEUE_USER_LIMIT", 1))
+
+# Seconds between two scheduling rounds when nothing wakes the scheduler up
+POLL_INTERVAL = 5
+
+# Seconds a job takes when there are no finished generations to measure
+DEFAULT_JOB_TIME = 60
+
+_wakeup = asyncio.Event()
+
+# Conversion cache keys of the jobs started by this process
+_cache_keys = {}
+
+_tasks = set()
+
+
+def notify():
+    """
+    Wake the scheduler up, after a job was queued or finished.
+    """
+    _wakeup.set()
+
+
+async def enqueue(chat_id, reservation_id, payload, cache_key=None):
+    """
+    Queue a conversion and return the job ID.
+
+    Args:
+        chat_id (int): The chat_id of the user.
+        reservation_id (int): The credit reservation paying for the conversion.
+        payload (dict): Arguments of the conversion: audio, model_url, pitch,
+            voice_name, rvc_model, duration and model_name.
+        cache_key (tuple): The conversion cache key of the conversion.
+    """
+    job_id = await enqueue_job(chat_id, reservation_id, payload)
+    if cache_key is not None:
+        _cache_keys[job_id] = cache_key
+    notify()
+    return job_id
+
+
+async def get_position(job_id):
+    """
+    Return the queue position of a job and its estimated wait in seconds.
+
+    Returns:
+        tuple or None: (position, eta), or None if the job isn't queued anymore.
+    """
+    ahead = await get_queue_position(job_id)
+    if ahead is None:
+        return None
+
+    job_time = await get_average_latency() or DEFAULT_JOB_TIME
+    eta = math.ceil((ahead + 1) / QUEUE_GLOBAL_LIMIT) * job_time
+    return ahead + 1, int(eta)
+
+
+async def job_finished(replicate_id, status):
+    await finish_job(status, replicate_id=replicate_id)
+    notify()
+
+
+async def collect_metrics():
+    for status, count in (await count_jobs()).items():
+        metrics.JOBS.set(count, status)
+
+
+metrics.add_collector(collect_metrics)
+
+
+async def run_scheduler(bot):
+    """
+    Submit queued jobs whenever there is room for them, runs until cancelled.
+    """
+    while True:
+        _wakeup.clear()
+        try:
+            await schedule(bot)
+        except Exception as e:
+            logging.error(f"Error scheduling jobs: {str(e)}")
+
+        try:
+            await asyncio.wait_for(_wakeup.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def schedule(bot):
+    if await count_running_jobs() >= QUEUE_GLOBAL_LIMIT:
+        return
+
+    # each worker submits the jobs of its own users, see shards.py
+    for job in await claim_jobs(
+        QUEUE_GLOBAL_LIMIT, QUEUE_USER_LIMIT, shards.local_shard()
+    ):
+        task = asyncio.create_task(submit(bot, job))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+
+async def submit(bot, job):
+    job_id = job["id"]
+    chat_id = job["chat_id"]
+    # the mirror is looked up now, it may have changed while the job was queued
+    payload = {
+        **job["payload"],
+        "model_url": model_mirror.url_for(job["payload"]["model_url"]),
+    }
+
+    async def start(prediction):
+        await start_job(
+            job_id,
+            job["reservation_id"],
+            chat_id,
+            prediction,
+            payload["audio"],
+            payload["model_name"],
+            payload["duration"],
+        )
+
+    # create rvc conversion to replicate, not retried since a timed out
+    # request may still have created the prediction
+    chunked = chunking.should_chunk(payload["duration"])
+    prediction = chunking.new_id() if chunked else None
+    try:
+        if chunked:
+            # recorded before the chunks are created, their webhooks may
+            # complete the conversion before chunking.submit returns
+            conversion_cache.add_pending(prediction, _cache_keys.pop(job_id, None))
+            await start(prediction)
+            await chunking.submit(chat_id, payload, prediction)
+        else:
+            prediction = await run_blocking(
+                rvc.create_rvc_conversion,
+                payload["audio"],
+                payload["model_url"],
+                chat_id,
+                pitch=payload["pitch"],
+                voice_name=payload["voice_name"],
+                rvc_model=payload["rvc_model"],
+                duration=payload["duration"],
+                retries=0,
+            )
+    except Exception as e:
+        _cache_keys.pop(job_id, None)
+        if chunked:
+            conversion_cache.discard(prediction)
+            await complete_generation(prediction, "failed")
+        await finish_job("failed", job_id=job_id)
+        await refund_reservation(job["reservation_id"])
+        user_cache.invalidate(chat_id)
+        notify()
+
+        logging.error(f"Error submitting job {job_id}: {str(e)}")
+        await bot.send_message(
+            chat_id, msgs.conversion_failed.format(admin=msgs.admin_username)
+        )
+        await bot.send_message(msgs.admin_id, f"Error submitting job: {str(e)}")
+        return
+
+    if not chunked:
+        # before any other await, the webhook may already be on its way
+        conversion_cache.add_pending(prediction, _cache_keys.pop(job_id, None))
+        await start(prediction)
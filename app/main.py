@@ -1,12 +1,16 @@
-import json
+import asyncio
+import io
 import logging
+import math
 import os
+import time
 
 import dotenv
 
 dotenv.load_dotenv(".env")
 
-from pyrogram import Client, enums, filters
+from pyrogram import Client, enums, filters, idle
+from pyrogram.errors import FloodWait
 from pyrogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -14,57 +18,174 @@ from pyrogram.types import (
     ReplyKeyboardMarkup,
 )
 
+import broadcast
+import job_queue
+import metrics
+import model_mirror
 import msgs
+import rate_limit
 import rvc
-from db import (
-    create_user,
-    create_users_table,
+import shards
+import webhook
+from async_db import (
+    add_credits,
+    add_media_history,
+    expire_jobs,
+    expire_reservations,
+    generate_generations_report,
+    generate_users_report,
+    get_media_history,
+    get_media_history_item,
+    get_running_broadcasts,
     get_users_columns,
-    update_user_column,
+    register_user,
+    reserve_credits,
+    set_credits,
+    set_media_history_duration,
     user_exists,
+)
+from audio import (
+    AUDIO_PREPROCESS,
+    MAX_AUDIO_DURATION,
+    MIN_AUDIO_DURATION,
+    preprocess,
+    probe_duration,
+    processing_id,
+)
+from catalog import MODELS_DIR, ModelCatalog
+from conversion_cache import cache as conversion_cache
+from conversion_cache import hash_audio
+from db import (
+    create_users_table,
     DB_NAME,
-    create_generations_table,
-    add_generation,
-    add_gender_column_to_users,
-    generate_users_report,
-    generate_generations_report,
+    disable_incremental_stats,
+    enable_incremental_stats,
 )
-from uploader import upload_file
+from media_cache import cache as media_cache
+from migrations import migrate
+from uploader import upload_bytes, upload_file
+from user_cache import cache as user_cache
+from workers import generate_pool_report, run_blocking
 
 links = msgs.channels_list
-MODELS_DIR = "sessions/models.json"
 
+# Voices up to this size (bytes) are kept in memory, bigger ones spill to disk
+MAX_IN_MEMORY_SIZE = int(os.getenv("MAX_IN_MEMORY_SIZE", 20 * 1024 * 1024))
+
+# Earlier voices listed per page of /history
+HISTORY_PAGE_SIZE = 5
+
+# Seconds to remember channel membership checks, members rarely leave so
+# positive results are kept much longer than negative ones
+JOINED_TTL = int(os.getenv("JOINED_TTL", 6 * 60 * 60))
+NOT_JOINED_TTL = int(os.getenv("NOT_JOINED_TTL", 30))
+MEMBERSHIP_CACHE_SIZE = 50000
+
+# Seconds after which credits held for a prediction without a webhook are refunded
+RESERVATION_TIMEOUT = int(os.getenv("RESERVATION_TIMEOUT", 30 * 60))
+
+# (user_id, channel) -> (joined, expires_at)
+_membership_cache = {}
+
+# Keep references to the running notification tasks so they aren't garbage collected
+_tasks = set()
+
+# a shard worker gets its updates from cluster.py instead of Telegram
 bot = Client(
-    "sessions/nedaai",
+    shards.session_name("sessions/nedaai"),
     api_id=os.getenv("API_ID"),
     api_hash=os.getenv("API_HASH"),
     bot_token=os.getenv("TOKEN"),
+    no_updates=shards.is_sharded(),
 )
 
-# initialize the tables
-create_users_table()
-create_generations_table()
-add_gender_column_to_users()
+# create or upgrade the tables
+migrate()
 
+# keep the /report counters up to date with triggers instead of scanning the tables
+if os.getenv("INCREMENTAL_STATS") == "1":
+    enable_incremental_stats()
+else:
+    disable_incremental_stats()
 
-async def is_joined(app, user_id):
-    not_joined = []
-    for channel in links:
-        try:
-            await app.get_chat_member(channel, user_id)
-        except:
-            not_joined.append(channel)
-    return not_joined
+catalog = ModelCatalog(MODELS_DIR)
+
+
+def set_banner_image(banner_img_id):
+    msgs.banner_img_id = banner_img_id
+
+
+shards.subscribe("invalidate_user", user_cache.invalidate)
+shards.subscribe("banner_img_id", set_banner_image, keep=True)
+
+# reply markup of the model list and the catalog version it was built from
+_model_list_markup = {"version": None, "markup": None}
+
+
+async def is_joined(app, user_id, recheck_not_joined=False):
+    """
+    Return the channels of `links` the user hasn't joined.
+
+    The channels are checked concurrently and the results are cached per user
+    and channel.
+
+    Args:
+        app (Client): The pyrogram client.
+        user_id (int): The user to check.
+        recheck_not_joined (bool): Ignore cached negative results, used when the
+            user says they just joined.
+    """
+    results = await asyncio.gather(
+        *(
+            is_channel_member(app, channel, user_id, recheck_not_joined)
+            for channel in links
+        )
+    )
+    return [channel for channel, joined in zip(links, results) if not joined]
+
+
+async def is_channel_member(app, channel, user_id, recheck_not_joined=False):
+    key = (user_id, channel)
+    now = time.monotonic()
+
+    cached = _membership_cache.get(key)
+    if cached and cached[1] > now and (cached[0] or not recheck_not_joined):
+        return cached[0]
+
+    try:
+        await metrics.track_call(
+            "get_chat_member", app.get_chat_member(channel, user_id)
+        )
+        joined = True
+    except FloodWait:
+        # throttled: keep the last known answer, expired or not, and let the
+        # unknown users through uncached, they couldn't do anything about a "no"
+        return cached[0] if cached else True
+    except Exception:
+        joined = False
+
+    if len(_membership_cache) >= MEMBERSHIP_CACHE_SIZE:
+        for expired in [k for k, v in _membership_cache.items() if v[1] <= now]:
+            del _membership_cache[expired]
+        if len(_membership_cache) >= MEMBERSHIP_CACHE_SIZE:
+            _membership_cache.clear()
+
+    _membership_cache[key] = (joined, now + (JOINED_TTL if joined else NOT_JOINED_TTL))
+    return joined
 
 
 @bot.on_message(filters.user(msgs.admin_id) & filters.document)
+@shards.ordered
+@metrics.track_handler
 async def handle_file(client, message):
     chat_id = message.chat.id
     logging.basicConfig(level=logging.INFO)
     print(message.document)
 
     try:
-        file = await message.download(f"./{MODELS_DIR}")
+        # download next to the current file and swap it in only if it's valid
+        file = await message.download(f"./{MODELS_DIR}.upload")
+        catalog.replace(file)
         await message.reply(file)
         await message.reply("Json saved successfully")
         logging.basicConfig(level=logging.INFO)
@@ -74,6 +195,8 @@ async def handle_file(client, message):
 
 
 @bot.on_message(filters.user(msgs.admin_id) & (filters.reply))
+@shards.ordered
+@metrics.track_handler
 async def handle_reply(client, message):
     chat_id = message.chat.id
     reply = message.reply_to_message
@@ -91,20 +214,59 @@ async def handle_reply(client, message):
 
 
 @bot.on_message(filters.user(msgs.admin_id) & filters.forwarded)
+@shards.ordered
+@metrics.track_handler
 async def handle_forward(client, message):
     await message.reply(message.forward_from.id)
 
 
 @bot.on_message(filters.user(msgs.admin_id) & filters.regex("/admin"))
+@shards.ordered
+@metrics.track_handler
 async def amdin(client, message):
     message.chat.id
     text = message.text
     message.from_user.mention
 
-    if ("/get_credits ") in text:
+    if text.startswith("/admin/broadcast_status"):
+        broadcasts = await get_running_broadcasts()
+        for running in broadcasts:
+            await message.reply(
+                broadcast.format_summary(running["id"], running, "running")
+            )
+        if not broadcasts:
+            await message.reply("No broadcast is running")
+
+    elif text.startswith("/admin/broadcast_cancel"):
+        argument = text[len("/admin/broadcast_cancel") :].strip()
+        if not argument.isdigit():
+            await message.reply("usage: /admin/broadcast_cancel <broadcast_id>")
+            return
+        broadcast_id = int(argument)
+        canceled = await broadcast.cancel(broadcast_id)
+        if canceled:
+            await message.reply(
+                broadcast.format_summary(broadcast_id, canceled, "canceled")
+            )
+        else:
+            await message.reply(f"broadcast {broadcast_id} is not running")
+
+    elif text.startswith("/admin/broadcast"):
+        broadcast_text = text[len("/admin/broadcast") :].strip()
+        if not broadcast_text:
+            await message.reply("usage: /admin/broadcast <text>")
+            return
+
+        broadcast_id = await broadcast.start(client, broadcast_text)
+        if broadcast_id is None:
+            await message.reply("Another broadcast is running")
+        else:
+            await message.reply(f"broadcast {broadcast_id} started")
+
+    elif ("/get_credits ") in text:
         user_id = text.replace("/admin/get_credits ", "")
-        if user_exists(user_id):
-            user_data = get_users_columns(user_id, "credits")
+        if await user_exists(user_id):
+            user_data = await get_users_columns(user_id, "credits")
             print(user_data)
             credits = user_data["credits"]
             await message.reply(credits)
@@ -124,7 +286,8 @@ async def amdin(client, message):
 
     elif ("set_banner_image") in text:
         banner_img_id = text.replace("/admin/set_banner_image", "")
-        msgs.banner_img_id = banner_img_id
+        # the invite handlers of every shard worker send the banner
+        await shards.publish("banner_img_id", banner_img_id)
 
         await message.reply(msgs.banner_img_id)
         # await client.send_photo(msgs.admin_id, int(banner_img_id))
@@ -132,12 +295,12 @@ async def amdin(client, message):
     elif ("/add_credits") in text:
         text = text.replace("/admin/add_credits", "").split(" ")
         user_chat_id = text[1]
-        amount = text[2]
-
-        if user_exists(user_chat_id):
-            update_user_column(user_chat_id, "credits", amount, increment=True)
-            new_credits = get_users_columns(user_chat_id, "credits")["credits"]
+        amount = int(text[2])
 
+        new_credits = await add_credits(user_chat_id, amount, "admin")
+        # the user may be cached by another shard worker
+        await shards.publish("invalidate_user", user_chat_id)
+        if new_credits is not None:
             await message.reply(
                 f"added {amount} credits to {user_chat_id} user credits updated"
             )
@@ -151,12 +314,10 @@ async def amdin(client, message):
     elif ("/set_credits") in text:
         text = text.replace("/admin/set_credits", "").split(" ")
         user_chat_id = text[1]
-        amount = text[2]
-
-        if user_exists(user_chat_id):
-            update_user_column(user_chat_id, "credits", amount, increment=False)
-            new_credits = get_users_columns(user_chat_id, "credits")["credits"]
+        amount = int(text[2])
 
+        if await set_credits(user_chat_id, amount):
+            await shards.publish("invalidate_user", user_chat_id)
             await message.reply(
                 f"set {amount} credits to {user_chat_id} user credits updated"
             )
@@ -165,40 +326,47 @@ async def amdin(client, message):
             await message.reply(f"user {user_chat_id} does not exist")
 
     elif ("/report") in text:
-        users_report = generate_users_report()
-        gens_report = generate_generations_report()
+        users_report = await generate_users_report()
+        gens_report = await generate_generations_report()
 
         await message.reply(users_report)
         await message.reply(gens_report)
+        await message.reply(generate_pool_report())
+        await message.reply(conversion_cache.generate_report())
+        await message.reply(media_cache.generate_report())
+        await message.reply(model_mirror.generate_report())
+        await message.reply(rate_limit.generate_report())
+
+    elif ("/metrics") in text:
+        await metrics.collect()
+        await message.reply(metrics.generate_report())
 
 
 @bot.on_message((filters.regex("/start") | filters.regex("/Start")) & filters.private)
+@rate_limit.limit("command")
+@shards.ordered
+@metrics.track_handler
 async def start_text(client, message):
     not_joined_channels = await is_joined(bot, message.from_user.id)
     chat_id = message.chat.id
     message.from_user.mention
     username = message.from_user.username
 
-    # check if user exists
-    if not user_exists(chat_id):
-        create_user(chat_id, username)
-        await message.reply(msgs.gift_msg.format(inital_credits=msgs.initial_gift))
-
-        # Check if user is invited, if yes add reward credits to inviter
-        if len(message.text.split(" ")) == 2:
-            invited_by = message.text.split(" ")[1]
-            update_user_column(invited_by, "refs", 1, True)
+    # Check if user is invited, the inviter is rewarded when the user is new
+    invited_by = None
+    args = message.text.split(" ")
+    if len(args) == 2 and args[1].isdigit():
+        invited_by = int(args[1])
 
-            await client.send_message(
-                invited_by,
-                msgs.invite_successfully.format(
-                    user=username,
-                    gift_credits=msgs.invitation_gift,
-                    admin=msgs.admin_username,
-                ),
-            )
+    created, inviter_credits = await register_user(chat_id, username, invited_by)
+    if created:
+        await message.reply(msgs.gift_msg.format(inital_credits=msgs.initial_gift))
 
-            update_user_column(invited_by, "credits", msgs.invitation_gift, True)
+    if inviter_credits is not None:
+        await shards.publish("invalidate_user", invited_by)
+        task = asyncio.create_task(notify_inviter(client, invited_by, username))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
 
     # Check if user has joined required channels
     if not_joined_channels:
@@ -210,39 +378,152 @@ async def start_text(client, message):
         await message.reply(msgs.start.format(username=username))
 
 
+async def notify_inviter(client, invited_by, username):
+    try:
+        await client.send_message(
+            invited_by,
+            msgs.invite_successfully.format(
+                user=username,
+                gift_credits=msgs.invitation_gift,
+                admin=msgs.admin_username,
+            ),
+        )
+    except Exception as e:
+        # the inviter may have blocked the bot, the credits are theirs anyway
+        logging.warning(f"Error notifying inviter {invited_by}: {str(e)}")
+
+
 @bot.on_message(filters.private & (filters.voice | filters.audio))
+@rate_limit.limit("voice")
+@shards.ordered
+@metrics.track_handler
 async def get_voice_or_audio(client, message):
     t_id = message.chat.id
     media = message.voice or message.audio
-    duration = media.duration
 
     try:
         if media and not message.from_user.is_bot:
-            # save file
-            file_id = media.file_id
-            file = await client.download_media(
-                file_id, file_name=f"files/{t_id}/voice.ogg"
+            # a forwarded or resent voice was already uploaded, reuse it
+            upload = await media_cache.get(
+                media.file_unique_id, processing_id(), media.file_size
             )
+            if upload:
+                conversion_cache.remember_audio(upload["url"], upload["audio_hash"])
+                if AUDIO_PREPROCESS and media.duration > MAX_AUDIO_DURATION:
+                    await message.reply(
+                        msgs.voice_too_long.format(max_duration=MAX_AUDIO_DURATION)
+                    )
+            else:
+                upload = await upload_voice(client, message, media)
+                if upload is None:
+                    return
 
-            # upload file to pixiee
-            file_url = upload_file(file, f"nedaai/{t_id}/{file_id}.ogg")
+            await add_media_history(
+                t_id, upload["url"], upload["duration"], upload["audio_hash"]
+            )
+            await select_audio(t_id, message, upload["url"], upload["duration"])
 
-            # add the audio to database
-            update_user_column(t_id, "audio", file_url)
+    except Exception as e:
+        logging.basicConfig(level=logging.INFO)
+        await client.send_message(msgs.admin_id, f"Error: {str(e)}")
 
-            # add the audio duration to database
-            update_user_column(t_id, "duration", duration)
 
-            # ask user the gender
-            buttons = create_reply_markup(msgs.gender_btns)
-            await message.reply(msgs.gender_select, reply_markup=buttons)
+async def upload_voice(client, message, media):
+    """
+    Download a voice, preprocess and upload it and remember the upload.
+
+    Returns:
+        dict or None: The upload as stored in the media cache, None if the
+            voice is silent.
+    """
+    t_id = message.chat.id
+    file_id = media.file_id
+    file_name = f"nedaai/{t_id}/{file_id}.ogg"
+    duration = media.duration
+
+    # download to memory and upload to pixiee straight from there, too
+    # big files go through a temp file that is removed after
+    in_memory = (media.file_size or 0) <= MAX_IN_MEMORY_SIZE
+    if in_memory:
+        file = await client.download_media(file_id, in_memory=True)
+    else:
+        file = await client.download_media(
+            file_id, file_name=f"files/{t_id}/voice.ogg"
+        )
+
+    try:
+        if in_memory:
+            audio_hash = hash_audio(file)
+        else:
+            audio_hash = await run_blocking(hash_audio, file, retries=0)
+
+        upload = file
+        if AUDIO_PREPROCESS:
+            upload, duration = await preprocess_voice(file, duration)
+            if duration < MIN_AUDIO_DURATION:
+                await message.reply(msgs.voice_silent)
+                return None
+            if media.duration > MAX_AUDIO_DURATION:
+                await message.reply(
+                    msgs.voice_too_long.format(max_duration=MAX_AUDIO_DURATION)
+                )
+
+        if isinstance(upload, str):
+            size = os.path.getsize(upload)
+            file_url = await run_blocking(upload_file, upload, file_name)
+        else:
+            size = upload.getbuffer().nbytes
+            file_url = await run_blocking(upload_bytes, upload, file_name)
+        conversion_cache.remember_audio(file_url, audio_hash)
+    finally:
+        if not in_memory:
+            os.remove(file)
+
+    # the original is uploaded when preprocessing failed
+    processing = processing_id() if upload is not file else ""
+    await media_cache.add(
+        media.file_unique_id, processing, file_url, duration, audio_hash, size
+    )
+    return {"url": file_url, "duration": duration, "audio_hash": audio_hash}
+
+
+async def select_audio(chat_id, message, audio_url, duration):
+    # add the audio and its duration to database
+    await user_cache.update(chat_id, audio=audio_url, duration=duration)
+
+    # ask user the gender
+    buttons = create_reply_markup(msgs.gender_btns)
+    await message.reply(msgs.gender_select, reply_markup=buttons)
+
+
+async def preprocess_voice(file, duration):
+    """
+    Trim, normalize and resample a voice, the original is kept if ffmpeg fails.
+
+    Args:
+        file (BytesIO or str): The downloaded voice or its path.
+        duration (int): The duration reported by Telegram.
 
+    Returns:
+        tuple: (file, duration), the processed voice as a BytesIO and its
+            duration rounded up to seconds, or the original file and duration.
+    """
+    audio = file if isinstance(file, str) else file.getvalue()
+    try:
+        data, processed_duration = await run_blocking(preprocess, audio, retries=0)
     except Exception as e:
-        logging.basicConfig(level=logging.INFO)
-        await client.send_message(msgs.admin_id, f"Error: {str(e)}")
+        logging.warning(f"Error preprocessing voice: {str(e)}")
+        return file, duration
+
+    processed = io.BytesIO(data)
+    processed.name = "voice.ogg"
+    return processed, math.ceil(processed_duration)
 
 
 @bot.on_callback_query()
+@rate_limit.limit("callback")
+@shards.ordered
+@metrics.track_handler
 async def callbacks(client, callback_query):
     try:
         message = callback_query.message
@@ -252,22 +533,35 @@ async def callbacks(client, callback_query):
         return_to_menu = create_reply_markup([msgs.return_to_menu_button])
         username = callback_query.from_user.mention
 
+        # stop the loading of the button now, not after the work is done
         if data.startswith("cat_"):
-            await callback_query.answer(msgs.select_category)
+            answer_callback(callback_query, msgs.select_category)
             return
+        answer_callback(callback_query)
 
         await message.delete()
 
+        # next page of the history
+        if data.startswith("history_page_"):
+            before_id = int(data.replace("history_page_", ""))
+            await send_history(message, chat_id, before_id)
+
+        # picked an earlier voice from the history
+        elif data.startswith("history_"):
+            await select_history_item(
+                chat_id, message, int(data.replace("history_", ""))
+            )
+
         # selected the voice models
-        if data.startswith("voice_"):
+        elif data.startswith("voice_"):
             model_name = data.replace("voice_", "")
-            update_user_column(chat_id, "model_name", model_name)
+            await user_cache.update(chat_id, model_name=model_name)
 
             # check the gender of input and selected voice
-            model_data = get_value_from_json(MODELS_DIR, model_name)
+            model_data = catalog.get(model_name)
             model_gender = model_data["gender"]
 
-            user_data = get_users_columns(chat_id, "gender")
+            user_data = await user_cache.get(chat_id, "gender")
             user_gender = user_data["gender"]
 
             # same gender for user input and selected model
@@ -292,17 +586,17 @@ async def callbacks(client, callback_query):
         # selected the gender
         elif data.startswith("gender_"):
             gender = data.replace("gender_", "")
-            update_user_column(chat_id, "gender", gender)
+            await user_cache.update(chat_id, gender=gender)
 
             # generate the available models as buttons from models.json
-            buttons = create_reply_markup(generate_model_list(MODELS_DIR))
+            buttons = get_model_list_markup()
             await message.reply(
                 msgs.voice_select, reply_markup=buttons, parse_mode=enums.ParseMode.HTML
             )
 
         elif data == "invite":
             # Get user's current refs count
-            user_data = get_users_columns(chat_id, ["refs", "credits"])
+            user_data = await user_cache.get(chat_id, ["refs", "credits"])
             if user_data is None:
                 return
 
@@ -327,7 +621,7 @@ async def callbacks(client, callback_query):
 
         elif data == "credits":
             # Get user's current credits
-            user_data = get_users_columns(chat_id, "credits")
+            user_data = await user_cache.get(chat_id, "credits")
             if user_data is None:
                 return
 
@@ -352,7 +646,9 @@ async def callbacks(client, callback_query):
             await message.reply(msgs.menu_msg, reply_markup=buttons)
 
         elif data == "joined_channels":
-            not_joined_channels = await is_joined(bot, chat_id)
+            not_joined_channels = await is_joined(
+                bot, chat_id, recheck_not_joined=True
+            )
 
             # Check if user has joined required channels
             if not_joined_channels:
@@ -374,12 +670,32 @@ async def callbacks(client, callback_query):
         await client.send_message(msgs.admin_id, f"Error in callback: {str(e)}")
 
 
+def answer_callback(callback_query, text=None):
+    """
+    Answer a callback query in the background, so the handler doesn't wait for it.
+    """
+
+    async def answer():
+        try:
+            await callback_query.answer(text)
+        except Exception as e:
+            # the query expired, the button stops loading by itself
+            logging.warning(f"Error answering callback: {str(e)}")
+
+    task = asyncio.create_task(answer())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
 @bot.on_message(filters.command("invite"))
+@rate_limit.limit("command")
+@shards.ordered
+@metrics.track_handler
 async def invite_command(client, message):
     chat_id = message.from_user.id
 
     # Get user's current refs count
-    user_data = get_users_columns(chat_id, ["refs", "credits"])
+    user_data = await user_cache.get(chat_id, ["refs", "credits"])
     if user_data is None:
         return
 
@@ -405,12 +721,76 @@ async def invite_command(client, message):
     )
 
 
+@bot.on_message(filters.command("history") & filters.private)
+@rate_limit.limit("command")
+@shards.ordered
+@metrics.track_handler
+async def history_command(client, message):
+    await send_history(message, message.from_user.id)
+
+
+async def send_history(message, chat_id, before_id=None):
+    """
+    Send a page of the user's earlier voices as buttons, the newest first.
+    """
+    items = await get_media_history(chat_id, before_id, HISTORY_PAGE_SIZE + 1)
+    if not items:
+        buttons = create_reply_markup([msgs.return_to_menu_button])
+        await message.reply(msgs.history_empty, reply_markup=buttons)
+        return
+
+    buttons = [
+        [
+            msgs.history_item.format(
+                date=item["created_at"][:16],
+                duration=item["duration"] if item["duration"] is not None else "?",
+            ),
+            "callback",
+            f"history_{item['id']}",
+            row,
+        ]
+        for row, item in enumerate(items[:HISTORY_PAGE_SIZE])
+    ]
+    # one item more than a page was read to know if there is a next page
+    if len(items) > HISTORY_PAGE_SIZE:
+        buttons.append(
+            [
+                msgs.history_more,
+                "callback",
+                f"history_page_{items[HISTORY_PAGE_SIZE - 1]['id']}",
+                len(buttons),
+            ]
+        )
+    buttons.append([*msgs.return_to_menu_button[:3], len(buttons)])
+    await message.reply(msgs.history_select, reply_markup=create_reply_markup(buttons))
+
+
+async def select_history_item(chat_id, message, item_id):
+    item = await get_media_history_item(chat_id, item_id)
+    if item is None:
+        return
+
+    # the voices imported from files.json have no duration yet
+    duration = item["duration"]
+    if duration is None:
+        probed = await run_blocking(probe_duration, item["url"], retries=0)
+        duration = math.ceil(probed)
+        await set_media_history_duration(item_id, duration)
+
+    if item["audio_hash"]:
+        conversion_cache.remember_audio(item["url"], item["audio_hash"])
+    await select_audio(chat_id, message, item["url"], duration)
+
+
 @bot.on_message(filters.command("credits"))
+@rate_limit.limit("command")
+@shards.ordered
+@metrics.track_handler
 async def credits_command(client, message):
     chat_id = message.from_user.id
 
     # Get user's current credits
-    user_data = get_users_columns(chat_id, "credits")
+    user_data = await user_cache.get(chat_id, "credits")
     if user_data is None:
         return
 
@@ -423,11 +803,14 @@ async def credits_command(client, message):
 
 
 @bot.on_message(filters.command("buy_credits"))
+@rate_limit.limit("command")
+@shards.ordered
+@metrics.track_handler
 async def buy_credits_command(client, message):
     chat_id = message.from_user.id
 
     # Get user's current credits
-    user_data = get_users_columns(chat_id, "credits")
+    user_data = await user_cache.get(chat_id, "credits")
     if user_data is None:
         return
 
@@ -440,17 +823,26 @@ async def buy_credits_command(client, message):
 
 
 @bot.on_message(filters.command("menu"))
+@rate_limit.limit("command")
+@shards.ordered
+@metrics.track_handler
 async def menu_command(client, message):
     buttons = create_reply_markup(msgs.menu_btns)
     await message.reply(msgs.menu_msg, reply_markup=buttons)
 
 
 @bot.on_message(filters.command("123"))
+@rate_limit.limit("command")
+@shards.ordered
+@metrics.track_handler
 async def help123_command(client, message):
     logging.info(f"123")
 
 
 @bot.on_message(filters.command("help"))
+@rate_limit.limit("command")
+@shards.ordered
+@metrics.track_handler
 async def help_command(client, message):
     buttons = create_reply_markup([msgs.return_to_menu_button])
     await message.reply(
@@ -459,6 +851,9 @@ async def help_command(client, message):
 
 
 @bot.on_message(filters.text)
+@rate_limit.limit("command")
+@shards.ordered
+@metrics.track_handler
 async def unknown_command(client, message):
     await message.reply(msgs.error_message)
 
@@ -527,111 +922,16 @@ def file_name_gen(t_id, file_id):
     return f"{directory}/{file_number}.ogg"
 
 
-def add_to_files_json(t_id, file_url):
-    if os.path.exists("files.json"):
-        with open("files.json", "r") as f:
-            files = json.load(f)
-    else:
-        files = {}
-
-    if str(t_id) in files:
-        files[str(t_id)].append(file_url)
-    else:
-        files[str(t_id)] = [file_url]
-
-    with open("files.json", "w") as f:
-        json.dump(files, f, indent=4)
-
-
-def get_files_by_chat_id(chat_id):
-    if os.path.exists("files.json"):
-        with open("files.json", "r") as f:
-            files = json.load(f)
-        return files.get(str(chat_id), [])
-    return []
-
-
-def generate_model_list(json_file):
+def get_model_list_markup():
     """
-    Generate a list of models grouped by categories, with category names as headers.
-
-    Args:
-        json_file (str): Path to the models.json file.
-
-    Returns:
-        list: A list of models grouped by categories with headers.
-    """
-    with open(json_file, "r", encoding="utf-8") as f:
-        models = json.load(f)
-
-    # Group models by category
-    categories = {}
-    for key, model in models.items():
-        category = model.get("category", "Uncategorized")
-        if category not in categories:
-            categories[category] = []
-        categories[category].append((key, model))
-
-    model_list = []
-    row_number = 0
-
-    # Define category order
-    category_order = ["voice_actor", "character", "actor", "celebritie", "singer"]
-
-    # Add models by category with headers in specified order
-    for category in category_order:
-        if category not in categories:
-            continue
-
-        category_models = categories[category]
-
-        # Add category header as a regular button instead of header type
-        model_list.append(
-            [
-                msgs.category_header.format(
-                    category=msgs.categories_lable[category], count=len(category_models)
-                ),
-                "callback",
-                f"cat_{category}",
-                row_number,
-            ]
-        )
-        row_number += 1
-
-        # Add models in this category
-        for i, (key, model) in enumerate(category_models):
-            if i % 2 == 0 and i > 0:
-                row_number += 1
-            model_list.append([model["name"], "callback", f"voice_{key}", row_number])
-
-        row_number += 1  # Add extra row between categories
-
-    return model_list
-
-
-def get_value_from_json(file_path, key):
+    Return the reply markup of the model list, rebuilt only when the catalog changes.
     """
-    Retrieve the value of a specific key from a JSON file.
+    model_list = catalog.model_list()
+    if _model_list_markup["version"] != catalog.version:
+        _model_list_markup["markup"] = create_reply_markup(model_list)
+        _model_list_markup["version"] = catalog.version
 
-    Args:
-        file_path (str): Path to the JSON file.
-        key (str): The key whose value you want to retrieve.
-
-    Returns:
-        any: The value associated with the key, or None if the key doesn't exist.
-    """
-    try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            data = json.load(file)
-            return data.get(
-                key
-            )  # Returns the value for the key, or None if it doesn't exist
-    except FileNotFoundError:
-        print(f"Error: File '{file_path}' not found.")
-        return None
-    except json.JSONDecodeError:
-        print("Error: Failed to decode JSON.")
-        return None
+    return _model_list_markup["markup"]
 
 
 def joined_channels_button(not_joined_channels):
@@ -656,18 +956,10 @@ def joined_channels_button(not_joined_channels):
 
 
 async def process_pitch_conversion(chat_id, data, message, pitch_based_on_gender=None):
-    # check if user has enough credits
-    user = get_users_columns(chat_id, ["duration", "credits"])
-    credits = user["credits"]
+    user = await user_cache.get(chat_id, ["duration", "model_name", "audio"])
     duration = user["duration"]
-
-    if credits < duration:
-        await message.reply(msgs.no_credits)
-        return
-
-    # update user credits
-    new_credits = credits - duration
-    update_user_column(chat_id, "credits", new_credits)
+    model_name = user["model_name"]
+    audio = user["audio"]
 
     # get pitch | if data has been passed it means it is calling from pitch selection
     if data:
@@ -677,39 +969,121 @@ async def process_pitch_conversion(chat_id, data, message, pitch_based_on_gender
     elif pitch_based_on_gender is not None:
         pitch = pitch_based_on_gender
 
-    # get model from database
-    model_name = get_users_columns(chat_id, "model_name")["model_name"]
-
     # get model data from models.json
-    model_data = get_value_from_json(MODELS_DIR, model_name)
+    model_data = catalog.get(model_name)
     model_title = model_data["name"]
     model_url = model_data["url"]
     model_0_pitch = model_data["pitch"]
-    audio = get_users_columns(chat_id, "audio")["audio"]
     rvc_model = model_data["type"]
 
-    # create rvc conversion to replicate
-    prediction = rvc.create_rvc_conversion(
-        audio,
-        model_url,
-        chat_id,
-        pitch=pitch + model_0_pitch,
-        voice_name=model_title,
-        rvc_model=rvc_model,
-        duration=duration,
+    # the same audio has already been converted with these settings, send the
+    # earlier output without charging for a new prediction
+    cache_key = conversion_cache.make_key(
+        audio, model_name, pitch + model_0_pitch, rvc_model, model_url
     )
+    cached_output = conversion_cache.get(cache_key)
+    if cached_output:
+        await message.reply_audio(
+            cached_output, caption=msgs.conversion_done.format(voice=model_title)
+        )
+        return
+
+    # hold the credits, they are kept when the prediction succeeds and
+    # refunded if it fails
+    reservation = await reserve_credits(chat_id, duration)
+    if reservation is None:
+        await message.reply(msgs.no_credits)
+        return
+    reservation_id, new_credits = reservation
+    user_cache.patch(chat_id, credits=new_credits)
 
-    # add to generations table
-    add_generation(chat_id, audio, model_name, duration, prediction)
+    # queue the conversion, the scheduler sends it to replicate when there is room
+    job_id = await job_queue.enqueue(
+        chat_id,
+        reservation_id,
+        {
+            "audio": audio,
+            "model_url": model_url,
+            "pitch": pitch + model_0_pitch,
+            "voice_name": model_title,
+            "rvc_model": rvc_model,
+            "duration": duration,
+            "model_name": model_name,
+        },
+        cache_key,
+    )
+    position = await job_queue.get_position(job_id)
 
     await message.reply(msgs.proccessing_emojie)
-    await message.reply(msgs.proccessing.format(credits=new_credits))
+    if position is None:
+        await message.reply(msgs.proccessing.format(credits=new_credits))
+    else:
+        await message.reply(
+            msgs.queued.format(
+                position=position[0], eta=position[1], credits=new_credits
+            )
+        )
+
+
+async def refund_expired_reservations():
+    while True:
+        await asyncio.sleep(60)
+        try:
+            if shards.is_primary():
+                expired = await expire_jobs(RESERVATION_TIMEOUT)
+                if expired:
+                    job_queue.notify()
+                    logging.info(f"{expired} jobs expired without a webhook")
+
+            # the refunded users must be in this worker's user cache
+            refunded = await expire_reservations(
+                RESERVATION_TIMEOUT, shards.local_shard()
+            )
+            for chat_id in refunded:
+                user_cache.invalidate(chat_id)
+            if refunded:
+                logging.info(f"refunded {len(refunded)} expired credit reservations")
+        except Exception as e:
+            logging.error(f"Error refunding reservations: {str(e)}")
+
+
+async def main():
+    rvc.check_webhook_url()
+    await bot.start()
+    update_server = None
+    events_task = None
+    if shards.is_sharded():
+        update_server = await shards.serve_updates(bot)
+        events_task = asyncio.create_task(shards.run_events())
+    webhook_runner = await webhook.start_server(
+        bot, port=shards.local_port(webhook.WEBHOOK_PORT)
+    )
+    refund_task = asyncio.create_task(refund_expired_reservations())
+    scheduler_task = asyncio.create_task(job_queue.run_scheduler(bot))
+    loop_lag_task = asyncio.create_task(metrics.monitor_loop_lag())
+    mirror_task = asyncio.create_task(
+        model_mirror.run(catalog, primary=shards.is_primary())
+    )
+    if shards.is_primary():
+        await broadcast.resume(bot)
+    logging.info("bot started")
+
+    await idle()
+
+    if update_server is not None:
+        update_server.close()
+        events_task.cancel()
+    mirror_task.cancel()
+    loop_lag_task.cancel()
+    scheduler_task.cancel()
+    refund_task.cancel()
+    await webhook_runner.cleanup()
+    await bot.stop()
 
 
 logging.basicConfig(level=logging.INFO)
-logging.info("bot started")
 
 if __name__ == "__main__":
-    bot.run()
+    bot.run(main())
 
 logging.info("bot stopped")
@@ -0,0 +1,128 @@
+"""
+Cache of the uploaded voices by Telegram file.
+
+A forwarded or resent voice keeps its file_unique_id, so the URL and the
+duration of its first upload are reused instead of downloading, processing
+and uploading it again. The uploads are stored in the media_uploads table
+with the preprocessing settings they were made with, and the recent ones are
+kept in memory in front of it.
+"""
+import os
+import time
+from collections import OrderedDict
+
+import metrics
+from async_db import add_media_upload, get_media_upload
+
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", 5000))
+
+# Days an upload is reused for
+MEDIA_CACHE_MAX_AGE = int(os.getenv("MEDIA_CACHE_MAX_AGE", 30))
+
+MEDIA_LOOKUPS = metrics.Counter(
+    "nedaai_media_cache_lookups_total",
+    "Lookups of uploaded voices by Telegram file, by where they were found.",
+    ["result"],
+)
+MEDIA_BYTES_SAVED = metrics.Counter(
+    "nedaai_media_cache_bytes_saved_total",
+    "Bytes not downloaded from Telegram and not uploaded thanks to the media cache.",
+)
+
+
+class MediaCache:
+    """
+    LRU cache of the media_uploads rows by (file_unique_id, processing).
+    """
+
+    def __init__(self, size=MEDIA_CACHE_SIZE, max_age=MEDIA_CACHE_MAX_AGE):
+        self.size = size
+        self.max_age = max_age
+        self._entries = OrderedDict()
+
+    async def get(self, file_unique_id, processing, file_size=0):
+        """
+        Return the earlier upload of a Telegram file.
+
+        Args:
+            file_unique_id (str): The file_unique_id of the voice or audio.
+            processing (str): The current audio.processing_id().
+            file_size (int): Size of the Telegram file, counted as saved on a hit.
+
+        Returns:
+            dict or None: {"url", "duration", "audio_hash", "size", "created_at"},
+                or None on a miss.
+        """
+        key = (file_unique_id, processing)
+        entry = self._entries.get(key)
+        # the uploads expire in memory like in the database
+        if entry is not None and self._expired(entry):
+            del self._entries[key]
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(key)
+            MEDIA_LOOKUPS.inc("memory")
+        else:
+            entry = await get_media_upload(file_unique_id, processing, self.max_age)
+            if entry is None:
+                MEDIA_LOOKUPS.inc("miss")
+                return None
+            self._remember(key, entry)
+            MEDIA_LOOKUPS.inc("db")
+
+        MEDIA_BYTES_SAVED.inc(amount=(file_size or 0) + (entry["size"] or 0))
+        return entry
+
+    async def add(self, file_unique_id, processing, url, duration, audio_hash, size):
+        """
+        Store the upload of a Telegram file.
+        """
+        await add_media_upload(
+            file_unique_id, processing, url, duration, audio_hash, size
+        )
+        self._remember(
+            (file_unique_id, processing),
+            {
+                "url": url,
+                "duration": duration,
+                "audio_hash": audio_hash,
+                "size": size,
+                "created_at": time.time(),
+            },
+        )
+
+    def _expired(self, entry):
+        return time.time() - entry["created_at"] >= self.max_age * 24 * 60 * 60
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def generate_report(self):
+        """
+        Generate a report about the media cache hit rate.
+
+        Returns:
+            str: A formatted string report about the media cache.
+        """
+        memory, db, misses = (
+            MEDIA_LOOKUPS.get("memory"),
+            MEDIA_LOOKUPS.get("db"),
+            MEDIA_LOOKUPS.get("miss"),
+        )
+        lookups = memory + db + misses
+        hit_rate = (memory + db) / lookups * 100 if lookups else 0
+
+        report_lines = [
+            "📊 **Media Cache Report:**\n",
+            f"📦 **In memory:** {len(self._entries)}/{self.size}",
+            f"✅ **Hits:** {memory + db} ({hit_rate:.2f}%), {memory} from memory",
+            f"❌ **Misses:** {misses}",
+            f"💾 **Saved:** {MEDIA_BYTES_SAVED.get() / 1024 / 1024:.1f} MB",
+        ]
+        return "\n".join(report_lines)
+
+
+cache = MediaCache()
@@ -0,0 +1,301 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Counters, gauges and histograms are plain dicts keyed by label values, so
+recording a value costs a lock and a few dict operations. The webhook server
+serves them on /metrics and the admin can get a summary with /admin/metrics.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+
+# Upper bounds (seconds) of the latency buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Seconds between two event loop lag samples
+LOOP_LAG_INTERVAL = 1
+
+_metrics = []
+
+# Async functions run before every scrape to refresh the gauges
+_collectors = []
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _format_labels(self, labels, extra=None):
+        pairs = list(zip(self.labelnames, labels))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _render_value(self, labels, value):
+        return [f"{self.name}{self._format_labels(labels)} {value}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # per bucket counts (the last one is +Inf), sum, count
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def get(self, *labels):
+        """
+        Return the count, sum and estimated 95th percentile of a histogram.
+        """
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                return 0, 0.0, 0.0
+            counts, total, count = list(entry[0]), entry[1], entry[2]
+
+        # upper bound of the bucket holding the 95th percentile
+        target, seen = count * 0.95, 0
+        p95 = float("inf")
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= target:
+                p95 = bound
+                break
+        return count, total, p95
+
+    def _render_value(self, labels, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += bucket_count
+            lines.append(
+                f"{self.name}_bucket"
+                f"{self._format_labels(labels, ('le', bound))} {cumulative}"
+            )
+        lines.append(f"{self.name}_sum{self._format_labels(labels)} {total}")
+        lines.append(f"{self.name}_count{self._format_labels(labels)} {count}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+HANDLER_SECONDS = Histogram(
+    "nedaai_handler_seconds", "Time spent in the pyrogram handlers.", ["handler"]
+)
+HANDLER_ERRORS = Counter(
+    "nedaai_handler_errors_total",
+    "Exceptions raised by the pyrogram handlers.",
+    ["handler"],
+)
+DB_SECONDS = Histogram(
+    "nedaai_db_seconds", "Time spent running the db.py functions.", ["function"]
+)
+DB_WAIT_SECONDS = Histogram(
+    "nedaai_db_wait_seconds", "Time db.py calls waited for the database thread."
+)
+DB_ERRORS = Counter(
+    "nedaai_db_errors_total", "Exceptions raised by the db.py functions.", ["function"]
+)
+DB_QUEUE_DEPTH = Gauge(
+    "nedaai_db_queue_depth", "Database calls waiting for the database thread."
+)
+EXTERNAL_SECONDS = Histogram(
+    "nedaai_external_call_seconds",
+    "Time spent in calls to external services.",
+    ["call"],
+    buckets=SLOW_BUCKETS,
+)
+EXTERNAL_ERRORS = Counter(
+    "nedaai_external_call_errors_total",
+    "Failed or timed out calls to external services.",
+    ["call"],
+)
+WORKER_WAIT_SECONDS = Histogram(
+    "nedaai_worker_wait_seconds",
+    "Time blocking calls waited for a worker pool slot and thread.",
+    ["call"],
+)
+WORKER_IN_FLIGHT = Gauge(
+    "nedaai_worker_calls_in_flight",
+    "Blocking calls waiting or running on the worker pool.",
+)
+JOBS = Gauge("nedaai_jobs", "Conversion jobs by status.", ["status"])
+LOOP_LAG_SECONDS = Histogram(
+    "nedaai_event_loop_lag_seconds",
+    "Delay of the event loop in waking up a sleeping task.",
+)
+
+
+def track_handler(func):
+    """
+    Decorator recording the latency and the errors of a pyrogram handler.
+
+    Put it under the @bot.on_... decorator so the timed function is registered.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+
+    return wrapper
+
+
+async def track_call(name, awaitable):
+    """
+    Await a call to an external service and record its latency and errors.
+    """
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    except Exception:
+        EXTERNAL_ERRORS.inc(name)
+        raise
+    finally:
+        EXTERNAL_SECONDS.observe(time.perf_counter() - start, name)
+
+
+def add_collector(collector):
+    """
+    Register an async function to run before every scrape, e.g. to refresh a gauge.
+    """
+    _collectors.append(collector)
+
+
+async def collect():
+    for collector in _collectors:
+        try:
+            await collector()
+        except Exception as e:
+            logging.error(f"Error collecting metrics: {str(e)}")
+
+
+def render():
+    """
+    Return all the metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def monitor_loop_lag(interval=LOOP_LAG_INTERVAL):
+    """
+    Sample how late the event loop wakes up from a sleep, runs until cancelled.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+def generate_report():
+    """
+    Generate a report about the handler, database and external call latencies.
+
+    Returns:
+        str: A formatted string report about the metrics.
+    """
+    report_lines = ["📊 **Metrics Report:**\n"]
+
+    sections = (
+        ("🤖 **Handlers:**", HANDLER_SECONDS, HANDLER_ERRORS),
+        ("🗄 **Database:**", DB_SECONDS, DB_ERRORS),
+        ("🌐 **External calls:**", EXTERNAL_SECONDS, EXTERNAL_ERRORS),
+    )
+    for title, histogram, errors in sections:
+        report_lines.append(title)
+        for (name,) in sorted(histogram._values):
+            count, total, p95 = histogram.get(name)
+            report_lines.append(
+                f"🔹 {name}: {count} calls, {errors.get(name)} errors, "
+                f"avg {total / count * 1000:.1f}ms, p95 ≤ {p95 * 1000:.0f}ms"
+            )
+        report_lines.append("")
+
+    count, total, p95 = LOOP_LAG_SECONDS.get()
+    if count:
+        report_lines.append(
+            f"⏱ **Event loop lag:** avg {total / count * 1000:.1f}ms, "
+            f"p95 ≤ {p95 * 1000:.0f}ms"
+        )
+    report_lines.append(
+        f"📥 **Jobs:** {JOBS.get('queued')} queued, {JOBS.get('running')} running | "
+        f"**DB queue:** {DB_QUEUE_DEPTH.get()} | "
+        f"**Worker calls:** {WORKER_IN_FLIGHT.get()}"
+    )
+    return "\n".join(report_lines)
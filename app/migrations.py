@@ -0,0 +1,312 @@
+"""
+Versioned schema migrations.
+
+The schema version is kept in SQLite's user_version. migrate() runs every
+migration newer than it in order, each one in its own transaction, so a
+migration runs once per database instead of on every boot.
+"""
+import json
+import logging
+import os
+
+import db
+
+# Uploads list of the bot before the media_history table, imported by it
+FILES_JSON = "files.json"
+
+
+def initial_schema(conn):
+    # the tables as they were created before versioned migrations, every
+    # step is a no-op on databases that already have them, and none commits
+    # so migrate() keeps its lock until the version is set
+    db.create_users_table(commit=False)
+    db.create_generations_table(commit=False)
+    db.add_gender_column_to_users(commit=False)
+    db.add_status_columns_to_generations(commit=False)
+    db.create_credit_tables(commit=False)
+
+
+def unique_users_chat_id(conn):
+    # concurrent /start could create the same user twice, keep the first row
+    cursor = conn.execute(
+        "DELETE FROM users WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY chat_id)"
+    )
+    if cursor.rowcount:
+        logging.warning(f"removed {cursor.rowcount} duplicate users")
+
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_chat_id ON users (chat_id)")
+
+
+def text_replicate_id(conn):
+    columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(generations)")}
+    if columns["replicate_id"] == "TEXT":
+        return
+
+    # SQLite can't change a column type, rebuild the table with the same columns
+    conn.execute(
+        """
+    CREATE TABLE generations_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        audio TEXT,
+        model_name TEXT,
+        duration INTEGER,
+        replicate_id TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        status TEXT,
+        output TEXT,
+        completed_at TIMESTAMP,
+        latency REAL
+    )
+    """
+    )
+    conn.execute(
+        """
+        INSERT INTO generations_new
+        SELECT id, chat_id, audio, model_name, duration, CAST(replicate_id AS TEXT),
+               created_at, status, output, completed_at, latency
+        FROM generations
+    """
+    )
+    conn.execute("DROP TABLE generations")
+    conn.execute("ALTER TABLE generations_new RENAME TO generations")
+
+
+def generations_indexes(conn):
+    # the users report counts every user by credits, audio, refs and gender, no
+    # index saves that scan, INCREMENTAL_STATS keeps its counters instead
+    # per user lookups and COUNT(DISTINCT chat_id) of the report
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_generations_chat_id ON generations (chat_id)"
+    )
+    # covers the per model GROUP BY of the report without touching the table
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_generations_model_duration "
+        "ON generations (model_name, duration)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_generations_created_at ON generations (created_at)"
+    )
+    # webhook lookups
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_generations_replicate_id "
+        "ON generations (replicate_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_credit_reservations_replicate_id "
+        "ON credit_reservations (replicate_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_credit_reservations_status "
+        "ON credit_reservations (status, created_at)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_credit_transactions_chat_id "
+        "ON credit_transactions (chat_id)"
+    )
+
+
+def jobs_table(conn):
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        priority INTEGER DEFAULT 0,            -- Higher runs first, 1 for paid users
+        status TEXT DEFAULT 'queued',          -- queued, running, succeeded, failed or canceled
+        payload TEXT,                          -- JSON arguments of the conversion
+        reservation_id INTEGER,                -- Credits held for the job
+        replicate_id TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, chat_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_replicate_id ON jobs (replicate_id)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_reservation_id ON jobs (reservation_id)"
+    )
+
+
+def referrals_table(conn):
+    # one row per invited user, so a user can only be referred once
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS referrals (
+        chat_id INTEGER PRIMARY KEY,           -- The invited user
+        invited_by INTEGER,                    -- The inviter
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_referrals_invited_by ON referrals (invited_by)"
+    )
+
+
+def broadcasts_table(conn):
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT,
+        status TEXT DEFAULT 'running',         -- running, done or canceled
+        last_chat_id INTEGER DEFAULT 0,        -- Users up to this chat_id were sent to
+        delivered INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,             -- Users who blocked the bot or were deleted
+        failed INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """
+    )
+
+
+def chunks_table(conn):
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS chunks (
+        parent_id TEXT,                        -- The replicate_id of the whole conversion
+        idx INTEGER,                           -- Position of the chunk in the audio
+        replicate_id TEXT,                     -- The prediction of the chunk
+        status TEXT,
+        output TEXT,
+        PRIMARY KEY (parent_id, idx)
+    )
+    """
+    )
+
+
+def model_mirrors_table(conn):
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS model_mirrors (
+        source_url TEXT PRIMARY KEY,           -- URL of the weights in models.json
+        model_name TEXT,
+        file_name TEXT,                        -- <sha256>.<ext> in MODEL_MIRROR_DIR
+        size INTEGER,
+        mirrored_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """
+    )
+
+
+def media_uploads_table(conn):
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS media_uploads (
+        file_unique_id TEXT,                   -- Telegram's ID of the file content
+        processing TEXT,                       -- audio.processing_id() of the upload
+        url TEXT,                              -- URL of the uploaded file
+        duration INTEGER,
+        audio_hash TEXT,                       -- sha256 of the original file
+        size INTEGER,                          -- Bytes uploaded
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (file_unique_id, processing)
+    )
+    """
+    )
+
+
+def media_history_table(conn):
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS media_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        url TEXT,                              -- URL of the uploaded voice
+        duration INTEGER,                      -- NULL for the imported ones
+        audio_hash TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """
+    )
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_media_history_chat_id_url "
+        "ON media_history (chat_id, url)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_media_history_chat_id_id "
+        "ON media_history (chat_id, id)"
+    )
+
+    # the uploads used to be listed in files.json, {chat_id: [url, ...]}
+    if os.path.exists(FILES_JSON):
+        with open(FILES_JSON) as f:
+            files = json.load(f)
+        conn.executemany(
+            "INSERT OR IGNORE INTO media_history (chat_id, url) VALUES (?, ?)",
+            [(int(chat_id), url) for chat_id, urls in files.items() for url in urls],
+        )
+        print(f"Imported {FILES_JSON} into media_history.")
+
+
+def shard_events_table(conn):
+    # changes made by one shard worker that the others must apply, see shards.py
+    conn.execute(
+        """
+    CREATE TABLE IF NOT EXISTS shard_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT,
+        value TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """
+    )
+
+
+# (version, migration), append new migrations at the end with the next version
+MIGRATIONS = [
+    (1, initial_schema),
+    (2, unique_users_chat_id),
+    (3, text_replicate_id),
+    (4, generations_indexes),
+    (5, jobs_table),
+    (6, referrals_table),
+    (7, broadcasts_table),
+    (8, chunks_table),
+    (9, model_mirrors_table),
+    (10, media_uploads_table),
+    (11, media_history_table),
+    (12, shard_events_table),
+]
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate():
+    """
+    Run the migrations the database hasn't had yet.
+
+    Returns:
+        int: The schema version after migrating.
+    """
+    conn = db.get_connection()
+    version = get_version(conn)
+
+    for migration_version, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # another process (shard worker) may have run it while we waited
+            if get_version(conn) >= migration_version:
+                conn.rollback()
+                version = migration_version
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {migration_version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        version = migration_version
+        print(f"Database migrated to version {version} ({migration.__name__}).")
+
+    return version
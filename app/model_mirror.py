@@ -0,0 +1,341 @@
+"""
+Local mirror of the weights of the most used voice models.
+
+Every prediction passes the model's download URL from models.json and the
+Replicate worker downloads the weights from it before converting. With
+MODEL_MIRROR=1 the bot keeps a copy of the weights of the MODEL_MIRROR_TOP
+most used models of the last MODEL_POPULARITY_DAYS days in MODEL_MIRROR_DIR.
+The files are named by the sha256 of their content and served by the webhook
+server under MODEL_MIRROR_PATH, so a URL always points to the same bytes and
+the worker (or any cache in between) may keep it for ever.
+
+The mirrors are refreshed every MODEL_MIRROR_INTERVAL seconds. The file of a
+model that dropped out of the top is deleted MODEL_MIRROR_RETENTION seconds
+later, the predictions submitted before may still download it.
+
+With MODEL_WARMUP=1 a short silent voice is converted with each of the
+MODEL_WARMUP_TOP most used models every MODEL_WARMUP_INTERVAL seconds, so a
+worker stays up with their weights already downloaded.
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+import time
+import wave
+from urllib.parse import urlsplit
+
+import requests
+
+import metrics
+import rvc
+from async_db import (
+    add_model_mirror,
+    get_model_mirrors,
+    get_popular_models,
+    remove_model_mirror,
+)
+from uploader import upload_bytes
+from workers import run_blocking
+
+MODEL_MIRROR = os.getenv("MODEL_MIRROR") == "1"
+MODEL_WARMUP = os.getenv("MODEL_WARMUP") == "1"
+
+# Number of models mirrored, the most used first
+MODEL_MIRROR_TOP = int(os.getenv("MODEL_MIRROR_TOP", 10))
+
+# Days of generations the popularity of the models is counted over
+MODEL_POPULARITY_DAYS = int(os.getenv("MODEL_POPULARITY_DAYS", 7))
+
+# Seconds between two refreshes of the mirrors
+MODEL_MIRROR_INTERVAL = int(os.getenv("MODEL_MIRROR_INTERVAL", 60 * 60))
+
+# Seconds between two reloads of the mirrors in the other shard workers
+MODEL_MIRROR_RELOAD_INTERVAL = 60
+
+# Seconds the file of a model is kept after it stops being mirrored
+MODEL_MIRROR_RETENTION = int(os.getenv("MODEL_MIRROR_RETENTION", 60 * 60))
+
+# Bytes a model file may have at most
+MODEL_MAX_SIZE = int(os.getenv("MODEL_MAX_SIZE", 1024 * 1024 * 1024))
+
+MODEL_MIRROR_DIR = os.getenv("MODEL_MIRROR_DIR", "sessions/models")
+
+# Path of the mirrored files on the webhook server
+MODEL_MIRROR_PATH = "/models"
+
+# Public URL of MODEL_MIRROR_PATH, defaults to the host of WEBHOOK_URL
+MODEL_MIRROR_URL = os.getenv("MODEL_MIRROR_URL")
+
+# Number of models kept warm and seconds between two warm-ups
+MODEL_WARMUP_TOP = int(os.getenv("MODEL_WARMUP_TOP", 3))
+MODEL_WARMUP_INTERVAL = int(os.getenv("MODEL_WARMUP_INTERVAL", 10 * 60))
+
+# Seconds a model download may take
+DOWNLOAD_TIMEOUT = 10 * 60
+
+FILE_NAME_PATTERN = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,8}$")
+
+MIRROR_LOOKUPS = metrics.Counter(
+    "nedaai_model_mirror_lookups_total",
+    "Model URLs handed to predictions, by whether a mirror was used.",
+    ["result"],
+)
+
+# source URL -> mirror URL
+_urls = {}
+
+# URL of the uploaded warm-up voice
+_warm_up_audio = None
+
+
+def get_base_url():
+    if MODEL_MIRROR_URL:
+        return MODEL_MIRROR_URL.rstrip("/")
+    parts = urlsplit(rvc.base_url)
+    return f"{parts.scheme}://{parts.netloc}{MODEL_MIRROR_PATH}"
+
+
+def get_path(file_name):
+    """
+    Return the local path of a mirrored file, or None if the name isn't one.
+    """
+    if not FILE_NAME_PATTERN.match(file_name):
+        return None
+    return os.path.join(MODEL_MIRROR_DIR, file_name)
+
+
+def url_for(source_url):
+    """
+    Return the URL predictions should download a model from.
+
+    Args:
+        source_url (str): The URL of the model in models.json.
+
+    Returns:
+        str: The URL of the mirror, or `source_url` if the model isn't mirrored.
+    """
+    mirror_url = _urls.get(source_url)
+    MIRROR_LOOKUPS.inc("hit" if mirror_url else "miss")
+    return mirror_url or source_url
+
+
+def download(source_url):
+    """
+    Download a model file into MODEL_MIRROR_DIR, named by its sha256.
+
+    Returns:
+        tuple: (file_name, size)
+    """
+    os.makedirs(MODEL_MIRROR_DIR, exist_ok=True)
+    extension = os.path.splitext(urlsplit(source_url).path)[1].lower()
+    if not re.fullmatch(r"\.[a-z0-9]{1,8}", extension):
+        extension = ".zip"
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=MODEL_MIRROR_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as file, requests.get(
+            source_url, stream=True, timeout=30
+        ) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(1024 * 1024):
+                size += len(chunk)
+                if size > MODEL_MAX_SIZE:
+                    raise ValueError(f"{source_url} is larger than {MODEL_MAX_SIZE}")
+                digest.update(chunk)
+                file.write(chunk)
+
+        file_name = digest.hexdigest() + extension
+        os.replace(temp_path, get_path(file_name))
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    return file_name, size
+
+
+def prune(mirrors):
+    """
+    Delete the files no mirror uses anymore once they are older than the retention.
+    """
+    if not os.path.isdir(MODEL_MIRROR_DIR):
+        return
+    used = {mirror["file_name"] for mirror in mirrors.values()}
+    now = time.time()
+    for file_name in os.listdir(MODEL_MIRROR_DIR):
+        path = os.path.join(MODEL_MIRROR_DIR, file_name)
+        if file_name in used:
+            continue
+        if now - os.path.getmtime(path) > MODEL_MIRROR_RETENTION:
+            os.remove(path)
+            logging.info(f"deleted model mirror {file_name}")
+
+
+def _set_urls(mirrors):
+    global _urls
+
+    base_url = get_base_url()
+    _urls = {
+        source_url: f"{base_url}/{mirror['file_name']}"
+        for source_url, mirror in mirrors.items()
+        if os.path.exists(get_path(mirror["file_name"]))
+    }
+
+
+async def refresh(catalog):
+    """
+    Mirror the most used models and stop mirroring the ones out of the top.
+
+    Args:
+        catalog (ModelCatalog): The catalog to look the model URLs up in.
+    """
+    wanted = {}
+    for model_name, _ in await get_popular_models(
+        MODEL_MIRROR_TOP, MODEL_POPULARITY_DAYS
+    ):
+        model = catalog.get(model_name)
+        if model and model.get("url"):
+            wanted[model["url"]] = model_name
+
+    mirrors = await get_model_mirrors()
+    for source_url, model_name in wanted.items():
+        mirror = mirrors.get(source_url)
+        if mirror and os.path.exists(get_path(mirror["file_name"])):
+            continue
+
+        try:
+            file_name, size = await run_blocking(
+                download, source_url, timeout=DOWNLOAD_TIMEOUT, retries=1
+            )
+        except Exception as e:
+            logging.error(f"Error mirroring model {model_name}: {str(e)}")
+            continue
+
+        await add_model_mirror(source_url, model_name, file_name, size)
+        mirrors[source_url] = {
+            "model_name": model_name,
+            "file_name": file_name,
+            "size": size,
+            "mirrored_at": None,
+        }
+        logging.info(f"mirrored model {model_name} as {file_name} ({size} bytes)")
+
+    for source_url in set(mirrors) - set(wanted):
+        retired = mirrors.pop(source_url)
+        await remove_model_mirror(source_url)
+        # the retention is counted from now
+        path = get_path(retired["file_name"])
+        if os.path.exists(path):
+            os.utime(path)
+
+    _set_urls(mirrors)
+    await run_blocking(prune, mirrors, retries=0)
+
+
+def silent_voice(seconds=1, sample_rate=16000):
+    """
+    Return a silent mono WAV file.
+    """
+    output = io.BytesIO()
+    with wave.open(output, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(b"\0\0" * seconds * sample_rate)
+    output.seek(0)
+    output.name = "warm-up.wav"
+    return output
+
+
+async def warm_up(catalog):
+    """
+    Create a warm-up prediction for each of the most used models.
+    """
+    global _warm_up_audio
+
+    if _warm_up_audio is None:
+        _warm_up_audio = await run_blocking(
+            upload_bytes, silent_voice(), "nedaai/warm-up.wav"
+        )
+
+    for model_name, _ in await get_popular_models(
+        MODEL_WARMUP_TOP, MODEL_POPULARITY_DAYS
+    ):
+        model = catalog.get(model_name)
+        if not model:
+            continue
+        try:
+            await run_blocking(
+                rvc.create_warm_up,
+                _warm_up_audio,
+                url_for(model["url"]),
+                model["type"],
+                retries=0,
+            )
+        except Exception as e:
+            logging.error(f"Error warming up model {model_name}: {str(e)}")
+
+
+async def _every(interval, func, *args):
+    while True:
+        try:
+            await func(*args)
+        except Exception as e:
+            logging.error(f"Error in {func.__name__}: {str(e)}")
+        await asyncio.sleep(interval)
+
+
+async def load():
+    """
+    Use the mirrors stored in the database, refreshed by the primary process.
+    """
+    _set_urls(await get_model_mirrors())
+
+
+async def run(catalog, primary=True):
+    """
+    Refresh the mirrors and send the warm-ups while they are enabled, runs
+    until cancelled.
+
+    Args:
+        catalog (ModelCatalog): The catalog to look the model URLs up in.
+        primary (bool): False in the shard workers that only reload the
+            mirrors the primary worker made, see shards.py.
+    """
+    loops = []
+    if MODEL_MIRROR:
+        # serve the mirrors of the last run until the first refresh is done
+        await load()
+        if primary:
+            loops.append(_every(MODEL_MIRROR_INTERVAL, refresh, catalog))
+        else:
+            loops.append(_every(MODEL_MIRROR_RELOAD_INTERVAL, load))
+    if MODEL_WARMUP and primary:
+        loops.append(_every(MODEL_WARMUP_INTERVAL, warm_up, catalog))
+    await asyncio.gather(*loops)
+
+
+def generate_report():
+    """
+    Generate a report about the mirrored models.
+
+    Returns:
+        str: A formatted string report about the mirrors.
+    """
+    report_lines = ["🪞 **Model Mirrors:**\n"]
+    report_lines.append(
+        f"🔹 Mirrored: {len(_urls)} (top {MODEL_MIRROR_TOP}), "
+        f"enabled: {MODEL_MIRROR}, warm-up: {MODEL_WARMUP}"
+    )
+    hits, misses = MIRROR_LOOKUPS.get("hit"), MIRROR_LOOKUPS.get("miss")
+    if hits + misses:
+        report_lines.append(
+            f"🔹 Predictions using a mirror: {hits}/{hits + misses} "
+            f"({hits / (hits + misses):.0%})"
+        )
+    return "\n".join(report_lines)
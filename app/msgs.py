@@ -36,6 +36,14 @@ proccessing = (
     "**🔸 اعتبار باقی‌مانده شما: {credits} ثانیه**\n\n"
     # "بازگشت به منوی اصلی : /menu"
 )
+queued = (
+    "🔄 درخواست شما در صف پردازش قرار گرفت.\n\n"
+    "🔢 نوبت شما: {position}\n"
+    "⏱ زمان تقریبی انتظار: {eta} ثانیه\n\n"
+    "**🔸 اعتبار باقی‌مانده شما: {credits} ثانیه**\n\n"
+)
+voice_silent = "🔇 صدایی در فایل ارسالی شما پیدا نشد، لطفا دوباره ارسال کنید."
+voice_too_long = "✂️ فقط {max_duration} ثانیه اول فایل شما برای تبدیل استفاده می‌شود."
 no_credits = "‼️اعتبار شما برای این درخواست کافی نیست. برای افزایش اعتبار می‌توانید از /buy_credits استفاده کنید یا با /invite از دوستانتان به ربات دعوت کنید و اعتبار هدیه بگیرید."
 banner_msg = """
 🔥ربات تقلید صدای هوش‌مصنوعی
@@ -106,6 +114,8 @@ help_msg = """
 
 - در ادامه ربات براتون ویس ساخته شده با صدای جدید رو می‌فرسته و می‌تونید ذخیره‌اش کنید و تو جاهای مختلف استفاده کنید.
 
+🗂 با /history می‌تونید صداهایی که قبلا فرستادید رو بدون ارسال دوباره تبدیل کنید.
+
 ❓ اگه سوالی داشتید می‌تونید از {admin_username} بپرسید
 
 """
@@ -136,7 +146,21 @@ gender_btns = [
     ["👩 زن", "callback", "gender_female", 0],
     ["👨 مرد", "callback", "gender_male", 0],
 ]
+history_select = "🗂 یکی از صداهای قبلی خود را برای تبدیل دوباره انتخاب کنید:"
+history_empty = "🗂 هنوز صدایی ارسال نکرده‌اید، برای شروع یک ویس یا فایل صوتی بفرستید."
+history_item = "🎙 {date} | {duration} ثانیه"
+history_more = "⬇️ صداهای قدیمی‌تر"
+rate_limited = "⏳ درخواست‌های شما زیاد است، لطفا چند لحظه صبر کنید و دوباره تلاش کنید."
 added_credits = (
     "✨ کاربر گرامی، {credits} ثانیه اعتبار به حساب شما اضافه شد.\n\n"
     "🔸 اعتبار باقیمانده شما : {new_credits}"
 )
+conversion_done = (
+    "✅ صدای شما با صدای **{voice}** آماده شد.\n\n"
+    "🎤 برای تبدیل دوباره یک ویس یا فایل صوتی دیگر ارسال کنید"
+)
+conversion_failed = (
+    "❌ متاسفانه تبدیل صدای شما با خطا مواجه شد و اعتبار آن به حساب شما برگشت داده شد، "
+    "لطفا دوباره تلاش کنید.\n\n"
+    "در صورت تکرار مشکل با {admin} در تماس باشید"
+)
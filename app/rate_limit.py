@@ -0,0 +1,244 @@
+"""
+Per-user rate limits of the pyrogram handlers.
+
+Every user has a token bucket per action type (RATE_LIMITS), a handler
+decorated with `limit(action)` only runs when the bucket of the user has a
+token. A throttled voice or command gets a short warning at most once every
+RATE_LIMIT_WARN_INTERVAL seconds, a throttled callback only an answer, so the
+spam of a user costs at most one API call.
+
+A double tap on the buttons of a message arrives as several callback
+queries, pyrogram would run all of them. While a callback of a message is
+running, the other taps on that message wait for it to finish and return
+without running, like a single tap.
+"""
+import asyncio
+import functools
+import os
+import time
+
+from pyrogram.errors import RPCError
+
+import metrics
+import msgs
+import shards
+
+# Tokens per second and burst of each action type
+RATE_LIMITS = {
+    # a voice costs a download, an upload and DB writes, 6 per minute
+    "voice": (
+        float(os.getenv("VOICE_RATE", 0.1)),
+        int(os.getenv("VOICE_BURST", 3)),
+    ),
+    "callback": (
+        float(os.getenv("CALLBACK_RATE", 1)),
+        int(os.getenv("CALLBACK_BURST", 5)),
+    ),
+    "command": (
+        float(os.getenv("COMMAND_RATE", 1)),
+        int(os.getenv("COMMAND_BURST", 5)),
+    ),
+}
+
+# Seconds between two warnings to a throttled user
+RATE_LIMIT_WARN_INTERVAL = 10
+
+# Buckets kept before the full ones (users that went quiet) are dropped
+RATE_LIMIT_MAX_BUCKETS = 50000
+
+THROTTLED = metrics.Counter(
+    "nedaai_rate_limited_total", "Updates dropped by the rate limits.", ["action"]
+)
+COALESCED = metrics.Counter(
+    "nedaai_coalesced_callbacks_total",
+    "Callback taps attached to a running callback of the same message.",
+)
+
+# (chat_id, action) -> TokenBucket
+_buckets = {}
+
+# (chat_id, action) -> time of the last warning
+_warned = {}
+
+# (chat_id, message_id) -> future done when the running callback returns
+_in_flight = {}
+
+
+class TokenBucket:
+    """
+    Allow `rate` acquisitions per second with bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def try_acquire(self):
+        """
+        Take a token if there is one, without waiting.
+
+        Returns:
+            bool: True if a token was taken.
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def is_full(self):
+        now = time.monotonic()
+        return self._tokens + (now - self._updated) * self.rate >= self.capacity
+
+    def pause(self, seconds):
+        """
+        Stop handing out tokens for `seconds`, e.g. after a FloodWait.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+def _prune():
+    # a full bucket is the same as a new one
+    for key in [key for key, bucket in _buckets.items() if bucket.is_full()]:
+        del _buckets[key]
+        _warned.pop(key, None)
+
+
+def allow(chat_id, action):
+    """
+    Take a token from the bucket of a user for an action.
+
+    Returns:
+        bool: False if the user is over the limit of the action.
+    """
+    key = (chat_id, action)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        if len(_buckets) >= RATE_LIMIT_MAX_BUCKETS:
+            _prune()
+        bucket = _buckets[key] = TokenBucket(*RATE_LIMITS[action])
+    return bucket.try_acquire()
+
+
+def _should_warn(key):
+    now = time.monotonic()
+    if now - _warned.get(key, 0) < RATE_LIMIT_WARN_INTERVAL:
+        return False
+    _warned[key] = now
+    return True
+
+
+async def _answer(callback_query, text=None):
+    # the query may have expired or been answered already, nothing to do then
+    try:
+        await callback_query.answer(text)
+    except RPCError:
+        pass
+
+
+async def _reject(update, chat_id, action):
+    THROTTLED.inc(action)
+    warn = _should_warn((chat_id, action))
+    if hasattr(update, "data"):
+        # a callback must be answered or the button keeps loading
+        await _answer(update, msgs.rate_limited if warn else None)
+    elif warn:
+        await update.reply(msgs.rate_limited)
+
+
+def _tap_key(update, chat_id):
+    # None for messages, only the callbacks are coalesced
+    if not hasattr(update, "data"):
+        return None
+    message = getattr(update, "message", None)
+    if message is not None:
+        return chat_id, message.id
+    return chat_id, update.inline_message_id
+
+
+def limit(action):
+    """
+    Decorator of pyrogram handlers enforcing the rate limit of `action`.
+
+    Put it right under the @bot.on_... decorator, above shards.ordered, so the
+    dropped updates don't wait for the lock of the chat and a repeated tap
+    is seen while the first one still waits for it. The admin isn't limited.
+    """
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(client, update, *args, **kwargs):
+            chat_id = shards.update_chat_id(update)
+            if chat_id is None:
+                return await handler(client, update, *args, **kwargs)
+
+            tap = _tap_key(update, chat_id)
+            running = _in_flight.get(tap)
+            if running is not None:
+                COALESCED.inc()
+                await _answer(update)
+                await asyncio.shield(running)
+                return
+
+            if chat_id != msgs.admin_id and not allow(chat_id, action):
+                await _reject(update, chat_id, action)
+                return
+
+            if tap is None:
+                return await handler(client, update, *args, **kwargs)
+
+            _in_flight[tap] = asyncio.get_running_loop().create_future()
+            try:
+                return await handler(client, update, *args, **kwargs)
+            finally:
+                _in_flight.pop(tap).set_result(None)
+
+        return wrapper
+
+    return decorator
+
+
+def generate_report():
+    """
+    Generate a report about the throttled updates.
+
+    Returns:
+        str: A formatted string report about the rate limits.
+    """
+    report_lines = ["🚦 **Rate Limits:**\n"]
+    for action, (rate, burst) in RATE_LIMITS.items():
+        report_lines.append(
+            f"🔹 {action}: {THROTTLED.get(action)} throttled "
+            f"({rate * 60:g}/min, burst {burst})"
+        )
+    report_lines.append(f"🔹 Coalesced callback taps: {COALESCED.get()}")
+    report_lines.append(f"🔹 Users tracked: {len({key[0] for key in _buckets})}")
+    return "\n".join(report_lines)
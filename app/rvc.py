@@ -1,33 +1,103 @@
+import os
+from urllib.parse import urlencode
+
 import replicate
 from dotenv import load_dotenv
 
 load_dotenv(".env")
 
-base_url = "https://n8n.inbeet.tech/webhook/replicate"
+# Public URL of the bot's webhook server (webhook.py), Replicate posts the
+# finished predictions there, required
+base_url = os.getenv("WEBHOOK_URL")
+
+# Version of the RVC model on Replicate
+RVC_VERSION = "d18e2e0a6a6d3af183cc09622cebba8555ec9a9e66983261fc64c8b1572b7dce"
+
+# Conversion settings sent with every prediction
+RVC_PARAMS = {
+    "protect": 0.5,
+    "index_rate": 0.5,
+    "rms_mix_rate": 0.3,
+    "filter_radius": 3,
+    "output_format": "wav",
+}
+
+
+def check_webhook_url():
+    """
+    Raise if WEBHOOK_URL isn't set.
+
+    The jobs and the credit reservations only complete when Replicate posts
+    the predictions to webhook.py, without it every job would stay running
+    until it expires and every conversion would be refunded.
+    """
+    if not base_url:
+        raise RuntimeError(
+            "WEBHOOK_URL must be set to the public URL of the webhook server, "
+            "e.g. https://bot.example.com/webhook/replicate"
+        )
 
 
 def create_rvc_conversion(
-    audio, model_url, t_id, pitch=0, voice_name=None, rvc_model="CUSTOM", duration=0
+    audio,
+    model_url,
+    t_id,
+    pitch=0,
+    voice_name=None,
+    rvc_model="CUSTOM",
+    duration=0,
+    parent=None,
+    chunk=None,
 ):
     input = {
-        "protect": 0.5,
+        **RVC_PARAMS,
         "rvc_model": rvc_model,  # to use custom = CUSTOM
-        "index_rate": 0.5,
         "input_audio": audio,
         "pitch_change": pitch,
-        "rms_mix_rate": 0.3,
-        "filter_radius": 3,
         "custom_rvc_model_download_url": model_url,
-        "output_format": "wav",
     }
 
-    callback_url = f"{base_url}?t_id={t_id}&voice={voice_name}&duration={duration}"
+    params = {"t_id": t_id, "voice": voice_name, "duration": duration}
+    if parent:
+        # a chunk of a chunked conversion, see chunking.py
+        params.update({"parent": parent, "chunk": chunk})
+    query = urlencode(params)
+    callback_url = f"{base_url}?{query}"
 
     rep = replicate.predictions.create(
-        version="d18e2e0a6a6d3af183cc09622cebba8555ec9a9e66983261fc64c8b1572b7dce",
+        version=RVC_VERSION,
         input=input,
         webhook=callback_url,
         webhook_events_filter=["completed"],
     )
 
     return rep.id
+
+
+def create_warm_up(audio, model_url, rvc_model="CUSTOM"):
+    """
+    Create a prediction without a webhook, only to keep a worker and the
+    model weights warm. Its output is never used.
+
+    Returns:
+        str: The prediction ID.
+    """
+    rep = replicate.predictions.create(
+        version=RVC_VERSION,
+        input={
+            **RVC_PARAMS,
+            "rvc_model": rvc_model,
+            "input_audio": audio,
+            "pitch_change": 0,
+            "custom_rvc_model_download_url": model_url,
+        },
+    )
+
+    return rep.id
+
+
+def cancel_prediction(prediction_id):
+    """
+    Cancel a running prediction, e.g. a chunk of a conversion that failed.
+    """
+    replicate.predictions.cancel(prediction_id)
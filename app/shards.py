@@ -0,0 +1,295 @@
+"""
+Sharding of the update handling across several bot processes.
+
+In the sharded mode (see cluster.py) one receiver process gets the updates
+from Telegram and forwards every update to the worker that owns its chat,
+the chat_id modulo SHARD_COUNT. A worker is a main.py process started with
+SHARD_INDEX and SHARD_COUNT. It doesn't receive updates from Telegram itself
+(no_updates), its pyrogram handlers run the updates read from the receiver
+on SHARD_PORT + SHARD_INDEX.
+
+Since a chat always goes to the same worker, the per-user caches stay local
+to one process, and `ordered` runs the handlers of a chat one at a time in
+the order its updates arrived.
+
+The updates are sent as their MTProto serialization with the users and chats
+they reference, in frames prefixed with their length.
+
+A change that a worker makes for a chat it doesn't own, like the admin adding
+credits to a user, is published in the shard_events table, and every worker
+applies the new events every SHARD_EVENTS_INTERVAL seconds.
+"""
+import asyncio
+import functools
+import io
+import logging
+import os
+import struct
+import time
+
+from pyrogram import raw, utils
+
+from async_db import (
+    add_shard_event,
+    delete_shard_events,
+    get_last_shard_event,
+    get_last_shard_event_id,
+    get_shard_events,
+)
+
+# Position of this process and number of worker processes, set by cluster.py
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", 0))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 1))
+
+# Worker i reads its updates from SHARD_HOST:SHARD_PORT + i
+SHARD_HOST = os.getenv("SHARD_HOST", "127.0.0.1")
+SHARD_PORT = int(os.getenv("SHARD_PORT", 8100))
+
+# Seconds between two reads of the events published by the workers
+SHARD_EVENTS_INTERVAL = 1
+
+# Seconds the events are kept, worker 0 deletes the older ones
+SHARD_EVENTS_RETENTION = 60 * 60
+
+_FRAME_HEADER = struct.Struct("<I")
+_COUNTS = struct.Struct("<II")
+
+# chat_id -> [lock, handlers holding or waiting for it]
+_chat_locks = {}
+
+# event kind -> function applying it in this process
+_event_handlers = {}
+
+# kinds of events whose latest value a starting worker applies
+_kept_events = set()
+
+
+def is_sharded():
+    return SHARD_COUNT > 1
+
+
+def is_primary():
+    """
+    Return True in the process that runs the jobs done once for all shards.
+    """
+    return SHARD_INDEX == 0
+
+
+def shard_of(chat_id, count=SHARD_COUNT):
+    # abs() so negative group IDs land on the same shard as in db._shard_filter
+    return abs(int(chat_id)) % count
+
+
+def local_shard():
+    """
+    Return (index, count) of this process for the db functions.
+
+    Returns:
+        tuple: (SHARD_INDEX, SHARD_COUNT), or None if not sharded.
+    """
+    return (SHARD_INDEX, SHARD_COUNT) if is_sharded() else None
+
+
+def session_name(name):
+    # workers can't share the session file of the receiver
+    return f"{name}-{SHARD_INDEX}" if is_sharded() else name
+
+
+def local_port(port):
+    """
+    Return the port a server of this worker listens on, `port` is the public one.
+    """
+    return port + 1 + SHARD_INDEX if is_sharded() else port
+
+
+def get_chat_id(update):
+    """
+    Return the chat_id a raw update belongs to, as in message.chat.id, or 0.
+    """
+    peer = getattr(getattr(update, "message", None), "peer_id", None)
+    if peer is not None:
+        return utils.get_peer_id(peer)
+    # the chat of the message a callback query button belongs to
+    peer = getattr(update, "peer", None)
+    if peer is not None:
+        return utils.get_peer_id(peer)
+    return getattr(update, "user_id", 0)
+
+
+def pack_update(update, users, chats):
+    """
+    Serialize a raw update with its users and chats into a frame.
+    """
+    blobs = [update.write()]
+    blobs += [user.write() for user in users.values()]
+    blobs += [chat.write() for chat in chats.values()]
+
+    body = _COUNTS.pack(len(users), len(chats)) + b"".join(
+        _FRAME_HEADER.pack(len(blob)) + blob for blob in blobs
+    )
+    return _FRAME_HEADER.pack(len(body)) + body
+
+
+def unpack_update(body):
+    """
+    Read a frame body written by pack_update.
+
+    Returns:
+        tuple: (update, users, chats) like pyrogram's dispatcher queue packets.
+    """
+    n_users, n_chats = _COUNTS.unpack_from(body)
+    stream = io.BytesIO(body[_COUNTS.size :])
+
+    objects = []
+    for _ in range(1 + n_users + n_chats):
+        (size,) = _FRAME_HEADER.unpack(stream.read(_FRAME_HEADER.size))
+        objects.append(raw.core.TLObject.read(io.BytesIO(stream.read(size))))
+
+    users = objects[1 : 1 + n_users]
+    chats = objects[1 + n_users :]
+    return objects[0], {u.id: u for u in users}, {c.id: c for c in chats}
+
+
+async def read_frame(reader):
+    (size,) = _FRAME_HEADER.unpack(await reader.readexactly(_FRAME_HEADER.size))
+    return await reader.readexactly(size)
+
+
+def start_dispatcher(client):
+    """
+    Start the handler tasks of a client created with no_updates.
+
+    pyrogram doesn't start them without updates from Telegram, but the worker
+    gets its updates from the receiver.
+    """
+    dispatcher = client.dispatcher
+    for _ in range(client.workers):
+        lock = asyncio.Lock()
+        dispatcher.locks_list.append(lock)
+        dispatcher.handler_worker_tasks.append(
+            asyncio.create_task(dispatcher.handler_worker(lock))
+        )
+
+
+async def serve_updates(client, host=SHARD_HOST, port=None):
+    """
+    Run the updates forwarded by the receiver through the client's handlers.
+
+    Returns:
+        asyncio.Server: The server, close() it to stop.
+    """
+    port = port or SHARD_PORT + SHARD_INDEX
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                update, users, chats = unpack_update(await read_frame(reader))
+                # the access hashes are needed to answer the users
+                await client.fetch_peers(list(users.values()) + list(chats.values()))
+                client.dispatcher.updates_queue.put_nowait((update, users, chats))
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            logging.error(f"Error reading updates from the receiver: {str(e)}")
+        finally:
+            writer.close()
+
+    start_dispatcher(client)
+    server = await asyncio.start_server(handle, host, port)
+    logging.info(f"shard {SHARD_INDEX}/{SHARD_COUNT} reading updates on {port}")
+    return server
+
+
+def update_chat_id(update):
+    """
+    Return the chat_id of a pyrogram message or callback query, or None.
+    """
+    chat = getattr(update, "chat", None) or getattr(
+        getattr(update, "message", None), "chat", None
+    )
+    if chat is not None:
+        return chat.id
+    user = getattr(update, "from_user", None)
+    return user.id if user is not None else None
+
+
+def ordered(handler):
+    """
+    Decorator of pyrogram handlers running the updates of a chat one at a time.
+
+    pyrogram runs the handlers of several updates concurrently, so a user's
+    second tap could overtake the first one. The lock of the chat is taken in
+    the order the handlers start, which is the order the updates arrived.
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(client, update, *args, **kwargs):
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            return await handler(client, update, *args, **kwargs)
+
+        entry = _chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await handler(client, update, *args, **kwargs)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _chat_locks[chat_id]
+
+    return wrapper
+
+
+def subscribe(kind, handler, keep=False):
+    """
+    Register the function that applies the events of a kind.
+
+    Args:
+        kind (str): The event kind.
+        handler (callable): Called with the event value as a string.
+        keep (bool): The latest value is a setting, a worker applies it when it
+            starts and it's never deleted.
+    """
+    _event_handlers[kind] = handler
+    if keep:
+        _kept_events.add(kind)
+
+
+async def publish(kind, value):
+    """
+    Apply a change in this process and, when sharded, in the other workers.
+    """
+    _event_handlers[kind](str(value))
+    if is_sharded():
+        await add_shard_event(kind, value)
+
+
+async def run_events():
+    """
+    Apply the events published by the workers, runs until cancelled.
+    """
+    last_id = await get_last_shard_event_id()
+    for kind in _kept_events:
+        value = await get_last_shard_event(kind)
+        if value is not None:
+            _event_handlers[kind](value)
+
+    pruned_at = time.monotonic()
+    while True:
+        await asyncio.sleep(SHARD_EVENTS_INTERVAL)
+        try:
+            # the events of this worker are applied again, they are idempotent
+            for event_id, kind, value in await get_shard_events(last_id):
+                last_id = event_id
+                handler = _event_handlers.get(kind)
+                if handler is not None:
+                    handler(value)
+
+            if is_primary() and time.monotonic() - pruned_at > SHARD_EVENTS_RETENTION:
+                await delete_shard_events(
+                    SHARD_EVENTS_RETENTION, tuple(_kept_events)
+                )
+                pruned_at = time.monotonic()
+        except Exception as e:
+            logging.error(f"Error applying shard events: {str(e)}")
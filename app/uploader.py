@@ -2,8 +2,8 @@ import os
 import ufiles
 
 ufiles_client = ufiles.UFiles(
-    ufiles_base_url="https://media.pixiee.io/v1/f",
-    usso_base_url="https://sso.pixiee.io",
+    ufiles_base_url=os.getenv("UFILES_URL", "https://media.pixiee.io/v1/f"),
+    usso_base_url=os.getenv("USSO_URL", "https://sso.pixiee.io"),
     api_key=os.getenv("PTOKEN"),
 )
 
@@ -12,3 +12,19 @@ def upload_file(file_path, file_name):
     uploaded_file = ufiles_client.upload_file(file_path, filename=file_name)
 
     return uploaded_file.url
+
+
+def upload_bytes(file_bytes, file_name):
+    """
+    Upload an in-memory file without writing it to disk first.
+
+    Args:
+        file_bytes (BytesIO): The file content, it's read from the start.
+        file_name (str): Name of the file on the storage.
+
+    Returns:
+        str: URL of the uploaded file.
+    """
+    uploaded_file = ufiles_client.upload_bytes(file_bytes, filename=file_name)
+
+    return uploaded_file.url
@@ -0,0 +1,97 @@
+"""
+Write-through cache of the users table rows.
+
+A conversion flow reads the same user several times (gender, model, audio,
+duration, credits). The cache loads the whole row once and serves the
+following reads from memory. Writes go to the database first and then to
+the cached row, and code that changes a user with its own SQL (credits,
+referrals) invalidates or patches the entry.
+"""
+import os
+from collections import OrderedDict
+
+from async_db import get_user, update_user_columns
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+
+
+class UserStateCache:
+    """
+    LRU cache of user rows by chat_id.
+    """
+
+    def __init__(self, size=USER_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+
+        # incremented on every write, a load that overlapped a write isn't cached
+        self._write_seq = 0
+
+    async def get(self, chat_id, columns):
+        """
+        Retrieve values from specific column(s) of a user, like db.get_users_columns.
+
+        Args:
+            chat_id (int): The chat ID of the user.
+            columns (list or str): Column name(s) to retrieve.
+
+        Returns:
+            dict or None: A dictionary of column-value pairs if the user exists, otherwise None.
+        """
+        if isinstance(columns, str):
+            columns = [columns]
+
+        user = await self._get_row(int(chat_id))
+        if user is None:
+            return None
+        return {column: user[column] for column in columns}
+
+    async def update(self, chat_id, **values):
+        """
+        Write columns of a user to the database in one statement, then to the cache.
+        """
+        chat_id = int(chat_id)
+        self._write_seq += 1
+        await update_user_columns(chat_id, values)
+        self.patch(chat_id, **values)
+
+    def patch(self, chat_id, **values):
+        """
+        Update a cached user after the database was changed by other means.
+        """
+        chat_id = int(chat_id)
+        self._write_seq += 1
+        user = self._entries.get(chat_id)
+        if user is not None:
+            user.update(values)
+
+    def invalidate(self, chat_id):
+        """
+        Drop a user from the cache, the next read loads it from the database.
+        """
+        self._write_seq += 1
+        self._entries.pop(int(chat_id), None)
+
+    async def _get_row(self, chat_id):
+        user = self._entries.get(chat_id)
+        if user is not None:
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return user
+
+        self.misses += 1
+        write_seq = self._write_seq
+        user = await get_user(chat_id)
+
+        # users that don't exist yet aren't cached, they may be created any time
+        if user is not None and write_seq == self._write_seq:
+            self._entries[chat_id] = user
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return user
+
+
+cache = UserStateCache()
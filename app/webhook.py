@@ -0,0 +1,278 @@
+"""
+HTTP endpoint that receives the Replicate prediction webhooks inside the bot process.
+
+The server runs on the bot's event loop. For every finished prediction it
+records the outcome in the generations table and sends the converted audio
+(or an error message) to the user.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+
+from aiohttp import web
+
+import chunking
+import job_queue
+import metrics
+import model_mirror
+import msgs
+from async_db import commit_reservation, complete_generation, refund_reservation
+from conversion_cache import cache as conversion_cache
+from user_cache import cache as user_cache
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = "/webhook/replicate"
+METRICS_PATH = "/metrics"
+
+# Bearer token required to scrape the metrics, they are public when it's not set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Signing secret from the Replicate account (whsec_...), the webhooks are
+# rejected when it's not set
+WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET")
+
+# Accept unsigned webhooks when there is no secret, only for local testing:
+# anyone who knows a prediction ID could fake its result
+ALLOW_UNSIGNED_WEBHOOKS = os.getenv("ALLOW_UNSIGNED_WEBHOOKS") == "1"
+
+# Seconds a webhook timestamp may differ from our clock
+TIMESTAMP_TOLERANCE = 5 * 60
+
+FINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+# Keep references to the running tasks so they aren't garbage collected
+_tasks = set()
+
+
+def verify_signature(headers, body, secret):
+    """
+    Verify the signature Replicate adds to its webhooks.
+
+    Args:
+        headers (Mapping): Request headers with webhook-id, webhook-timestamp and
+            webhook-signature.
+        body (bytes): The raw request body.
+        secret (str): The webhook signing secret, if it's None verification
+            only passes with ALLOW_UNSIGNED_WEBHOOKS.
+
+    Returns:
+        bool: True if the request is signed with the secret.
+    """
+    if not secret:
+        return ALLOW_UNSIGNED_WEBHOOKS
+
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature")
+    if not (webhook_id and timestamp and signatures):
+        return False
+
+    try:
+        if abs(time.time() - int(timestamp)) > TIMESTAMP_TOLERANCE:
+            return False
+    except ValueError:
+        return False
+
+    key = base64.b64decode(secret.split("_", 1)[-1])
+    signed_content = f"{webhook_id}.{timestamp}.".encode() + body
+    expected = base64.b64encode(
+        hmac.new(key, signed_content, hashlib.sha256).digest()
+    ).decode()
+
+    # the header may hold several space separated "v1,<signature>" values
+    for signature in signatures.split():
+        version, _, value = signature.partition(",")
+        if version == "v1" and hmac.compare_digest(value, expected):
+            return True
+    return False
+
+
+def get_output_url(output):
+    # the output is a single URL for wav files, but may be a list of URLs
+    if isinstance(output, list):
+        return output[-1] if output else None
+    return output
+
+
+@metrics.track_handler
+async def handle_replicate(request):
+    body = await request.read()
+    if not verify_signature(request.headers, body, WEBHOOK_SECRET):
+        return web.Response(status=401, text="invalid signature")
+
+    try:
+        prediction = json.loads(body)
+        replicate_id = prediction["id"]
+        status = prediction["status"]
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400, text="invalid prediction")
+
+    if status not in FINAL_STATUSES:
+        return web.Response(text="ignored")
+
+    output = get_output_url(prediction.get("output"))
+    if status == "succeeded" and not output:
+        status = "failed"
+
+    t_id = request.query.get("t_id")
+    voice = request.query.get("voice")
+    bot = request.app["bot"]
+
+    parent_id = request.query.get("parent")
+    if parent_id:
+        # stitching takes a while, answer Replicate before it
+        _spawn(
+            complete_chunk(
+                bot,
+                parent_id,
+                int(request.query.get("chunk", 0)),
+                replicate_id,
+                status,
+                output,
+                t_id,
+                voice,
+                float(request.query.get("duration", 0)),
+            )
+        )
+        return web.Response(text="ok")
+
+    completed = await complete_prediction(
+        bot, replicate_id, status, output, t_id, voice
+    )
+    # the webhook can arrive before the generation is recorded, an error
+    # response makes Replicate deliver it again
+    if completed is None:
+        return web.Response(status=404, text="unknown prediction")
+    # repeated webhooks for the same prediction are acknowledged but not resent
+    if not completed:
+        return web.Response(text="already completed")
+    return web.Response(text="ok")
+
+
+async def complete_chunk(
+    bot, parent_id, chunk, replicate_id, status, output, t_id, voice, duration
+):
+    try:
+        decided = await chunking.complete(
+            parent_id, chunk, replicate_id, status, output, t_id, duration
+        )
+        if decided is not None:
+            completed = await complete_prediction(bot, parent_id, *decided, t_id, voice)
+            if completed is None:
+                logging.error(f"Chunked conversion {parent_id} has no generation")
+    except Exception as e:
+        logging.error(f"Error completing chunk {chunk} of {parent_id}: {str(e)}")
+
+
+async def complete_prediction(bot, replicate_id, status, output, t_id, voice):
+    """
+    Record the outcome of a conversion and send the result to the user.
+
+    Returns:
+        bool or None: False if the conversion was already completed, None if
+            there is no generation for it (yet).
+    """
+    completed = await complete_generation(replicate_id, status, output)
+    if not completed:
+        return completed
+
+    if status == "succeeded":
+        conversion_cache.complete(replicate_id, output)
+    else:
+        conversion_cache.discard(replicate_id)
+
+    await job_queue.job_finished(replicate_id, status)
+
+    if status == "succeeded":
+        await commit_reservation(replicate_id)
+    elif await refund_reservation(replicate_id=replicate_id) and t_id:
+        user_cache.invalidate(t_id)
+
+    if t_id:
+        _spawn(send_result(bot, int(t_id), status, output, voice))
+
+    logging.info(f"prediction {replicate_id} {status}")
+    return True
+
+
+def _spawn(coroutine):
+    task = asyncio.create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def handle_metrics(request):
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        return web.Response(status=401, text="unauthorized")
+
+    await metrics.collect()
+    return web.Response(
+        text=metrics.render(), content_type="text/plain", charset="utf-8"
+    )
+
+
+async def handle_model(request):
+    path = model_mirror.get_path(request.match_info["file_name"])
+    if path is None or not os.path.exists(path):
+        raise web.HTTPNotFound()
+
+    # the name is the hash of the content, it never changes
+    return web.FileResponse(
+        path, headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
+
+
+async def send_result(bot, t_id, status, output, voice):
+    try:
+        if status == "succeeded":
+            await bot.send_audio(
+                t_id, output, caption=msgs.conversion_done.format(voice=voice)
+            )
+        else:
+            await bot.send_message(
+                t_id, msgs.conversion_failed.format(admin=msgs.admin_username)
+            )
+    except Exception as e:
+        logging.error(f"Error sending result to {t_id}: {str(e)}")
+        await bot.send_message(msgs.admin_id, f"Error sending result: {str(e)}")
+
+
+def create_app(bot):
+    app = web.Application()
+    app["bot"] = bot
+    app.router.add_post(WEBHOOK_PATH, handle_replicate)
+    app.router.add_get(METRICS_PATH, handle_metrics)
+    app.router.add_get(f"{model_mirror.MODEL_MIRROR_PATH}/{{file_name}}", handle_model)
+    return app
+
+
+async def start_server(bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+    """
+    Start the webhook server on the running event loop.
+
+    Returns:
+        web.AppRunner: The runner, call its cleanup() to stop the server.
+    """
+    if not WEBHOOK_SECRET and not ALLOW_UNSIGNED_WEBHOOKS:
+        logging.error(
+            "REPLICATE_WEBHOOK_SECRET is not set, every Replicate webhook will be "
+            "rejected and the conversions won't complete"
+        )
+    elif not WEBHOOK_SECRET:
+        logging.warning(
+            "REPLICATE_WEBHOOK_SECRET is not set, accepting unsigned webhooks"
+        )
+
+    runner = web.AppRunner(create_app(bot))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"webhook server listening on {host}:{port}{WEBHOOK_PATH}")
+    return runner
@@ -0,0 +1,175 @@
+"""
+Bounded thread pool for the blocking network calls made by the handlers.
+
+upload_file and create_rvc_conversion are synchronous, so calling them inside
+a handler stalls the bot for every user. run_blocking runs them on a thread
+pool with a concurrency limit, a timeout, retries with exponential backoff and
+per call queue/execution timings.
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Threads available for blocking calls
+POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", 8))
+
+# Calls allowed to be submitted or running at once, the rest wait in the event loop
+MAX_CONCURRENCY = int(os.getenv("WORKER_MAX_CONCURRENCY", POOL_SIZE))
+
+DEFAULT_TIMEOUT = float(os.getenv("WORKER_TIMEOUT", 60))  # seconds per attempt
+DEFAULT_RETRIES = int(os.getenv("WORKER_RETRIES", 2))
+DEFAULT_BACKOFF = float(os.getenv("WORKER_BACKOFF", 1))  # seconds, doubled per retry
+
+_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="worker")
+_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+# Timings and counters by call name
+stats = {}
+
+
+async def run_blocking(
+    func,
+    *args,
+    name=None,
+    timeout=DEFAULT_TIMEOUT,
+    retries=DEFAULT_RETRIES,
+    backoff=DEFAULT_BACKOFF,
+    **kwargs,
+):
+    """
+    Run a blocking function on the worker pool and await its result.
+
+    Args:
+        func (callable): The blocking function to run.
+        *args, **kwargs: Arguments passed to the function.
+        name (str): Name used in the stats, defaults to the function name.
+        timeout (float): Seconds to wait for each attempt, None to wait forever.
+        retries (int): Extra attempts after a failure or a timeout.
+        backoff (float): Seconds to wait before the first retry, doubled after each one.
+
+    Returns:
+        any: The return value of the function.
+
+    Raises:
+        Exception: The error of the last attempt, TimeoutError if it timed out.
+    """
+    name = name or func.__name__
+
+    for attempt in range(retries + 1):
+        try:
+            return await _run_once(name, func, args, kwargs, timeout)
+        except Exception as e:
+            if attempt == retries:
+                raise
+
+            delay = backoff * 2**attempt
+            _get_stats(name)["retries"] += 1
+            logging.warning(f"{name} failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def _run_once(name, func, args, kwargs, timeout):
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+    timing = {}
+
+    def call():
+        started = time.perf_counter()
+        timing["queue"] = started - submitted
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timing["exec"] = time.perf_counter() - started
+
+    def done(future):
+        # the slot is freed only when the thread is done, even after a timeout
+        _semaphore.release()
+        metrics.WORKER_IN_FLIGHT.dec()
+        _record(name, timing, future.exception())
+
+    metrics.WORKER_IN_FLIGHT.inc()
+    try:
+        await _semaphore.acquire()
+    except BaseException:
+        # cancelled while waiting for a slot, done() won't run
+        metrics.WORKER_IN_FLIGHT.dec()
+        raise
+    future = loop.run_in_executor(_executor, call)
+    future.add_done_callback(done)
+
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        _get_stats(name)["timeouts"] += 1
+        metrics.EXTERNAL_ERRORS.inc(name)
+        raise
+
+
+def _get_stats(name):
+    return stats.setdefault(
+        name,
+        {
+            "calls": 0,
+            "errors": 0,
+            "retries": 0,
+            "timeouts": 0,
+            "queue_time": 0.0,
+            "exec_time": 0.0,
+            "max_queue_time": 0.0,
+            "max_exec_time": 0.0,
+        },
+    )
+
+
+def _record(name, timing, error):
+    queue_time = timing.get("queue", 0.0)
+    exec_time = timing.get("exec", 0.0)
+
+    call_stats = _get_stats(name)
+    call_stats["calls"] += 1
+    call_stats["errors"] += error is not None
+    call_stats["queue_time"] += queue_time
+    call_stats["exec_time"] += exec_time
+    call_stats["max_queue_time"] = max(call_stats["max_queue_time"], queue_time)
+    call_stats["max_exec_time"] = max(call_stats["max_exec_time"], exec_time)
+
+    metrics.WORKER_WAIT_SECONDS.observe(queue_time, name)
+    metrics.EXTERNAL_SECONDS.observe(exec_time, name)
+    if error is not None:
+        metrics.EXTERNAL_ERRORS.inc(name)
+
+    logging.info(f"{name}: queued {queue_time:.3f}s, ran {exec_time:.3f}s")
+
+
+def generate_pool_report():
+    """
+    Generate a report about the calls made through the worker pool.
+
+    Returns:
+        str: A formatted string report about the worker pool.
+    """
+    if not stats:
+        return "No worker pool calls yet."
+
+    report_lines = [
+        "📊 **Worker Pool Report:**\n",
+        f"🧵 **Threads:** {POOL_SIZE}, **Max concurrency:** {MAX_CONCURRENCY}\n",
+    ]
+
+    for name, call_stats in stats.items():
+        calls = call_stats["calls"] or 1
+        report_lines.append(
+            f"🔹 **{name}:** {call_stats['calls']} calls, "
+            f"{call_stats['errors']} errors, {call_stats['retries']} retries, "
+            f"{call_stats['timeouts']} timeouts\n"
+            f"   queue avg {call_stats['queue_time'] / calls:.3f}s "
+            f"max {call_stats['max_queue_time']:.3f}s | "
+            f"run avg {call_stats['exec_time'] / calls:.3f}s "
+            f"max {call_stats['max_exec_time']:.3f}s"
+        )
+
+    return "\n".join(report_lines)